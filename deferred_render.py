@@ -1,7 +1,19 @@
 import sys
 import math
+import copy
+import itertools
+import hashlib
+import re
+import weakref
+import threading
+from array import array
+from collections import deque, OrderedDict
 from direct.showbase.DirectObject import DirectObject
 from panda3d.core import *
+try:
+    import numpy as np
+except ImportError:
+    np = None
 if sys.version_info >= (3, 0):
     import builtins
 else:
@@ -12,7 +24,7 @@ __copyright__ = "Copyright 2017-2018"
 __license__ = "ISC"
 __version__ = "0.21"
 __email__ = "wezu.dev@gmail.com"
-__all__ = ['SphereLight', 'ConeLight', 'SceneLight', 'DeferredRenderer']
+__all__ = ['SphereLight', 'ConeLight', 'SceneLight', 'DeferredRenderer', 'ShadowAtlas', 'LightManager', 'LightBatch', 'SunLight']
 
 
 class DeferredRenderer(DirectObject):
@@ -21,8 +33,16 @@ class DeferredRenderer(DirectObject):
     It installs itself in the buildins,
     it also creates a deferred_render and forward_render nodes.
     """
-
-    def __init__(self, filter_setup=None, shading_setup=None, shadows=None, scene_mask=1, light_mask=2):
+    # filter stage 'format' -> (rgba bits, float color)
+    filter_formats = {'r8': ((8, 0, 0, 0), False),
+                      'rg8': ((8, 8, 0, 0), False),
+                      'rgba8': ((8, 8, 8, 8), False),
+                      'r16f': ((16, 0, 0, 0), True),
+                      'rgba16f': ((16, 16, 16, 16), True),
+                      'r11g11b10f': ((11, 11, 10, 0), True)}
+
+    def __init__(self, filter_setup=None, shading_setup=None, shadows=None, scene_mask=1, light_mask=2,
+                 shadow_mask=13, shadow_atlas_size=4096, dynamic_shadow_mask=14):
         # check if there are other DeferredRenderer in buildins
         if hasattr(builtins, 'deferred_renderer'):
             raise RuntimeError('There can only be one DeferredRenderer')
@@ -37,9 +57,23 @@ class DeferredRenderer(DirectObject):
         self.last_window_size = (base.win.get_x_size(), base.win.get_y_size())
 
         self.shadow_size=shadows
+        # handle -> (node, light, offset)
         self.attached_lights={}
+        # node -> {'transform', 'handles', 'offsets'}
+        self._light_attachments={}
+        self._attach_handle_counter=itertools.count(1)
         self.modelMask = scene_mask
         self.lightMask = light_mask
+        self.shadowMask = shadow_mask
+        self.dynamicShadowMask = dynamic_shadow_mask
+        # stage name -> camera, timers are only installed on these
+        # when enabled, see enable_frame_timings()
+        self.stage_cams = {}
+        # stage name -> {'collector', 'times'}, see _add_stage_timer()
+        self.frame_timings = {}
+        self.frame_timings_enabled = ConfigVariableBool('deferred-frame-timings', False).getValue()
+        self.frame_timing_frames = 60
+        self.frame_timing_text = None
 
         # install a wrapped version of the loader in the builtins
         builtins.loader = WrappedLoader(builtins.loader)
@@ -56,12 +90,33 @@ class DeferredRenderer(DirectObject):
         # set up the deferred rendering buffers
         self.shading_setup = shading_setup
         self._setup_g_buffer(self.shading_setup)
+        self._setup_shadow_atlas(shadow_atlas_size)
+        self._setup_shadow_cache(self.shading_setup)
+        self.light_manager = LightManager()
+        self._setup_light_manager(self.shading_setup)
 
         # post process
         self.filter_buff = {}
         self.filter_quad = {}
         self.filter_tex = {}
         self.filter_cam = {}
+        self.filter_targets = {}
+        self.filter_build = {}
+        self.filter_inputs = {}
+        # texture name -> PTA with the part of the buffer in use,
+        # only for stages that can change size (see set_dynamic_resolution())
+        self.viewport_scale = {}
+        self.dynamic_resolution = None
+        # stage name -> translate_tex_name, for stages reading upsampled textures
+        self.filter_translate = {}
+        self.filter_parts = {}
+        # what each stage reads, see _update_filter_graph()
+        self.filter_reads = {}
+        self.filter_readers = {}
+        # names of stages turned off with set_stage_enabled()
+        self.filter_disabled = set()
+        self._neutral_textures = {}
+        self._viewport_shaders = {}
 
 
         self.cube_tex=loader.load_cube_map('tex/cube/skybox_#.png')
@@ -74,20 +129,64 @@ class DeferredRenderer(DirectObject):
         self.cube_tex.set_magfilter(SamplerState.FT_linear_mipmap_linear )
         self.cube_tex.set_minfilter(SamplerState.FT_linear_mipmap_linear)
 
+        self._setup_directional_lights()
+        # for temporal accumulation (see _expand_temporal_stages())
+        self.prev_view_proj = PTA_LMatrix4f.empty_array(1)
+        self.view_proj = Mat4.ident_mat()
+        self.temporal_jitter = PTA_LVecBase2f.empty_array(1)
+        self.temporal_frame = 0
+
         self.common_inputs = {'render': render,
                               'camera': base.cam,
+                              'dir_light_color': self.dir_light_color,
+                              'dir_light_direction': self.dir_light_direction,
+                              'num_dir_lights': self.num_dir_lights,
                               'depth_tex': self.depth,
                               'normal_tex': self.normal,
                               'albedo_tex': self.albedo,
                               'lit_tex': self.lit_tex,
                               'forward_tex': self.plain_tex,
                               'forward_aux_tex': self.plain_aux,
-                              'cube_tex': self.cube_tex}
+                              'cube_tex': self.cube_tex,
+                              'prev_view_proj': self.prev_view_proj,
+                              'temporal_jitter': self.temporal_jitter}
 
         self.filter_stages = filter_setup
+        self._shader_info = {}
+        self._setup_filter_triangle()
+        self._build_filters()
 
-        for stage in self.filter_stages:
-            self.add_filter(**stage)
+        # listen to window events so that buffers can be resized with the
+        # window
+        self.accept("window-event", self._on_window_event)
+        # update task
+        taskMgr.add(self._update, '_update_tsk', sort=-150)
+        # after the camera moved, but before the frame is rendered
+        taskMgr.add(self._update_temporal, '_update_temporal_tsk', sort=49)
+
+    def _build_filters(self, keep=(), build=None):
+        """
+        Creates the buffers, quads and cameras for all the needed filter stages
+        and sets the last stage on a card in render2d.
+        Stages named in keep are already built, only their sort and inputs
+        are updated (see reset_filters())
+        """
+        if build is None:
+            build = self._compile_filter_graph(self.filter_stages)
+        old_inputs = self.filter_inputs
+        self.filter_build = {}
+        self.filter_inputs = {}
+        if self.dynamic_resolution is not None:
+            self._setup_dynamic_stages(build, keep)
+        for index, options in enumerate(build):
+            name = options.get('name', options['shader'])
+            self.filter_build[name] = options
+            self.filter_inputs[name] = dict(options.get('inputs', {}))
+            if name in keep:
+                self.filter_buff[name].set_sort(index)
+                self._update_filter_inputs(name, old_inputs.get(name, {}), options.get('inputs', {}))
+            else:
+                self.add_filter(sort=index, **options)
         for name, tex in self.filter_tex.items():
             self.common_inputs[name] = tex
         for filter_name, quad in self.filter_quad.items():
@@ -96,32 +195,428 @@ class DeferredRenderer(DirectObject):
             except AttributeError:
                 for name, value in self.common_inputs.items():
                     quad.set_shader_input(name, value)
+        # the textures of the other stages could have moved to other targets,
+        # also a translated name can be the same as the name of a stage
+        for name in self.filter_build:
+            for old_name, new_name in (self.filter_build[name].get('translate_tex_name') or {}).items():
+                self.filter_quad[name].set_shader_input(str(new_name), self.filter_tex[old_name])
 
+        self._update_filter_graph()
         # stick the last stage quad to render2d
         # this is a bit ugly...
-        if 'name' in self.filter_stages[-1]:
-            last_stage = self.filter_stages[-1]['name']
-        else:
-            last_stage = self.filter_stages[-1]['shader']
+        last_stage = self._get_stage_name(self.filter_stages[-1])
         self.filter_quad[last_stage] = self.lightbuffer.get_texture_card()
         self.reload_filter(last_stage)
         self.filter_quad[last_stage].reparent_to(render2d)
+        self._apply_disabled_stages()
 
-        # listen to window events so that buffers can be resized with the
-        # window
-        self.accept("window-event", self._on_window_event)
-        # update task
-        taskMgr.add(self._update, '_update_tsk', sort=-150)
+    def _update_filter_inputs(self, stage_name, old_inputs, inputs):
+        """
+        Sets the inputs of a filter stage that are not the same as in old_inputs
+        """
+        quad = self.filter_quad[stage_name]
+        for name, value in inputs.items():
+            if name in old_inputs and old_inputs[name] == value:
+                continue
+            if isinstance(value, str):
+                value = loader.load_texture(value, sRgb=loader.use_srgb)
+                inputs[name] = value
+            quad.set_shader_input(name, value)
+        for name in old_inputs:
+            if name not in inputs:
+                quad.clear_shader_input(name)
+
+    def _is_same_filter_stage(self, old, new):
+        """
+        Returns True if a built stage can be used for the new stage options
+        (same shader, defines, size, target and texture names)
+        """
+        for key in ('shader', 'define', 'size', 'min_size', 'format', 'clear_color', 'translate_tex_name', 'target'):
+            if old.get(key) != new.get(key):
+                return False
+        return True
+
+    def _get_stage_name(self, stage):
+        if 'name' in stage:
+            return stage['name']
+        return stage['shader']
+
+    def _get_shader_info(self, shader):
+        """
+        Returns the names of the sampler uniforms in a filter shader
+        and True if the shader can discard pixels
+        """
+        if shader not in self._shader_info:
+            samplers = set()
+            discards = False
+            for path in (self.v.format(shader), self.f.format(shader)):
+                txt = loader.read_shader_source(path)
+                samplers.update(re.findall(r'uniform\s+\w*sampler\w*\s+(\w+)', txt))
+                discards = discards or re.search(r'\bdiscard\b', txt) is not None
+            self._shader_info[shader] = (samplers, discards)
+        return self._shader_info[shader]
+
+    def _compile_filter_graph(self, filter_setup):
+        """
+        Turns the filter_setup into a list of add_filter() arguments:
+        - stages that render something no other stage reads are dropped
+          (the last stage is drawn straight to the screen, it needs no buffer)
+        - stages that are never needed at the same time share one texture
+        - stages that overwrite every pixel don't clear their buffer
+        A stage reads the output of other stages using translate_tex_name
+        or a sampler uniform with the name of the stage.
+        Set 'keep' in the stage dict to always build the stage with its own texture
+        (eg. if the texture is used outside the filters)
+        """
+        self.filter_translate = {}
+        filter_setup = self._expand_temporal_stages(filter_setup)
+        filter_setup = self._expand_upsample_stages(filter_setup)
+        names = [self._get_stage_name(stage) for stage in filter_setup]
+        # all the stages before fusion, see _update_filter_graph()
+        self.filter_parts = dict(zip(names, filter_setup))
+        index_of = dict((name, i) for i, name in enumerate(names))
+        reads = []
+        for stage in filter_setup:
+            samplers = self._get_shader_info(stage['shader'])[0]
+            read = set(index_of[name] for name in samplers if name in index_of)
+            if 'translate_tex_name' in stage:
+                read.update(index_of[name] for name in stage['translate_tex_name'] if name in index_of)
+            reads.append(read)
+
+        last = len(filter_setup) - 1
+        needed = set()
+        to_visit = [last] + [i for i, stage in enumerate(filter_setup) if stage.get('keep')]
+        while to_visit:
+            i = to_visit.pop()
+            if i not in needed:
+                needed.add(i)
+                to_visit.extend(reads[i])
+
+        needed, stages = self._fuse_filter_stages(filter_setup, needed, reads, index_of)
+        # the stages changed, read the shaders again
+        for i in needed:
+            samplers = self._get_shader_info(stages[i]['shader'])[0]
+            read = set(index_of[name] for name in samplers if name in index_of)
+            if 'translate_tex_name' in stages[i]:
+                read.update(index_of[name] for name in stages[i]['translate_tex_name'] if name in index_of)
+            reads[i] = read
+
+        # the last stage (in filter order) that reads each texture
+        last_read = {}
+        pinned = set(i for i, stage in enumerate(filter_setup) if stage.get('keep'))
+        for i in sorted(needed):
+            for j in reads[i]:
+                if j >= i:  # reads a texture that's not rendered yet (last frame)
+                    pinned.add(j)
+                last_read[j] = max(i, last_read.get(j, i))
+
+        # give each texture a shared target, the target is free again
+        # after the last stage that reads it
+        targets = []  # [(size, format), free after index, target id]
+        build = []
+        for i in sorted(needed):
+            if i == last:
+                continue
+            stage = stages[i]
+            size = (stage.get('size', 1.0), stage.get('format', 'rgba8'))
+            target = None
+            if i not in pinned:
+                for candidate in targets:
+                    if candidate[0] == size and candidate[1] is not None and candidate[1] < i:
+                        target = candidate
+                        break
+            if target is None:
+                target = [size, None, len(targets)]
+                targets.append(target)
+            if i in pinned:
+                target[1] = None
+            else:
+                target[1] = last_read.get(i, i)
+            options = dict(stage)
+            options['inputs'] = dict(stage.get('inputs', {}))
+            options.pop('keep', None)
+            options.pop('fuse', None)
+            options.pop('upsample', None)
+            options.pop('temporal', None)
+            options.pop('neutral', None)
+            options['target'] = target[2]
+            if 'clear_color' not in stage:
+                if self._get_shader_info(stage['shader'])[1]:
+                    options['clear_color'] = (0, 0, 0, 0)
+                else:
+                    options['clear_color'] = None
+            build.append(options)
+        return build
+
+    def _redirect_stage_reads(self, stage, renamed):
+        """
+        Returns the stage dict changed to read the textures named in renamed
+        (old name: new name) from the new stages, the sampler names stay the same
+        """
+        name = self._get_stage_name(stage)
+        translate = {}
+        for old_name, new_name in (stage.get('translate_tex_name') or {}).items():
+            translate[renamed.get(old_name, old_name)] = new_name
+        for sampler in self._get_shader_info(stage['shader'])[0] & set(renamed):
+            if sampler != name:
+                translate.setdefault(renamed[sampler], sampler)
+        if translate != (stage.get('translate_tex_name') or {}):
+            stage = dict(stage)
+            stage['translate_tex_name'] = translate
+            self.filter_translate[name] = translate
+        return stage
+
+    def _expand_temporal_stages(self, filter_setup):
+        """
+        Adds the stages for temporal accumulation after each stage with
+        'temporal' set to the weight of the history (eg. 0.9):
+        '<name>_temporal' mixes the output with the output of the last frame
+        (moved to where the pixels are now using prev_view_proj),
+        '<name>_history' keeps a copy for the next frame, and a shared
+        'temporal_depth' stage keeps the depth to find disocclusions.
+        The stage is compiled with TEMPORAL defined (and temporal_jitter changes
+        each frame), the other stages read the '<name>_temporal' texture.
+        """
+        temporal = set()
+        for stage in filter_setup[:-1]:
+            if stage.get('temporal'):
+                temporal.add(self._get_stage_name(stage))
+        if not temporal:
+            return filter_setup
+        renamed = dict((name, name + '_temporal') for name in temporal)
+        stages = []
+        for stage in filter_setup:
+            name = self._get_stage_name(stage)
+            if stage is filter_setup[-1]:
+                stages.append({'name': 'temporal_depth',
+                               'shader': 'temporal_depth'})
+            stage = self._redirect_stage_reads(stage, renamed)
+            if name not in temporal:
+                stages.append(stage)
+                continue
+            stage = dict(stage)
+            stage['define'] = dict(stage.get('define') or {})
+            stage['define']['TEMPORAL'] = 1
+            upsample = stage.pop('upsample', None)
+            stages.append(stage)
+            accumulate = {'name': name + '_temporal',
+                          'shader': 'temporal',
+                          'size': stage.get('size', 1.0),
+                          'inputs': {'temporal_blend': float(stage['temporal'])},
+                          'translate_tex_name': {name: 'current_tex',
+                                                 name + '_history': 'history_tex',
+                                                 'temporal_depth': 'history_depth'}}
+            history = {'name': name + '_history',
+                       'shader': 'temporal_copy',
+                       'size': stage.get('size', 1.0),
+                       'translate_tex_name': {name + '_temporal': 'input_tex'}}
+            if upsample is not None:
+                accumulate['upsample'] = upsample
+            if 'format' in stage:
+                accumulate['format'] = stage['format']
+                history['format'] = stage['format']
+            stages.append(accumulate)
+            stages.append(history)
+        return stages
+
+    def _expand_upsample_stages(self, filter_setup):
+        """
+        Adds a stage after each stage with 'upsample' set to 'bilateral'
+        (and a size less than 1.0) that scales its texture up to full size
+        using the depth and normals, the stage is named '<name>_upsample'
+        and the other stages read it in place of the low res texture
+        """
+        upsampled = set()
+        for stage in filter_setup[:-1]:
+            if stage.get('upsample') == 'bilateral' and stage.get('size', 1.0) < 1.0:
+                upsampled.add(self._get_stage_name(stage))
+        if not upsampled:
+            return filter_setup
+        renamed = dict((name, name + '_upsample') for name in upsampled)
+        stages = []
+        for stage in filter_setup:
+            name = self._get_stage_name(stage)
+            stages.append(self._redirect_stage_reads(stage, renamed))
+            if name in upsampled:
+                upsample = {'name': name + '_upsample',
+                            'shader': 'bilateral_upsample',
+                            'translate_tex_name': {name: 'low_tex'}}
+                if 'format' in stage:
+                    upsample['format'] = stage['format']
+                stages.append(upsample)
+        return stages
+
+    def _fuse_filter_stages(self, filter_setup, needed, reads, index_of):
+        """
+        Merges chains of stages into one stage (and one shader) where possible,
+        a stage can be merged into the next one if the next stage only samples
+        its output at the current uv, they have the same size and no other stage
+        reads it. Set 'fuse' to 0 in a stage dict to never merge it.
+        Returns the needed stages and a list of stage dicts (with the merged stages)
+        """
+        self.filter_alias = {}
+        self.filter_fused = {}
+        stages = list(filter_setup)
+        last = len(filter_setup) - 1
+        order = sorted(needed)
+        readers = {}
+        for i in order:
+            for j in reads[i]:
+                readers.setdefault(j, set()).add(i)
+        for i, j in zip(order, order[1:]):
+            a = stages[i]
+            b = stages[j]
+            if j == last or a.get('keep') or not a.get('fuse', True) or not b.get('fuse', True):
+                continue
+            if readers.get(i) != set([j]):
+                continue
+            fused = self._fuse_stage_pair(a, b, self._get_stage_name(filter_setup[i]))
+            if fused is None:
+                continue
+            stages[j] = fused
+            needed.discard(i)
+            readers.pop(i, None)
+            for k in reads[i]:
+                readers[k].discard(i)
+                readers[k].add(j)
+            reads[j] = (reads[j] | reads[i]) - set([i])
+            # stages merged earlier into 'a' now live in 'b' too
+            a_name = self._get_stage_name(a)
+            for alias, target in self.filter_alias.items():
+                if target == a_name:
+                    self.filter_alias[alias] = fused['name']
+            self.filter_alias[a_name] = fused['name']
+            self.filter_fused.pop(a_name, None)
+            self.filter_fused[fused['name']] = fused
+        return needed, stages
+
+    def _fuse_stage_pair(self, a, b, a_output):
+        """
+        Returns a new stage dict that does the work of stage a and b in one shader,
+        or None if the stages can't be merged
+        """
+        if a.get('size', 1.0) != b.get('size', 1.0):
+            return None
+        if 'min_size' in a or 'min_size' in b:
+            return None  # dynamic resolution needs a buffer for each
+        translate = b.get('translate_tex_name') or {}
+        if a_output not in translate or a_output in self._get_shader_info(b['shader'])[0]:
+            return None
+        input_name = str(translate[a_output])
+        if self._get_shader_info(a['shader'])[1] or self._get_shader_info(b['shader'])[1]:
+            return None  # discard
+        v_txt = loader.read_shader_source(self.v.format(a['shader']))
+        if v_txt != loader.read_shader_source(self.v.format(b['shader'])):
+            return None
+        inputs = dict(a.get('inputs') or {})
+        for name, value in (b.get('inputs') or {}).items():
+            if name in inputs and inputs[name] != value:
+                return None
+            inputs[name] = value
+        new_translate = dict(a.get('translate_tex_name') or {})
+        for old_name, new_name in translate.items():
+            if old_name == a_output:
+                continue
+            if new_name in new_translate.values() and new_translate.get(old_name) != new_name:
+                return None
+            new_translate[old_name] = new_name
+        prefix = 'fused_' + re.sub(r'\W', '_', self._get_stage_name(a))
+        a_txt = self._prepare_fused_source(loader.read_shader_source(self.f.format(a['shader'])),
+                                           a.get('define'), prefix)
+        b_txt = self._prepare_fused_source(loader.read_shader_source(self.f.format(b['shader'])),
+                                           b.get('define'), None)
+        # b should only read the texture from a at the current uv
+        sample = re.compile(r'texture\s*\(\s*' + input_name + r'\s*,\s*uv\s*\)')
+        declaration = re.compile(r'^\s*uniform\s+sampler2D\s+' + input_name + r'\s*;\s*$', re.M)
+        b_txt = declaration.sub('', sample.sub(prefix + '_out', b_txt))
+        if re.search(r'\b' + input_name + r'\b', b_txt):
+            return None
+        b_txt = self._remove_duplicate_declarations(a_txt, b_txt)
+        if b_txt is None:
+            return None
+        # stage a can be turned off with '<prefix>_enabled' (see set_stage_enabled())
+        call = ('\n    if ({0}_enabled > 0.5)\n        {0}_main();\n'
+                '    else\n        {0}_out = {0}_neutral;').format(prefix)
+        b_txt, calls = re.subn(r'(void\s+main\s*\(\s*\)\s*\{)', lambda match: match.group(1) + call, b_txt, count=1)
+        if not calls:
+            return None
+        toggle = 'uniform float {0}_enabled;\nuniform vec4 {0}_neutral;\n'.format(prefix)
+        f_txt = '#version 140\n' + toggle + a_txt + '\n' + b_txt
+        shader = 'fused_{0}'.format(hashlib.md5(f_txt.encode('utf-8')).hexdigest()[:12])
+        loader.add_shader_source(self.v.format(shader), v_txt)
+        loader.add_shader_source(self.f.format(shader), f_txt)
+        inputs[prefix + '_enabled'] = 1.0
+        inputs[prefix + '_neutral'] = self._get_neutral_color(a.get('neutral', 0.0))
+        fused = {'name': self._get_stage_name(b),
+                 'shader': shader,
+                 'inputs': inputs,
+                 'size': b.get('size', 1.0),
+                 'translate_tex_name': new_translate}
+        for key in ('clear_color', 'keep', 'format', 'neutral'):
+            if key in b:
+                fused[key] = b[key]
+        return fused
+
+    def _prepare_fused_source(self, txt, define, prefix):
+        """
+        Puts the defines of a stage around its shader source, if a prefix is given
+        the functions and constants get renamed, main() writes to a variable
+        """
+        txt = re.sub(r'^\s*(//GLSL|#version.*)$', '', txt, flags=re.M)
+        if prefix is not None:
+            names = re.findall(r'^[A-Za-z_]\w*\s+([A-Za-z_]\w*)\s*\(', txt, flags=re.M)
+            names += re.findall(r'^const\s+\w+\s+([A-Za-z_]\w*)', txt, flags=re.M)
+            for name in set(names) - set(['main']):
+                txt = re.sub(r'\b' + name + r'\b', prefix + '_' + name, txt)
+            txt = re.sub(r'\bvoid\s+main\s*\(', 'void ' + prefix + '_main(', txt)
+            txt = txt.replace('gl_FragData[0]', prefix + '_out')
+            txt = 'vec4 {0}_out;\n'.format(prefix) + txt
+        if define:
+            header = ''
+            footer = ''
+            for name, value in define.items():
+                header += '#define {0} {1}\n'.format(name, value)
+                footer += '#undef {0}\n'.format(name)
+            txt = header + txt + '\n' + footer
+        return txt
+
+    def _remove_duplicate_declarations(self, a_txt, b_txt):
+        """
+        Removes uniforms and inputs from b_txt that are already declared in a_txt,
+        returns None if a name is declared in both with a different type,
+        or if it's only declared under a #if in a_txt
+        """
+        declaration = re.compile(r'^\s*(uniform|in)\s+(\w+)\s+(\w+)\s*(\[[^\]]*\])?\s*;')
+        a_declared = {}
+        depth = 0
+        for line in a_txt.splitlines():
+            stripped = line.strip()
+            if stripped.startswith('#if'):
+                depth += 1
+            elif stripped.startswith('#endif'):
+                depth -= 1
+            match = declaration.match(line)
+            if match:
+                a_declared[match.group(3)] = (' '.join(stripped.split()), depth)
+        lines = []
+        depth = 0
+        for line in b_txt.splitlines():
+            stripped = line.strip()
+            if stripped.startswith('#if'):
+                depth += 1
+            elif stripped.startswith('#endif'):
+                depth -= 1
+            match = declaration.match(line)
+            if match and match.group(3) in a_declared:
+                a_line, a_depth = a_declared[match.group(3)]
+                if a_line != ' '.join(stripped.split()) or a_depth > depth:
+                    return None
+                continue
+            lines.append(line)
+        return '\n'.join(lines)
 
     def save_screenshot(self, name='screen', extension='png'):
-        if 'name' in self.filter_stages[-1]:
-            last_stage = self.filter_stages[-1]['name']
-        else:
-            last_stage = self.filter_stages[-1]['shader']
-        tex=self.filter_tex[last_stage]
-        base.graphicsEngine.extract_texture_data(tex, base.win.getGsg())
-        #base.graphicsEngine.renderFrame()
-        tex.write(name+'.'+extension)
+        base.win.save_screenshot(Filename(name+'.'+extension))
         print('Screen saved to:', name+'.'+extension)
 
     def set_cubemap(self, cubemap):
@@ -155,68 +650,75 @@ class DeferredRenderer(DirectObject):
 
     def reset_filters(self, filter_setup, shading_setup=None):
         """
-        Remove all filters and creates a new filter list using the given filter_setup (dict)
+        Changes the filters to the given filter_setup (list of dicts),
+        stages with the same name, shader, defines, size and texture names
+        keep their buffers and only get the inputs that changed
         """
-        # special case - get the inputs for the directionl light(s)
-        dir_light_num_lights = self.get_filter_define(
-            'final_light', 'NUM_LIGHTS')
-        dir_light_color = self.get_filter_input('final_light', 'light_color')
-        dir_light_dir = self.get_filter_input('final_light', 'direction')
-
-        # remove buffers
-        for buff in self.filter_buff.values():
-            buff.clear_render_textures()
-            base.win.get_gsg().get_engine().remove_window(buff)
-        # remove quads, but keep the last one (detach it)
-        # the last one should also be self.lightbuffer.get_texture_card()
-        # so we don't need to keep a reference to it
-        if 'name' in self.filter_stages[-1]:
-            last_stage = self.filter_stages[-1]['name']
-        else:
-            last_stage = self.filter_stages[-1]['shader']
-        for name, quad in self.filter_quad.items():
-            if name != last_stage:
-                quad.remove_node()
-            else:
-                quad.detach_node()
-        for cam in self.filter_cam.values():
-            cam.remove_node()
-        # load the new values
-        self.filter_buff = {}
-        self.filter_quad = {}
-        self.filter_tex = {}
-        self.filter_cam = {}
+        old_build = self.filter_build
+        old_targets = self.filter_targets
         self.filter_stages = filter_setup
-        for stage in self.filter_stages:
-            self.add_filter(**stage)
-        for name, tex in self.filter_tex.items():
-            self.common_inputs[name] = tex
-        for filter_name, quad in self.filter_quad.items():
-            try:
-                quad.set_shader_inputs(**self.common_inputs)
-            except AttributeError:
-                for name, value in self.common_inputs.items():
-                    quad.set_shader_input(name, value)
-        # stick the last stage quad to render2d
-        # this is a bit ugly...
-        if 'name' in self.filter_stages[-1]:
-            last_stage = self.filter_stages[-1]['name']
-        else:
-            last_stage = self.filter_stages[-1]['shader']
-        self.filter_quad[last_stage] = self.lightbuffer.get_texture_card()
-        self.reload_filter(last_stage)
-        self.filter_quad[last_stage].reparent_to(render2d)
-
-        # reapply the directional lights
-        self.set_filter_define(
-            'final_light', 'NUM_LIGHTS', dir_light_num_lights)
-        if dir_light_color:
-            self.set_filter_input('final_light', None, dir_light_color)
-            self.set_filter_input('final_light', None, dir_light_dir)
+        build = self._compile_filter_graph(filter_setup)
+        # targets keep their texture if the size and format are the same
+        sizes = {}
+        for options in build:
+            sizes[options['target']] = (options.get('size', 1.0), options.get('format', 'rgba8'))
+        self.filter_targets = {}
+        for target, tex in old_targets.items():
+            for options in old_build.values():
+                if options['target'] == target:
+                    if sizes.get(target) == (options.get('size', 1.0), options.get('format', 'rgba8')):
+                        self.filter_targets[target] = tex
+                    break
+        keep = set()
+        dynamic = set(name for name, options in self.filter_build.items() if 'min_size' in options)
+        if dynamic != set(options.get('name', options['shader']) for options in build if 'min_size' in options):
+            # the shaders that read the textures of these stages change
+            old_build = {}
+        for options in build:
+            name = options.get('name', options['shader'])
+            if (name in old_build and name in self.filter_buff
+                    and options['target'] in self.filter_targets
+                    and self._is_same_filter_stage(old_build[name], options)):
+                keep.add(name)
+        # remove buffers, quads and cameras of the stages that changed
+        # the last one should also be self.lightbuffer.get_texture_card()
+        # so just detach it
+        for name, buff in list(self.filter_buff.items()):
+            if name not in keep:
+                buff.clear_render_textures()
+                base.win.get_gsg().get_engine().remove_window(buff)
+                del self.filter_buff[name]
+        for name, quad in list(self.filter_quad.items()):
+            if name not in keep:
+                if name in self.filter_cam:
+                    quad.remove_node()
+                else:
+                    quad.detach_node()
+                del self.filter_quad[name]
+        for name, cam in list(self.filter_cam.items()):
+            if name not in keep:
+                cam.remove_node()
+                del self.filter_cam[name]
+                self.stage_cams.pop(name, None)
+                self.frame_timings.pop(name, None)
+        # remove the textures of the old stages from the common inputs
+        for name in self.filter_tex:
+            self.common_inputs.pop(name, None)
+        for name in list(self.filter_tex):
+            if name not in keep:
+                del self.filter_tex[name]
+        self._build_filters(keep, build)
 
         if shading_setup != self.shading_setup:
             self.light_root.set_shader(loader.load_shader_GLSL(
                 self.v.format('point_light'), self.f.format('point_light'), shading_setup))
+            self.point_light_geom.set_shader(loader.load_shader_GLSL(
+                self.v.format('point_light_instanced'), self.f.format('point_light_instanced'), shading_setup))
+            self._setup_clustered_lights(shading_setup)
+            self._setup_light_manager(shading_setup)
+            for sun in self.sun_lights:
+                self._set_sun_shader(sun, shading_setup)
+            self._setup_shadow_cache(shading_setup)
             self.geometry_root.set_shader(loader.load_shader_GLSL(
                 self.v.format('geometry'), self.f.format('geometry'), shading_setup))
             self.plain_root.set_shader(loader.load_shader_GLSL(
@@ -234,6 +736,12 @@ class DeferredRenderer(DirectObject):
         """
         Reloads the shader and inputs of a given filter stage
         """
+        if stage_name in self.filter_alias or stage_name in self.filter_fused:
+            # merged stages need a new shader made from the changed stage dicts
+            self.reset_filters(self.filter_stages, self.shading_setup)
+            return
+        if stage_name not in self.filter_quad:  # stage not used
+            return
         id = self._get_filter_stage_index(stage_name)
         shader = self.filter_stages[id]['shader']
         inputs = {}
@@ -242,8 +750,12 @@ class DeferredRenderer(DirectObject):
         define = None
         if 'define' in self.filter_stages[id]:
             define = self.filter_stages[id]['define']
-        self.filter_quad[stage_name].set_shader(loader.load_shader_GLSL(
-            self.v.format(shader), self.f.format(shader), define))
+        if self.filter_stages[id].get('temporal') and stage_name != self._get_stage_name(self.filter_stages[-1]):
+            define = dict(define or {})
+            define['TEMPORAL'] = 1
+        # stages that read upsampled textures read them under other names
+        translate = self.filter_translate.get(stage_name, self.filter_stages[id].get('translate_tex_name'))
+        self._set_filter_shader(self.filter_quad[stage_name], stage_name, shader, define, translate)
         for name, value in inputs.items():
             if isinstance(value, str):
                 value = loader.load_texture(value)
@@ -256,17 +768,19 @@ class DeferredRenderer(DirectObject):
             for name, value in inputs.items():
                 self.filter_quad[stage_name].set_shader_input(name, value)
 
-        if 'translate_tex_name' in self.filter_stages[id]:
-            for old_name, new_name in self.filter_stages[id]['translate_tex_name'].items():
+        if translate:
+            for old_name, new_name in translate.items():
                 value = self.filter_tex[old_name]
                 self.filter_quad[stage_name].set_shader_input(
                     str(new_name), value)
+        if self.filter_disabled:
+            self._apply_disabled_stages()
 
     def get_filter_define(self, stage_name, name):
         """
         Returns the current value of a shader pre-processor define for a given filter stage
         """
-        if stage_name in self.filter_quad:
+        if stage_name in self.filter_quad or stage_name in self.filter_alias:
             id = self._get_filter_stage_index(stage_name)
             if 'define' in self.filter_stages[id]:
                 if name in self.filter_stages[id]['define']:
@@ -278,7 +792,7 @@ class DeferredRenderer(DirectObject):
         Sets a define value for the shader pre-processor for a given filter stage,
         The shader for that filter stage gets reloaded, so no need to call reload_filter()
         """
-        if stage_name in self.filter_quad:
+        if stage_name in self.filter_quad or stage_name in self.filter_alias:
             id = self._get_filter_stage_index(stage_name)
             if 'define' in self.filter_stages[id]:
                 if value is None:
@@ -291,6 +805,125 @@ class DeferredRenderer(DirectObject):
             # reload the shader
             self.reload_filter(stage_name)
 
+    def set_stage_enabled(self, stage_name, enabled=True):
+        """
+        Turns a filter stage on or off without rebuilding the filters.
+        A disabled stage (and the stages that only it reads) is not rendered,
+        the stages that read it get a 1x1 texture with the 'neutral' color
+        of the stage (eg. 1.0 for ao, black if not set).
+        A stage merged into another stage (see _fuse_filter_stages()) is
+        skipped by its shader using the '<prefix>_enabled' input
+        """
+        if stage_name == self._get_stage_name(self.filter_stages[-1]):
+            raise ValueError('The last filter stage can not be disabled')
+        self._get_filter_stage_index(stage_name)
+        if enabled:
+            self.filter_disabled.discard(stage_name)
+        else:
+            self.filter_disabled.add(stage_name)
+        self._apply_disabled_stages()
+
+    def is_stage_enabled(self, stage_name):
+        """
+        Returns False if the stage was turned off with set_stage_enabled()
+        """
+        return stage_name not in self.filter_disabled
+
+    def _get_neutral_color(self, color):
+        """
+        Returns the 'neutral' value of a stage as a Vec4
+        """
+        if isinstance(color, (int, float)):
+            color = (color, color, color, color)
+        return Vec4(*color)
+
+    def _get_neutral_texture(self, color):
+        """
+        Returns a 1x1 texture of the given color (cached)
+        """
+        color = tuple(self._get_neutral_color(color))
+        if color not in self._neutral_textures:
+            tex = Texture('neutral')
+            tex.setup_2d_texture(1, 1, Texture.T_unsigned_byte, Texture.F_rgba8)
+            tex.set_clear_color(LColor(*color))
+            self._neutral_textures[color] = tex
+        return self._neutral_textures[color]
+
+    def _update_filter_graph(self):
+        """
+        Finds what each filter stage reads, done once when the filters are built,
+        so set_stage_enabled() only needs to look things up.
+        filter_reads - input name -> texture name, for each stage with a quad
+        filter_readers - texture name -> names of the stages (before fusion) that read it
+        """
+        last_stage = self._get_stage_name(self.filter_stages[-1])
+        built = dict(self.filter_build)
+        built[last_stage] = dict(self.filter_stages[-1])
+        built[last_stage]['translate_tex_name'] = self.filter_translate.get(
+            last_stage, self.filter_stages[-1].get('translate_tex_name'))
+        self.filter_reads = {}
+        for name, options in built.items():
+            inputs = {}
+            for sampler in self._get_shader_info(options['shader'])[0]:
+                if sampler in built:
+                    inputs[sampler] = sampler
+            for old_name, new_name in (options.get('translate_tex_name') or {}).items():
+                inputs[str(new_name)] = old_name
+            self.filter_reads[name] = inputs
+        parts = dict(self.filter_parts)
+        parts[last_stage] = built[last_stage]
+        self.filter_readers = {}
+        for name, stage in parts.items():
+            read = set(sampler for sampler in self._get_shader_info(stage['shader'])[0] if sampler in parts)
+            read.update(stage.get('translate_tex_name') or {})
+            for tex_name in read:
+                self.filter_readers.setdefault(tex_name, set()).add(name)
+
+    def _apply_disabled_stages(self):
+        """
+        Turns off the buffers of the disabled stages (or the part of a merged
+        stage shader) and sets the neutral texture (or the texture of the stage
+        if it's enabled) on the stages that read them
+        """
+        disabled = set()
+        neutral = {}
+        for name in self.filter_disabled:
+            if name not in self.filter_parts:
+                continue
+            color = self.filter_parts[name].get('neutral', 0.0)
+            # the stages made for it by the graph compiler go with it
+            for suffix in ('', '_temporal', '_history', '_upsample', '_temporal_upsample'):
+                if name + suffix in self.filter_parts:
+                    disabled.add(name + suffix)
+                    neutral[name + suffix] = color
+        # stages only read by disabled stages have nothing to do
+        changed = True
+        while changed:
+            changed = False
+            for name in self.filter_parts:
+                stage_readers = self.filter_readers.get(name, set()) - set([name])
+                if name not in disabled and stage_readers and stage_readers <= disabled:
+                    disabled.add(name)
+                    changed = True
+        for name, buff in self.filter_buff.items():
+            buff.set_active(name not in disabled)
+        for name, target in self.filter_alias.items():
+            if target not in self.filter_quad:
+                continue
+            prefix = 'fused_' + re.sub(r'\W', '_', name)
+            quad = self.filter_quad[target]
+            quad.set_shader_input(prefix + '_enabled', 0.0 if name in disabled else 1.0)
+            quad.set_shader_input(prefix + '_neutral', self._get_neutral_color(
+                neutral.get(name, self.filter_parts[name].get('neutral', 0.0))))
+        for name, inputs in self.filter_reads.items():
+            if name in disabled or name not in self.filter_quad:
+                continue
+            for input_name, tex_name in inputs.items():
+                if tex_name in neutral:
+                    self.filter_quad[name].set_shader_input(input_name, self._get_neutral_texture(neutral[tex_name]))
+                elif tex_name in self.filter_tex:
+                    self.filter_quad[name].set_shader_input(input_name, self.filter_tex[tex_name])
+
     def _get_filter_stage_index(self, name):
         """
         Returns the index of a filter stage
@@ -307,9 +940,10 @@ class DeferredRenderer(DirectObject):
         """
         Returns the shader input from a given stage
         """
-        if stage_name in self.filter_quad:
-            id = self._get_filter_stage_index(stage_name)
-            return self.filter_quad[stage_name].get_shader_input(str(name))
+        # merged stages share one quad
+        quad_name = self.filter_alias.get(stage_name, stage_name)
+        if quad_name in self.filter_quad:
+            return self.filter_quad[quad_name].get_shader_input(str(name))
         return None
 
     def set_filter_input(self, stage_name, name, value, modify_using=None):
@@ -318,10 +952,12 @@ class DeferredRenderer(DirectObject):
         modify_using - should be an operator, like operator.add if you want to
                        change the value of an input based on the current value
         """
-        if stage_name in self.filter_quad:
+        # merged stages share one quad
+        quad_name = self.filter_alias.get(stage_name, stage_name)
+        if quad_name in self.filter_quad:
             id = self._get_filter_stage_index(stage_name)
             if name is None:
-                self.filter_quad[stage_name].set_shader_input(value)
+                self.filter_quad[quad_name].set_shader_input(value)
                 return
             if modify_using is not None:
                 value = modify_using(self.filter_stages[id][
@@ -338,9 +974,136 @@ class DeferredRenderer(DirectObject):
                     tex.set_wrap_u(Texture.WMClamp)
                     tex.set_wrap_v(Texture.WMClamp)
                 value=tex
-            self.filter_quad[stage_name].set_shader_input(str(name), value)
+            self.filter_quad[quad_name].set_shader_input(str(name), value)
             # print(stage_name, name, value)
 
+    def get_shader_variants(self, presets=None, light_types=('point', 'spot', 'sun'), max_dir_lights=None,
+                            cascades=4):
+        """
+        Returns a list of (vertex, fragment, define) of all the shader variants
+        the presets can use, each variant is listed once
+        (defines a shader doesn't use don't make a new variant, see getShaderKey())
+        presets - list of preset ini files or (filter_setup, shading_setup) pairs,
+        None for the current setup
+        light_types - the lights that will be used: 'point', 'spot' and/or 'sun'
+        max_dir_lights - also list the dir_light stages with MAX_DIR_LIGHTS set to this
+        (for setups that change it with set_max_dir_lights())
+        cascades - number of shadow cascades used by the suns
+        Variants made for dynamic resolution (set_dynamic_resolution()) are not included.
+        """
+        if presets is None:
+            presets = [(self.filter_stages, self.shading_setup)]
+        variants = OrderedDict()
+        for preset in presets:
+            if isinstance(preset, str):
+                from options import Options
+                options = Options(preset).get()
+                preset = (options['filter_setup'], options['shading_setup'])
+            for v_shader, f_shader, define in self._get_shader_variants(preset[0], preset[1], light_types,
+                                                                        max_dir_lights, cascades):
+                key = loader.get_shader_key(v_shader, f_shader, define)
+                variants.setdefault(key, (v_shader, f_shader, define))
+        return list(variants.values())
+
+    def prewarm_shaders(self, presets=None, light_types=('point', 'spot', 'sun'), max_dir_lights=None,
+                        cascades=4, progress=None, per_frame=4):
+        """
+        Makes all the shader variants the presets can use up front,
+        so lights and filters don't make new shaders in the middle of the game.
+        The presets, light_types, max_dir_lights and cascades are the same
+        as for get_shader_variants().
+        The sources are read (or the shaders are found in the model cache,
+        see readCachedShader()) on a thread, the results are handed back
+        in record['ready'], the thread doesn't write the shader cache,
+        then per_frame shaders are made and
+        prepared on the gsg each frame, progress(done, total) is called every frame,
+        keep the loading screen up until done == total.
+        Returns the number of variants
+        """
+        variants = self.get_shader_variants(presets, light_types, max_dir_lights, cascades)
+        record = {'ready': deque(),
+                  'done': 0,
+                  'total': len(variants),
+                  'progress': progress,
+                  'per_frame': max(1, per_frame)}
+
+        def _preprocess(variants):
+            for v_shader, f_shader, define in variants:
+                sources = None
+                try:
+                    sources = loader.read_cached_shader(v_shader, f_shader, define)
+                    if sources is None:
+                        sources = loader.preprocess_shader_GLSL(v_shader, f_shader, define)
+                except (IOError, OSError) as err:
+                    # loadShaderGLSL() will raise it again on the main thread
+                    print('Can not read shader:', err)
+                record['ready'].append((v_shader, f_shader, define, sources))
+
+        thread = threading.Thread(target=_preprocess, args=(variants,))
+        thread.daemon = True
+        thread.start()
+        taskMgr.add(self._prewarm_shaders, '_prewarm_shaders_tsk',
+                    extraArgs=[record], appendTask=True)
+        return record['total']
+
+    def _get_shader_variants(self, filter_setup, shading_setup, light_types, max_dir_lights, cascades):
+        """
+        Returns a list of (vertex, fragment, define) of all the shaders
+        used with the given filter_setup and shading_setup
+        """
+        setup = shading_setup or {}
+        shaders = [('geometry', shading_setup),
+                   ('forward', shading_setup),
+                   ('point_light', shading_setup),
+                   ('point_light_instanced', shading_setup),
+                   ('shadow', None)]
+        if 'SHADOW_CACHE' in setup:
+            shaders.append(('shadow_copy', None))
+        if 'CLUSTERED_LIGHTS' in setup:
+            shaders.append(('clustered_light', shading_setup))
+        if 'point' in light_types:
+            shaders.append(('point_light_shadow', shading_setup))
+        if 'spot' in light_types:
+            shaders.append(('spot_light', shading_setup))
+            shaders.append(('spot_light_shadow', shading_setup))
+        if 'sun' in light_types:
+            shaders.append(('sun_light', shading_setup))
+            if cascades:
+                define = dict(setup)
+                define['NUM_CASCADES'] = cascades
+                shaders.append(('sun_light', define))
+        # compiling the graph sets filter_alias, filter_fused, etc.
+        # do it on a copy so the current filters are never touched
+        build = copy.copy(self)._compile_filter_graph(filter_setup)
+        for options in build + [filter_setup[-1]]:
+            define = self._get_filter_define(options.get('define'))
+            shaders.append((options['shader'], define))
+            if max_dir_lights is not None and options['shader'] == 'dir_light':
+                define = dict(define)
+                define['MAX_DIR_LIGHTS'] = max_dir_lights
+                shaders.append((options['shader'], define))
+        return [(self.v.format(shader), self.f.format(shader), define) for shader, define in shaders]
+
+    def _prewarm_shaders(self, record, task):
+        """
+        Makes the shaders read by prewarm_shaders() and prepares them on the gsg,
+        a few each frame
+        """
+        gsg = base.win.get_gsg()
+        count = 0
+        while record['ready'] and count < record['per_frame']:
+            v_shader, f_shader, define, sources = record['ready'].popleft()
+            shader = loader.load_shader_GLSL(v_shader, f_shader, define, sources=sources)
+            if gsg is not None:
+                shader.prepare(gsg.get_prepared_objects())
+            record['done'] += 1
+            count += 1
+        if record['progress'] is not None:
+            record['progress'](record['done'], record['total'])
+        if record['done'] >= record['total']:
+            return task.done
+        return task.cont
+
     def _get_win_depth_bits(self):
         fbprops=base.win.get_fb_properties()
         return fbprops.get_depth_bits()
@@ -428,6 +1191,10 @@ class DeferredRenderer(DirectObject):
         # Then, tell it specifically when to clear and what to clear.
         self.modelcam.node().get_display_region(0).disable_clears()
         self.lightcam.node().get_display_region(0).disable_clears()
+        self._add_stage_cam('model_buffer', self.modelcam)
+        self._add_stage_cam('light_buffer', self.lightcam)
+        # the last filter stage and the 2d gui
+        self._add_stage_cam('screen', base.cam2d)
         base.cam.node().get_display_region(0).disable_clears()
         base.cam2d.node().get_display_region(0).disable_clears()
         self.modelbuffer.disable_clears()
@@ -448,15 +1215,22 @@ class DeferredRenderer(DirectObject):
         self.light_root.set_shader(loader.load_shader_GLSL(
             self.v.format('point_light'), self.f.format('point_light'), define))
         self.light_root.hide(BitMask32.bit(self.modelMask))
+        self._setup_instanced_lights(define)
+        # the part of the model buffer in use, the light shaders divide uv by it
+        # to get the screen position (see set_dynamic_resolution())
+        self.model_viewport = PTA_LVecBase2f.empty_array(1)
+        self.model_viewport[0] = LVecBase2f(1.0, 1.0)
         try:
             self.light_root.set_shader_inputs(albedo_tex=self.albedo,
                                           depth_tex=self.depth,
                                           normal_tex=self.normal,
+                                          model_viewport=self.model_viewport,
                                           camera=base.cam,
                                           render=render )
         except AttributeError:
             self.light_root.set_shader_input('albedo_tex', self.albedo)
             self.light_root.set_shader_input('depth_tex',self.depth)
+            self.light_root.set_shader_input('model_viewport', self.model_viewport)
             self.light_root.set_shader_input('normal_tex',self.normal)
             self.light_root.set_shader_input('camera',base.cam)
             self.light_root.set_shader_input('render',render )
@@ -470,6 +1244,7 @@ class DeferredRenderer(DirectObject):
         # self.geometry_root.hide(BitMask32(self.plainMask))
 
         self.plain_root, self.plain_tex, self.plain_cam, self.plain_buff, self.plain_aux = self._make_forward_stage(define)
+        self._add_stage_cam('forward', self.plain_cam)
         self.plain_root.set_shader(loader.load_shader_GLSL(
             self.v.format('forward'), self.f.format('forward'), define))
         self.plain_root.set_shader_input("depth_tex", self.depth)
@@ -484,6 +1259,662 @@ class DeferredRenderer(DirectObject):
         builtins.deferred_render = self.geometry_root
         builtins.forward_render = self.plain_root
 
+    def _setup_light_manager(self, define=None):
+        """
+        Sets the light budget using the MAX_LIGHTS, MAX_SHADOWED_LIGHTS
+        and LIGHT_FADE_TIME keys from the shading_setup
+        """
+        if define is None:
+            define = {}
+        self.light_manager.set_budget(max_lights=int(define.get('MAX_LIGHTS', 0)),
+                                      max_shadowed_lights=int(define.get('MAX_SHADOWED_LIGHTS', 0)),
+                                      fade_time=float(define.get('LIGHT_FADE_TIME', 0.5)))
+
+    def _setup_shadow_atlas(self, size):
+        """
+        Creates the shadow atlas shared by all shadow casting lights
+        and the render state used to draw the shadow casters
+        """
+        self.shadow_atlas = ShadowAtlas(size=size)
+        self.shadow_casters = {}
+        self.dynamic_casters = {}
+        self.shadow_budget_texels = None
+        self.shadow_budget_cameras = None
+        self.sun_lights = []
+        state_np = NodePath('shadow_state')
+        state_np.set_shader(loader.load_shader_GLSL(
+            self.v.format('shadow'), self.f.format('shadow'), None), 100)
+        state_np.set_attrib(ColorWriteAttrib.make(ColorWriteAttrib.C_off), 100)
+        self.shadow_state = state_np.get_state()
+        self.light_root.hide(BitMask32.bit(self.shadowMask))
+        # everything is a static shadow caster, unless marked as dynamic
+        # with add_dynamic_shadow_caster() or set_shadow_caster_type()
+        render.hide(BitMask32.bit(self.dynamicShadowMask))
+        self.all_casters_mask = BitMask32.bit(self.shadowMask) | BitMask32.bit(self.dynamicShadowMask)
+        self.shadow_cache = None
+        self.light_root.set_shader_input('shadow_atlas', self.shadow_atlas.tex)
+        self.light_root.set_shader_input('shadow_fade', 1.0)
+        # the orientation of the 6 lenses of a point light is always the same,
+        # the shader needs it to find the right tile in the atlas
+        lenses = PointLight('lenses')
+        face_forward = PTA_LVecBase3f()
+        face_right = PTA_LVecBase3f()
+        face_up = PTA_LVecBase3f()
+        for i in range(6):
+            forward = Vec3(lenses.get_lens(i).get_view_vector())
+            up = Vec3(lenses.get_lens(i).get_up_vector())
+            face_forward.push_back(forward)
+            face_right.push_back(forward.cross(up))
+            face_up.push_back(up)
+        try:
+            self.light_root.set_shader_inputs(shadow_face_forward=face_forward,
+                                              shadow_face_right=face_right,
+                                              shadow_face_up=face_up)
+        except AttributeError:
+            self.light_root.set_shader_input('shadow_face_forward', face_forward)
+            self.light_root.set_shader_input('shadow_face_right', face_right)
+            self.light_root.set_shader_input('shadow_face_up', face_up)
+
+    def _setup_shadow_cache(self, define=None):
+        """
+        Turns caching of static shadow casters on or off,
+        depending on the 'SHADOW_CACHE' key in the shading_setup.
+        When on, static geometry is rendered into a second atlas (the cache) only
+        when the light or the static geometry changes, the shadow atlas tiles
+        are then made by copying the cached depth and drawing only the dynamic casters
+        """
+        if define is None:
+            define = {}
+        enabled = 'SHADOW_CACHE' in define
+        if enabled == (self.shadow_cache is not None):
+            return
+        for record in self.shadow_casters.values():
+            self._remove_shadow_regions(record)
+        if enabled:
+            self.shadow_cache = ShadowAtlas(size=self.shadow_atlas.size, sort=self.shadow_atlas.sort - 1)
+            # one camera and one quad are enough to copy all the tiles
+            self.shadow_copy_root = NodePath('shadow_copy')
+            cm = CardMaker('shadow_copy')
+            cm.set_frame(-1, 1, -1, 1)
+            quad = self.shadow_copy_root.attach_new_node(cm.generate())
+            quad.node().set_bounds(OmniBoundingVolume())
+            quad.node().set_final(True)
+            quad.set_shader(loader.load_shader_GLSL(
+                self.v.format('shadow_copy'), self.f.format('shadow_copy'), None))
+            quad.set_shader_input('shadow_cache', self.shadow_cache.tex)
+            quad.set_attrib(DepthTestAttrib.make(RenderAttrib.MAlways))
+            quad.set_attrib(DepthWriteAttrib.make(DepthWriteAttrib.MOn))
+            quad.set_attrib(ColorWriteAttrib.make(ColorWriteAttrib.C_off))
+            quad.set_attrib(CullFaceAttrib.make(CullFaceAttrib.MCullNone))
+            self.shadow_copy_cam = self.shadow_copy_root.attach_new_node(Camera('shadow_copy'))
+        else:
+            self.shadow_cache.destroy()
+            self.shadow_cache = None
+            self.shadow_copy_root.remove_node()
+        for p3d_light, record in self.shadow_casters.items():
+            self._make_shadow_regions(p3d_light, record)
+
+    def _make_shadow_regions(self, p3d_light, record):
+        """
+        Makes the display regions that render the shadow maps of a light
+        """
+        record['regions'] = []
+        record['cache_regions'] = []
+        record['active'] = False
+        record['cache_active'] = False
+        record['dirty'] = True
+        record['static_dirty'] = True
+        if self.shadow_cache is None:
+            record['dynamic_camera'] = None
+            p3d_light.node().set_camera_mask(self.all_casters_mask)
+            for lens_index, tile in enumerate(record['tiles']):
+                record['regions'].append(self.shadow_atlas.make_region(tile, p3d_light, lens_index))
+        else:
+            # the light renders the static casters into the cache...
+            p3d_light.node().set_camera_mask(BitMask32.bit(self.shadowMask))
+            # ...and a second camera with the same lenses renders the dynamic ones
+            dynamic_camera = p3d_light.attach_new_node(Camera('dynamic_shadow'))
+            for lens_index in range(len(record['tiles'])):
+                dynamic_camera.node().set_lens(lens_index, p3d_light.node().get_lens(lens_index))
+            dynamic_camera.node().set_camera_mask(BitMask32.bit(self.dynamicShadowMask))
+            dynamic_camera.node().set_initial_state(self.shadow_state)
+            record['dynamic_camera'] = dynamic_camera
+            for lens_index, tile in enumerate(record['tiles']):
+                record['cache_regions'].append(self.shadow_cache.make_region(tile, p3d_light, lens_index))
+                copy_region = self.shadow_atlas.make_region(tile, self.shadow_copy_cam)
+                copy_region.set_clear_depth_active(False)
+                dynamic_region = self.shadow_atlas.make_region(tile, dynamic_camera, lens_index)
+                dynamic_region.set_clear_depth_active(False)
+                dynamic_region.set_sort(1)
+                record['regions'] += [copy_region, dynamic_region]
+        for region in record['regions'] + record['cache_regions']:
+            region.set_active(False)
+
+    def _remove_shadow_regions(self, record):
+        for region in record['regions']:
+            self.shadow_atlas.remove_region(region)
+        for region in record['cache_regions']:
+            self.shadow_cache.remove_region(region)
+        if record['dynamic_camera'] is not None:
+            record['dynamic_camera'].remove_node()
+        record['regions'] = []
+        record['cache_regions'] = []
+        record['dynamic_camera'] = None
+
+    def set_shadow_caster_type(self, node, caster_type='static'):
+        """
+        Marks a node as a 'static' or 'dynamic' shadow caster (or None to not cast shadows).
+        With SHADOW_CACHE on, static casters are only drawn when the light moves or
+        mark_shadow_casters_dirty() is called, dynamic casters are drawn every time
+        the shadow map is updated. Nodes are static by default.
+        """
+        static_bit = BitMask32.bit(self.shadowMask)
+        dynamic_bit = BitMask32.bit(self.dynamicShadowMask)
+        if caster_type == 'static':
+            node.show(static_bit | dynamic_bit)
+        elif caster_type == 'dynamic':
+            node.hide(static_bit)
+            node.show_through(dynamic_bit)
+        elif caster_type is None:
+            node.hide(static_bit | dynamic_bit)
+        else:
+            raise ValueError('Unknown shadow caster type: ' + str(caster_type))
+        self.mark_shadow_casters_dirty(node)
+
+    def add_shadow_caster(self, p3d_light, shadow_size, num_lenses=1):
+        """
+        Makes a light render its shadow map(s) into the shadow atlas,
+        one tile for each lens (6 for point lights, 1 for spot lights)
+        Returns a list of the tiles as Vec4 (uv offset, uv size),
+        or None if there's no free space left in the atlas.
+        Use the SphereLight or ConeLight class, not this function!
+        """
+        tiles = []
+        for i in range(num_lenses):
+            tile = self.shadow_atlas.allocate(shadow_size)
+            if tile is None:
+                for tile in tiles:
+                    self.shadow_atlas.release(tile)
+                print('Shadow atlas is full, light will not cast shadows')
+                return None
+            tiles.append(tile)
+        p3d_light.node().set_initial_state(self.shadow_state)
+        p3d_light.node().set_active(True)
+        record = {'tiles': tiles,
+                  'texels': sum(tile[2] * tile[2] for tile in tiles),
+                  'suspended': False,
+                  'age': 0}
+        # new tiles need to be rendered at least once
+        self._make_shadow_regions(p3d_light, record)
+        self.shadow_casters[p3d_light] = record
+        return [self.shadow_atlas.get_tile_uv(tile) for tile in tiles]
+
+    def set_shadow_budget(self, texels=None, cameras=None):
+        """
+        Limits how many shadow maps are rendered each frame,
+        texels - max number of shadow map texels (tile width*height) per frame
+        cameras - max number of shadow lenses (6 for a point light) per frame
+        None means no limit. Lights that don't move keep their old shadow map,
+        lights that need an update, but don't fit in the budget wait for the
+        next frame (lights close to the camera go first)
+        """
+        self.shadow_budget_texels = texels
+        self.shadow_budget_cameras = cameras
+
+    def mark_shadow_dirty(self, p3d_light):
+        """
+        Tells the renderer that the shadow map of a light needs to be rendered again
+        """
+        if p3d_light in self.shadow_casters:
+            self.shadow_casters[p3d_light]['dirty'] = True
+            self.shadow_casters[p3d_light]['static_dirty'] = True
+
+    def suspend_shadow(self, p3d_light, suspend=True):
+        """
+        Stops (or resumes) updating the shadow map of a light,
+        used by the LightManager for lights that have their shadows faded out
+        """
+        if p3d_light in self.shadow_casters:
+            record = self.shadow_casters[p3d_light]
+            if record['suspended'] and not suspend:
+                record['dirty'] = True
+                record['static_dirty'] = True
+            record['suspended'] = suspend
+
+    def mark_all_shadows_dirty(self):
+        """
+        Re-renders all shadow maps (eg. after loading a new level)
+        """
+        for record in self.shadow_casters.values():
+            record['dirty'] = True
+            record['static_dirty'] = True
+
+    def mark_shadow_casters_dirty(self, node):
+        """
+        Marks the shadow maps of all lights that could be affected by
+        the given node as dirty, call this after changing a shadow casting model
+        (or use add_dynamic_shadow_caster() for models that move a lot)
+        """
+        sphere = self._get_bounding_sphere(node)
+        if sphere is not None:
+            self._mark_shadows_in_sphere(*sphere, static=True)
+
+    def add_dynamic_shadow_caster(self, node):
+        """
+        The transform of the node will be checked every frame,
+        if it moves, all the lights that could see it get their shadows updated.
+        The node is also marked as a dynamic caster (see set_shadow_caster_type())
+        """
+        self.set_shadow_caster_type(node, 'dynamic')
+        self.dynamic_casters[node] = (node.get_net_transform(), self._get_bounding_sphere(node))
+
+    def remove_dynamic_shadow_caster(self, node):
+        """
+        Stops tracking a node added with add_dynamic_shadow_caster()
+        """
+        if node in self.dynamic_casters:
+            old_sphere = self.dynamic_casters.pop(node)[1]
+            if old_sphere is not None:
+                self._mark_shadows_in_sphere(*old_sphere)
+            if not node.is_empty():
+                self.set_shadow_caster_type(node, 'static')
+
+    def _get_bounding_sphere(self, node):
+        """
+        Returns the center and radius of a sphere (in render space) around the node,
+        or None if the node has no (finite) bounds
+        """
+        if node.is_empty():
+            return None
+        bounds = node.get_bounds()
+        if bounds.is_empty() or bounds.is_infinite():
+            return None
+        bounds = bounds.make_copy()
+        bounds.xform(node.get_mat(render))
+        if isinstance(bounds, BoundingSphere):
+            return Point3(bounds.get_center()), bounds.get_radius()
+        center = (bounds.get_min() + bounds.get_max()) * 0.5
+        return Point3(center), (bounds.get_max() - center).length()
+
+    def _mark_shadows_in_sphere(self, center, radius, static=False):
+        for p3d_light, record in self.shadow_casters.items():
+            light_radius = p3d_light.node().get_lens(0).get_far()
+            if (p3d_light.get_pos(render) - center).length() <= light_radius + radius:
+                record['dirty'] = True
+                if static:
+                    record['static_dirty'] = True
+
+    def _update_shadows(self):
+        """
+        Picks the shadow maps that get rendered this frame
+        """
+        for node, (transform, sphere) in list(self.dynamic_casters.items()):
+            if node.is_empty():
+                del self.dynamic_casters[node]
+                continue
+            new_transform = node.get_net_transform()
+            if new_transform != transform:
+                new_sphere = self._get_bounding_sphere(node)
+                # lights that could see the old and new position need updating
+                for old_or_new in (sphere, new_sphere):
+                    if old_or_new is not None:
+                        self._mark_shadows_in_sphere(*old_or_new)
+                self.dynamic_casters[node] = (new_transform, new_sphere)
+
+        dirty = []
+        cam_pos = base.cam.get_pos(render)
+        for p3d_light, record in self.shadow_casters.items():
+            if record['dirty'] and not record['suspended']:
+                light_radius = p3d_light.node().get_lens(0).get_far()
+                distance = (p3d_light.get_pos(render) - cam_pos).length()
+                importance = light_radius / max(distance - light_radius, 1.0)
+                dirty.append((importance * (1 + record['age']), record))
+        dirty.sort(key=lambda item: item[0], reverse=True)
+
+        texels = 0
+        cameras = 0
+        to_render = set()
+        for priority, record in dirty:
+            texels += record['texels']
+            cameras += len(record['tiles'])
+            if to_render:  # always render at least one light
+                if self.shadow_budget_texels is not None and texels > self.shadow_budget_texels:
+                    break
+                if self.shadow_budget_cameras is not None and cameras > self.shadow_budget_cameras:
+                    break
+            to_render.add(id(record))
+
+        for record in self.shadow_casters.values():
+            render_now = id(record) in to_render
+            # with the shadow cache, static casters are drawn only if they changed
+            render_static = render_now and record['static_dirty']
+            if render_now:
+                record['dirty'] = False
+                record['static_dirty'] = False
+                record['age'] = 0
+            elif record['dirty'] and not record['suspended']:
+                record['age'] += 1
+            if render_now != record['active']:
+                record['active'] = render_now
+                for region in record['regions']:
+                    region.set_active(render_now)
+            if render_static != record['cache_active']:
+                record['cache_active'] = render_static
+                for region in record['cache_regions']:
+                    region.set_active(render_static)
+
+    def remove_shadow_caster(self, p3d_light):
+        """
+        Frees the space in the shadow atlas used by a light
+        """
+        record = self.shadow_casters.pop(p3d_light, None)
+        if record is None:
+            return
+        self._remove_shadow_regions(record)
+        for tile in record['tiles']:
+            self.shadow_atlas.release(tile)
+
+    def _set_filter_shader(self, quad, stage_name, shader, define=None, translate_tex_name=None):
+        """
+        Sets the shader of a filter stage, with dynamic resolution on
+        the shader samples the textures of stages that can change size using
+        the '<sampler>_viewport' scale (see _get_viewport_shader())
+        """
+        scaled = {}
+        own = False
+        if self.dynamic_resolution is not None:
+            translate = dict((str(new_name), old_name) for old_name, new_name in (translate_tex_name or {}).items())
+            for sampler in self._get_shader_info(shader)[0]:
+                writer = translate.get(sampler, sampler)
+                if writer in self.viewport_scale:
+                    scaled[sampler] = writer
+            own = stage_name in self.viewport_scale and stage_name in self.filter_cam
+            if scaled or own:
+                shader = self._get_viewport_shader(shader, sorted(scaled), own)
+        quad.set_shader(loader.load_shader_GLSL(self.v.format(shader), self.f.format(shader),
+                                                self._get_filter_define(define)))
+        for sampler, writer in scaled.items():
+            quad.set_shader_input(sampler + '_viewport', self.viewport_scale[writer])
+        if own:
+            quad.set_shader_input('viewport_scale', self.viewport_scale[stage_name])
+
+    def _get_filter_define(self, define):
+        """
+        Returns the defines of a filter stage with MAX_DIR_LIGHTS set to the size
+        of the directional light arrays (shaders that don't use it ignore it,
+        see getShaderKey())
+        """
+        define = dict(define or {})
+        define['MAX_DIR_LIGHTS'] = self.max_dir_lights
+        return define
+
+    def _get_viewport_shader(self, shader, samplers, own):
+        """
+        Returns the name of a version of the shader where the given samplers are
+        read with uv scaled by '<sampler>_viewport' and, if own is True,
+        gl_FragCoord is scaled by 'viewport_scale' (the part of its own buffer
+        the stage renders to), so the shader still works with uv in 0-1 range
+        """
+        key = (shader, tuple(samplers), own)
+        if key not in self._viewport_shaders:
+            txt = loader.read_shader_source(self.f.format(shader))
+            txt = self._scale_texture_calls(txt, samplers)
+            header = ''
+            for sampler in samplers:
+                header += 'uniform vec2 {0}_viewport;\n'.format(sampler)
+            if samplers:
+                header += ('vec2 viewport_uv(sampler2D tex, vec2 uv, vec2 viewport)\n'
+                           '    {\n'
+                           '    return min(uv*viewport, viewport-0.5/vec2(textureSize(tex, 0)));\n'
+                           '    }\n')
+            if own:
+                header += 'uniform vec2 viewport_scale;\n'
+                txt = re.sub(r'\bgl_FragCoord\b', '(gl_FragCoord/vec4(viewport_scale, 1.0, 1.0))', txt)
+            # after the #version line, the defines also go there
+            txt = re.sub(r'^(#version.*)$', lambda match: match.group(1) + '\n' + header, txt, count=1, flags=re.M)
+            name = 'viewport_{0}'.format(hashlib.md5((shader + txt).encode('utf-8')).hexdigest()[:12])
+            loader.add_shader_source(self.v.format(name), loader.read_shader_source(self.v.format(shader)))
+            loader.add_shader_source(self.f.format(name), txt)
+            self._viewport_shaders[key] = name
+        return self._viewport_shaders[key]
+
+    def _scale_texture_calls(self, txt, samplers):
+        """
+        Changes texture(sampler, uv, ...) to texture(sampler, viewport_uv(sampler, uv, sampler_viewport), ...)
+        for the given samplers (also textureLod, textureOffset, etc.)
+        """
+        call = re.compile(r'\b(texture|textureLod|textureOffset|textureLodOffset|textureGrad)\s*\(\s*(\w+)\s*,')
+        out = []
+        pos = 0
+        while True:
+            match = call.search(txt, pos)
+            if match is None:
+                break
+            start = match.end()
+            out.append(txt[pos:start])
+            pos = start
+            if match.group(2) not in samplers:
+                continue
+            # find the end of the uv argument
+            depth = 0
+            end = start
+            while end < len(txt):
+                char = txt[end]
+                if char in '([':
+                    depth += 1
+                elif char in ')]':
+                    if depth == 0:
+                        break
+                    depth -= 1
+                elif char == ',' and depth == 0:
+                    break
+                end += 1
+            uv = self._scale_texture_calls(txt[start:end], samplers).strip()
+            out.append(' viewport_uv({0}, {1}, {0}_viewport)'.format(match.group(2), uv))
+            pos = end
+        out.append(txt[pos:])
+        return ''.join(out)
+
+    def set_dynamic_resolution(self, frame_time=None, model_min_size=1.0, step=0.05, interval=0.5):
+        """
+        Turns on a governor that changes the size of the filter stages that have
+        'min_size' in the filter setup (and of the model buffer if model_min_size
+        is less than 1.0) to keep the frame time close to frame_time (in seconds).
+        Call with frame_time=None to turn it off.
+        The buffers are not resized, the stages render to a part of their buffer
+        (the display region is scaled) and the stages that read their textures get
+        the scale as '<sampler>_viewport' so their output is the same,
+        the lights get the scale of the model buffer as 'model_viewport'.
+        """
+        for name in list(self.viewport_scale):
+            self._set_viewport_size(name, 1.0)
+        self.viewport_scale = {}
+        if frame_time is None:
+            self.dynamic_resolution = None
+        else:
+            self.dynamic_resolution = {'frame_time': frame_time,
+                                       'model_min_size': model_min_size,
+                                       'step': step,
+                                       'interval': interval,
+                                       'countdown': interval,
+                                       'average': frame_time,
+                                       'sizes': {}}
+            if model_min_size < 1.0:
+                # the light buffer and forward stage must match the model buffer,
+                # the light shaders read the scale as 'model_viewport'
+                scale = self.model_viewport
+                for name in ('depth_tex', 'albedo_tex', 'normal_tex', 'lit_tex', 'forward_tex', 'forward_aux_tex'):
+                    self.viewport_scale[name] = scale
+                self.dynamic_resolution['sizes']['model'] = 1.0
+        # all the shaders that read scaled textures need to change
+        self.filter_build = {}
+        self.reset_filters(self.filter_stages, self.shading_setup)
+
+    def _setup_dynamic_stages(self, build, keep):
+        """
+        Makes the viewport scales for the filter stages with a 'min_size',
+        stages that are kept (see reset_filters()) keep their scale
+        """
+        sizes = self.dynamic_resolution['sizes']
+        dynamic = {}
+        for options in build:
+            if 'min_size' in options:
+                dynamic[options.get('name', options['shader'])] = options
+        for name in list(sizes):
+            if name != 'model' and name not in dynamic:
+                del sizes[name]
+                del self.viewport_scale[name]
+        for name, options in dynamic.items():
+            if name not in self.viewport_scale:
+                self.viewport_scale[name] = PTA_LVecBase2f.empty_array(1)
+            if name not in keep:
+                self.viewport_scale[name][0] = LVecBase2f(1.0, 1.0)
+                sizes[name] = options.get('size', 1.0)
+
+    def _set_viewport_size(self, name, scale):
+        """
+        Sets the part of the buffer (0.0-1.0) used by a filter stage
+        or by the model buffer (name 'model' or any of the model textures)
+        """
+        if name in self.filter_cam:
+            cams = [self.filter_cam[name]]
+        elif name in ('model', 'depth_tex'):
+            name = 'depth_tex'
+            cams = [self.modelcam, self.lightcam, self.plain_cam]
+        else:
+            return
+        for cam in cams:
+            cam.node().get_display_region(0).set_dimensions(0, scale, 0, scale)
+        self.viewport_scale[name][0] = LVecBase2f(scale, scale)
+
+    def _update_dynamic_resolution(self, dt):
+        """
+        Makes the dynamic stages smaller if the frames take too long,
+        and bigger if there's time to spare
+        """
+        setup = self.dynamic_resolution
+        setup['average'] += (dt - setup['average']) * 0.1
+        setup['countdown'] -= dt
+        if setup['countdown'] > 0.0:
+            return
+        setup['countdown'] = setup['interval']
+        if setup['average'] > setup['frame_time'] * 1.05:
+            change = -setup['step']
+        elif setup['average'] < setup['frame_time'] * 0.85:
+            change = setup['step']
+        else:
+            return
+        for name, size in setup['sizes'].items():
+            if name == 'model':
+                min_size = setup['model_min_size']
+                max_size = 1.0
+            else:
+                min_size = self.filter_build[name]['min_size']
+                max_size = self.filter_build[name].get('size', 1.0)
+            new_size = min(max(size + change * max_size, min_size), max_size)
+            if new_size != size:
+                setup['sizes'][name] = new_size
+                self._set_viewport_size(name, new_size / max_size)
+
+    def _add_stage_cam(self, name, cam):
+        """
+        Remembers the camera of a stage, so it can be timed
+        if (or when) frame timings are enabled
+        """
+        self.stage_cams[name] = cam
+        if self.frame_timings_enabled:
+            self._add_stage_timer(name, cam)
+
+    def enable_frame_timings(self, enable=True):
+        """
+        Starts (or stops) timing the stages. The timing is done with python
+        draw callbacks on the display regions of the stages, that costs
+        some time every frame, so it's off by default
+        (or set 'deferred-frame-timings 1' in the config).
+        The times are CPU times (draw call submission, see _add_stage_timer()),
+        and 'screen' also includes the 2d gui.
+        """
+        self.frame_timings_enabled = enable
+        for name, cam in self.stage_cams.items():
+            if enable:
+                if name not in self.frame_timings:
+                    self._add_stage_timer(name, cam)
+            else:
+                cam.node().get_display_region(0).clear_draw_callback()
+        if not enable:
+            self.frame_timings = {}
+            self.show_frame_timings(False)
+
+    def _add_stage_timer(self, name, cam):
+        """
+        Times the drawing of the display region of the cam, the time is
+        recorded in a PStats collector named 'Deferred:<name>'
+        and kept for get_frame_timings().
+        Panda only starts timing the GPU with 'pstats-gpu-timing 1' in the config
+        (the buffers are named after the stages, look for them under 'Draw'),
+        the times measured here are the time it takes to submit the draw calls
+        unless 'gl-finish 1' is also set, then it waits for the GPU to finish.
+        """
+        record = {'collector': PStatCollector('Deferred:' + name),
+                  'times': deque(maxlen=self.frame_timing_frames)}
+        self.frame_timings[name] = record
+        clock = ClockObject.get_global_clock()
+
+        def _draw(cbdata):
+            start = clock.get_real_time()
+            record['collector'].start()
+            cbdata.upcall()
+            record['collector'].stop()
+            record['times'].append(clock.get_real_time() - start)
+
+        cam.node().get_display_region(0).set_draw_callback(PythonCallbackObject(_draw))
+
+    def get_frame_timings(self):
+        """
+        Returns a dict of stage name: average time (in milliseconds)
+        it took to draw the stage over the last frame_timing_frames frames
+        """
+        timings = {}
+        for name, record in self.frame_timings.items():
+            if record['times']:
+                timings[name] = 1000.0 * sum(record['times']) / len(record['times'])
+        return timings
+
+    def show_frame_timings(self, show=True):
+        """
+        Shows (or hides) the frame timings of all stages in the top left corner
+        of the window, showing them also enables the timings
+        """
+        if not show:
+            if self.frame_timing_text is not None:
+                self.frame_timing_text.remove_node()
+                self.frame_timing_text = None
+            return
+        if not self.frame_timings_enabled:
+            self.enable_frame_timings()
+        if self.frame_timing_text is None:
+            text = TextNode('frame_timings')
+            text.set_text_color(1, 1, 1, 1)
+            text.set_shadow(0.05, 0.05)
+            self.frame_timing_text = base.a2dTopLeft.attach_new_node(text)
+            self.frame_timing_text.set_scale(0.04)
+            self.frame_timing_text.set_pos(0.02, 0, -0.05)
+            self.frame_timing_text.set_bin('fixed', 100)
+            self._last_timing_update = 0.0
+
+    def _update_frame_timing_text(self):
+        """
+        Writes the timings to the overlay text, 2 times a second
+        """
+        time = globalClock.get_real_time()
+        if time - self._last_timing_update < 0.5:
+            return
+        self._last_timing_update = time
+        timings = self.get_frame_timings()
+        lines = ['{0}: {1:.2f}ms'.format(name, timings[name]) for name in sorted(timings)]
+        lines.append('total: {0:.2f}ms'.format(sum(timings.values())))
+        self.frame_timing_text.node().set_text('\n'.join(lines))
+
     def _on_window_event(self, window):
         """
         Function called when something hapens to the main window
@@ -519,27 +1950,39 @@ class DeferredRenderer(DirectObject):
     def add_filter(self, shader, inputs={},
                    name=None, size=1.0,
                    clear_color=(0, 0, 0, 0), translate_tex_name=None,
-                   define=None):
+                   define=None, target=None, sort=None, min_size=None, format='rgba8'):
         """
         Creates and adds filter stage to the filter stage dicts:
         the created buffer is put in self.filter_buff[name]
         the created fullscreen quad is put in self.filter_quad[name]
         the created fullscreen texture is put in self.filter_tex[name]
         the created camera is put in self.filter_cam[name]
+        Stages with the same target render into the same texture
+        (see _compile_filter_graph())
+        min_size is the smallest size used by the dynamic resolution governor
+        (see set_dynamic_resolution())
+        format is the format of the texture: r8, rg8, rgba8, r16f, rgba16f or r11g11b10f
         """
         #print(inputs)
         if name is None:
             name = shader
-        index = len(self.filter_buff)
+        index = sort
+        if index is None:
+            index = len(self.filter_buff)
+        tex = None
+        if target is not None:
+            tex = self.filter_targets.get(target)
         quad, tex, buff, cam = self._make_filter_stage(
-            sort=index, size=size, clear_color=clear_color, name=name)
+            sort=index, size=size, clear_color=clear_color, name=name, tex=tex, format=format)
+        if target is not None:
+            self.filter_targets[target] = tex
         self.filter_buff[name] = buff
         self.filter_quad[name] = quad
         self.filter_tex[name] = tex
         self.filter_cam[name] = cam
+        self._add_stage_cam(name, cam)
 
-        quad.set_shader(loader.load_shader_GLSL(self.v.format(
-            shader), self.f.format(shader), define))
+        self._set_filter_shader(quad, name, shader, define, translate_tex_name)
         for name, value in inputs.items():
             if isinstance(value, str):
                 value = loader.load_texture(value, sRgb=loader.use_srgb)
@@ -556,16 +1999,49 @@ class DeferredRenderer(DirectObject):
                 value = self.filter_tex[old_name]
                 quad.set_shader_input(str(new_name), value)
 
-    def _make_filter_stage(self, sort=0, size=1.0, clear_color=None, name=None):
+    def _setup_filter_triangle(self):
+        """
+        Creates the full screen triangle and the lens shared by all filter stages,
+        the triangle covers the whole -1 to 1 range of the lens (and more)
+        with uv going from 0 to 1 on the screen
+        """
+        vdata = GeomVertexData('triangle', GeomVertexFormat.get_v3t2(), Geom.UH_static)
+        vdata.set_num_rows(3)
+        vertex = GeomVertexWriter(vdata, 'vertex')
+        texcoord = GeomVertexWriter(vdata, 'texcoord')
+        for x, z in ((-1, -1), (3, -1), (-1, 3)):
+            vertex.add_data3(x, 1, z)
+            texcoord.add_data2((x + 1) * 0.5, (z + 1) * 0.5)
+        triangle = GeomTriangles(Geom.UH_static)
+        triangle.add_vertices(0, 1, 2)
+        geom = Geom(vdata)
+        geom.add_primitive(triangle)
+        node = GeomNode('full_screen_triangle')
+        node.add_geom(geom)
+        self.filter_triangle = NodePath(node)
+        self.filter_triangle.set_two_sided(True)
+        self.filter_triangle.set_depth_test(False)
+        self.filter_triangle.set_depth_write(False)
+        self.filter_lens = OrthographicLens()
+        self.filter_lens.set_film_size(2, 2)
+        self.filter_lens.set_near_far(0.0, 2.0)
+
+    def _make_filter_stage(self, sort=0, size=1.0, clear_color=None, name=None, tex=None, format='rgba8'):
         """
-        Creates a buffer, quad, camera and texture needed for a filter stage
+        Creates a buffer, root node, camera and texture needed for a filter stage,
+        if a texture is given, the buffer renders into that texture,
+        format is one of the keys in filter_formats
         Use add_filter() not this function
         """
+        if format not in self.filter_formats:
+            raise ValueError('Unknown filter stage format: ' + str(format))
         # make a root for the buffer
         root = NodePath("filterBufferRoot")
-        tex = Texture()
-        tex.set_wrap_u(Texture.WM_clamp)
-        tex.set_wrap_v(Texture.WM_clamp)
+        root.set_light_off()
+        if tex is None:
+            tex = Texture()
+            tex.set_wrap_u(Texture.WM_clamp)
+            tex.set_wrap_v(Texture.WM_clamp)
         buff_size_x = int(base.win.get_x_size() * size)
         buff_size_y = int(base.win.get_y_size() * size)
         # buff=base.win.makeTextureBuffer("buff", buff_size_x, buff_size_y, tex)
@@ -573,7 +2049,9 @@ class DeferredRenderer(DirectObject):
         winprops.set_size(buff_size_x, buff_size_y)
         props = FrameBufferProperties()
         props.set_rgb_color(True)
-        props.set_rgba_bits(8, 8, 8, 8)
+        bits, float_color = self.filter_formats[format]
+        props.set_rgba_bits(*bits)
+        props.set_float_color(float_color)
         props.set_depth_bits(0)
         buff = base.graphicsEngine.make_output(
             base.pipe, 'filter_stage_'+name, sort,
@@ -591,33 +2069,13 @@ class DeferredRenderer(DirectObject):
             buff.set_clear_color(clear_color)
             buff.set_clear_active(GraphicsOutput.RTPColor, True)
 
-        cam = base.make_camera(win=buff)
-        cam.reparent_to(root)
-        cam.set_pos(buff_size_x * 0.5, buff_size_y * 0.5, 100)
-        cam.set_p(-90)
-        lens = OrthographicLens()
-        lens.set_film_size(buff_size_x, buff_size_y)
-        cam.node().set_lens(lens)
-        # plane with the texture, a blank texture for now
-        cm = CardMaker("plane")
-        cm.set_frame(0, buff_size_x, 0, buff_size_y)
-        quad = root.attach_new_node(cm.generate())
-        quad.look_at(0, 0, -1)
-        quad.set_light_off()
-        '''Vertices=GeomVertexData('Triangle', GeomVertexFormat.getV3(), Geom.UHStatic)
-        Vertex=GeomVertexWriter(Vertices, 'vertex')
-        Vertex.addData3d(0.0,0.0,0.0)
-        Vertex.addData3d(0.0,0.0,0.0)
-        Vertex.addData3d(0.0,0.0,0.0)
-        Triangle = GeomTriangles(Geom.UHStatic)
-        Triangle.addVertices(0,1,2)
-        Triangle.closePrimitive()
-        Primitive=Geom(Vertices)
-        Primitive.addPrimitive(Triangle)
-        gNode=GeomNode('FullScreenTriangle')
-        gNode.addGeom(Primitive)
-        quad = NodePath(gNode)
-        quad.reparent_to(root)'''
+        # all stages draw the same triangle with the same lens,
+        # the root of the stage holds the shader and inputs
+        cam = root.attach_new_node(Camera('filter_cam_'+name, self.filter_lens))
+        cam.node().set_scene(root)
+        buff.make_display_region().set_camera(cam)
+        self.filter_triangle.instance_to(root)
+        quad = root
 
         return quad, tex, buff, cam
 
@@ -668,83 +2126,255 @@ class DeferredRenderer(DirectObject):
         cam.node().set_camera_mask(mask)
         return root, tex, cam, buff, aux_tex
 
-    def set_directional_light(self, color, direction, shadow_size=0):
+    def _setup_directional_lights(self, capacity=8):
+        """
+        Creates the arrays for the directional lights,
+        the dir_light shader is compiled once for MAX_DIR_LIGHTS (capacity) lights
+        and only the first num_dir_lights are used, the arrays are shared by all
+        filter stages (common_inputs) and are changed in place, so
+        adding, removing or changing lights never needs a shader recompile.
+        The filter stages get MAX_DIR_LIGHTS from here, see _get_filter_define()
+        """
+        self.max_dir_lights = capacity
+        self.dir_light_color = PTA_LVecBase3f.empty_array(capacity)
+        self.dir_light_direction = PTA_LVecBase3f.empty_array(capacity)
+        self.num_dir_lights = PTA_int.empty_array(1)
+
+    def set_max_dir_lights(self, capacity):
+        """
+        Changes how many directional lights can be used at the same time,
+        the arrays are made again (the lights in them are kept) and
+        the filter stages get shaders made for the new size
+        """
+        colors = [Vec3(self.dir_light_color[i]) for i in range(min(capacity, self.max_dir_lights))]
+        directions = [Vec3(self.dir_light_direction[i]) for i in range(len(colors))]
+        count = min(self.num_dir_lights[0], capacity)
+        self._setup_directional_lights(capacity)
+        for i, (color, direction) in enumerate(zip(colors, directions)):
+            self.dir_light_color[i] = color
+            self.dir_light_direction[i] = direction
+        self.num_dir_lights[0] = count
+        self.common_inputs['dir_light_color'] = self.dir_light_color
+        self.common_inputs['dir_light_direction'] = self.dir_light_direction
+        self.common_inputs['num_dir_lights'] = self.num_dir_lights
+        for quad in self.filter_quad.values():
+            quad.set_shader_input('dir_light_color', self.dir_light_color)
+            quad.set_shader_input('dir_light_direction', self.dir_light_direction)
+            quad.set_shader_input('num_dir_lights', self.num_dir_lights)
+        for stage in self.filter_stages:
+            name = self._get_stage_name(stage)
+            if name in self.filter_quad:
+                self.reload_filter(name)
+
+    def set_directional_light(self, color, direction, shadow_size=0, index=0):
         """
         Sets value for a directional light,
         use the SceneLight class to set the lights!
         """
+        if index >= self.max_dir_lights:
+            raise IndexError('Only {0} directional lights supported'.format(self.max_dir_lights))
+        self.dir_light_color[index] = Vec3(*color)
+        self.dir_light_direction[index] = Vec3(*direction)
 
-        try:
-            self.filter_quad['final_light'].set_shader_inputs(light_color=color, direction=direction)
-        except AttributeError:
-            self.filter_quad['final_light'].set_shader_input('light_color',color)
-            self.filter_quad['final_light'].set_shader_input('direction', direction)
-
+    def set_directional_light_count(self, count):
+        """
+        Sets how many directional lights (from the start of the arrays) are used,
+        use the SceneLight class to set the lights!
+        """
+        self.num_dir_lights[0] = min(count, self.max_dir_lights)
 
 
-    def add_sun_light(self, color, offset=100.0, direction=(0,0,1), radius=1.0):
+    def add_sun_light(self, color, direction=(0, 0, 1), shadow_size=1024, cascades=4,
+                      split_lambda=0.75, shadow_distance=None, offset=100.0,
+                      far_update_interval=4, bias=0.0005):
         """
-        Creates a spotlight,
-        use the ConeLight class, not this function!
-        ..in fact don't use this at all, experimental/broken
+        Creates a sun (directional light with cascaded shadow maps),
+        use the SunLight class, not this function!
+        The view frustum of base.cam is split into 'cascades' parts,
+        split_lambda 0.0 gives even splits, 1.0 gives logarithmic splits.
+        shadow_distance - how far from the camera are the shadows drawn (default: camera far)
+        offset - how far behind a cascade can shadow casters be
+        The first two cascades are rendered every frame, the rest every far_update_interval frames
+        Returns a record (dict) of the light
         """
-        #if fov > 179.0:
-        #    fov = 179.0
-        #xy_scale = math.tan(deg2Rad(fov * 0.5))
-        model = loader.load_model("models/sphere")
-        # temp=model.copyTo(self.plain_root)
-        # self.lights.append(model)
-        model.reparent_to(self.light_root)
-        #model.set_scale(xy_scale, 1.0, xy_scale)
-        #model.flatten_strong()
-        model.set_scale(radius*2.0)
-        #model.set_pos(pos)
-        #model.setHpr(hpr)
-        # debug=self.lights[-1].copyTo(self.plain_root)
-        model.set_attrib(DepthTestAttrib.make(RenderAttrib.MLess))
-        model.set_attrib(CullFaceAttrib.make(
-            CullFaceAttrib.MCullCounterClockwise))
+        cm = CardMaker('sun_light')
+        cm.set_frame(-1, 1, -1, 1)
+        model = self.light_root.attach_new_node(cm.generate())
+        model.set_attrib(DepthTestAttrib.make(RenderAttrib.MNone))
+        model.set_attrib(CullFaceAttrib.make(CullFaceAttrib.MCullNone))
         model.set_attrib(ColorBlendAttrib.make(
             ColorBlendAttrib.MAdd, ColorBlendAttrib.OOne, ColorBlendAttrib.OOne))
         model.set_attrib(DepthWriteAttrib.make(DepthWriteAttrib.MOff))
-
-        model.set_shader(loader.load_shader_GLSL(self.v.format(
-            'sun_light'), self.f.format('sun_light'), self.shading_setup))
-        p3d_light = deferred_render.attach_new_node(Spotlight("Spotlight"))
-        #p3d_light.set_pos(render, pos)
-        #p3d_light.set_hpr(render, hpr)
-        p3d_light.look_at(-Vec3(*direction))
-        p3d_light.set_y(p3d_light, -offset)
-        #p3d_light.set_x(render, -offset)
-        #p3d_light.node().set_exponent(20)
-        if self.shadow_size > 0.0:
-            p3d_light.node().set_shadow_caster(True, self.shadow_size, self.shadow_size)
-            model.set_shader(loader.load_shader_GLSL(self.v.format(
-            'sun_light'), self.f.format('sun_light_shadow'), self.shading_setup))
-        #p3d_light.node().set_camera_mask(self.modelMask)
+        model.node().set_bounds(OmniBoundingVolume())
+        model.node().set_final(True)
+        sun = {'model': model,
+               'direction': Vec3(*direction).normalized(),
+               'cascades': [],
+               'split_lambda': split_lambda,
+               'shadow_distance': shadow_distance,
+               'offset': offset,
+               'frame': 0,
+               'dirty': True}
+        if shadow_size > 0 and cascades > 0:
+            tiles = []
+            for i in range(cascades):
+                tile = self.shadow_atlas.allocate(shadow_size)
+                if tile is None:
+                    print('Shadow atlas is full, sun will not cast shadows')
+                    for tile in tiles:
+                        self.shadow_atlas.release(tile)
+                    tiles = []
+                    break
+                tiles.append(tile)
+            sun['matrices'] = PTA_LMatrix4f.empty_array(len(tiles))
+            sun['far'] = PTA_float.empty_array(len(tiles))
+            tile_uvs = PTA_LVecBase4f()
+            for i, tile in enumerate(tiles):
+                lens = OrthographicLens()
+                camera = render.attach_new_node(Camera('sun_cascade_{0}'.format(i), lens))
+                camera.node().set_camera_mask(self.all_casters_mask)
+                camera.node().set_initial_state(self.shadow_state)
+                region = self.shadow_atlas.make_region(tile, camera)
+                region.set_active(False)
+                if i < 2:
+                    interval = 1
+                else:
+                    interval = max(1, far_update_interval)
+                sun['cascades'].append({'tile': tile,
+                                        'camera': camera,
+                                        'lens': lens,
+                                        'region': region,
+                                        'interval': interval})
+                tile_uvs.push_back(self.shadow_atlas.get_tile_uv(tile))
+            if tiles:
+                sun['num_cascades'] = len(tiles)
+                try:
+                    model.set_shader_inputs(sun_shadow_mat=sun['matrices'],
+                                            sun_shadow_tile=tile_uvs,
+                                            sun_cascade_far=sun['far'],
+                                            bias=bias)
+                except AttributeError:
+                    model.set_shader_input('sun_shadow_mat', sun['matrices'])
+                    model.set_shader_input('sun_shadow_tile', tile_uvs)
+                    model.set_shader_input('sun_cascade_far', sun['far'])
+                    model.set_shader_input('bias', bias)
+        self._set_sun_shader(sun, self.shading_setup)
         try:
-            model.set_shader_inputs(spot=p3d_light,bias= 0.0003, direction=Vec3(*direction))
+            model.set_shader_inputs(sun_color=Vec3(*color), sun_direction=sun['direction'])
         except AttributeError:
-            model.set_shader_input('spot', p3d_light)
-            model.set_shader_input('bias', 0.0003)
-            model.set_shader_input('direction',Vec3(*direction))
-        lens=OrthographicLens()
-        lens.set_near_far(200.0, 1000.0)
-        lens.set_film_size(1000, 1000)
-        p3d_light.node().set_lens(lens)
-        p3d_light.node().set_color(Vec4(color[0], color[1], color[2], 0.0))
-        #p3d_light.node().showFrustum()
-        return model, p3d_light
+            model.set_shader_input('sun_color', Vec3(*color))
+            model.set_shader_input('sun_direction', sun['direction'])
+        self.sun_lights.append(sun)
+        return sun
+
+    def _set_sun_shader(self, sun, shading_setup):
+        define = dict(shading_setup or {})
+        if sun.get('num_cascades'):
+            define['NUM_CASCADES'] = sun['num_cascades']
+        sun['model'].set_shader(loader.load_shader_GLSL(self.v.format(
+            'sun_light'), self.f.format('sun_light'), define))
+
+    def set_sun_direction(self, sun, direction):
+        """
+        Changes the direction of a sun, all the cascades get rendered again
+        """
+        sun['direction'] = Vec3(*direction).normalized()
+        sun['model'].set_shader_input('sun_direction', sun['direction'])
+        sun['dirty'] = True
 
-    def add_cone_light(self, color, pos=(0, 0, 0), hpr=(0, 0, 0),exponent=40,
-                        radius=1.0, fov=45.0, shadow_size=0.0, bias=0.0005):
+    def remove_sun_light(self, sun):
         """
-        Creates a spotlight,
-        use the ConeLight class, not this function!
+        Removes a sun and frees its shadow maps
         """
-        if fov > 179.0:
-            fov = 179.0
-        xy_scale = math.tan(deg2Rad(fov * 0.5))
+        for cascade in sun['cascades']:
+            self.shadow_atlas.remove_region(cascade['region'])
+            self.shadow_atlas.release(cascade['tile'])
+            cascade['camera'].remove_node()
+        sun['model'].remove_node()
+        if sun in self.sun_lights:
+            self.sun_lights.remove(sun)
+
+    def _get_cascade_splits(self, sun):
+        """
+        Returns the distances where the cascades start and end
+        (mix of even and logarithmic splits)
+        """
+        lens = base.cam.node().get_lens()
+        near = lens.get_near()
+        far = sun['shadow_distance']
+        if far is None:
+            far = lens.get_far()
+        num_cascades = len(sun['cascades'])
+        splits = []
+        for i in range(num_cascades + 1):
+            f = float(i) / num_cascades
+            log_split = near * math.pow(far / near, f)
+            even_split = near + (far - near) * f
+            splits.append(sun['split_lambda'] * log_split + (1.0 - sun['split_lambda']) * even_split)
+        return splits
+
+    def _update_sun_lights(self):
+        """
+        Fits the cascades of each sun to the camera frustum and
+        picks the cascades that get rendered this frame
+        """
+        if not self.sun_lights:
+            return
+        lens = base.cam.node().get_lens()
+        fov = lens.get_fov()
+        # squared distance from the view axis to a frustum corner at a distance of 1.0
+        k2 = math.tan(deg2Rad(fov[0] * 0.5)) ** 2 + math.tan(deg2Rad(fov[1] * 0.5)) ** 2
+        for sun in self.sun_lights:
+            if not sun['cascades']:
+                continue
+            sun['frame'] += 1
+            splits = self._get_cascade_splits(sun)
+            direction = sun['direction']
+            if abs(direction.z) > 0.99:
+                up = Vec3(0, 1, 0)
+            else:
+                up = Vec3(0, 0, 1)
+            quat = Quat()
+            look_at(quat, -direction, up)
+            inv_quat = Quat(quat)
+            inv_quat.invert_in_place()
+            for i, cascade in enumerate(sun['cascades']):
+                if not sun['dirty'] and (sun['frame'] + i) % cascade['interval'] != 0:
+                    cascade['region'].set_active(False)
+                    continue
+                near, far = splits[i], splits[i + 1]
+                # bounding sphere of the frustum slice, its size does not change
+                # when the camera turns, so the shadows don't shimmer
+                center_y = min(far, 0.5 * (near + far) * (1.0 + k2))
+                radius = max(math.sqrt((center_y - near) ** 2 + near * near * k2),
+                             math.sqrt((far - center_y) ** 2 + far * far * k2))
+                radius = math.ceil(radius)
+                center = render.get_relative_point(base.cam, Point3(0, center_y, 0))
+                # snap the center to the shadow map texels (in light space)
+                texel = 2.0 * radius / cascade['tile'][2]
+                light_center = inv_quat.xform(Vec3(center))
+                light_center.x = math.floor(light_center.x / texel) * texel
+                light_center.z = math.floor(light_center.z / texel) * texel
+                center = Point3(quat.xform(light_center))
+                camera = cascade['camera']
+                camera.set_quat(render, quat)
+                camera.set_pos(render, center + direction * (radius + sun['offset']))
+                cascade['lens'].set_film_size(2.0 * radius, 2.0 * radius)
+                cascade['lens'].set_near_far(0.0, 2.0 * radius + sun['offset'])
+                sun['matrices'][i] = render.get_mat(camera) * cascade['lens'].get_projection_mat()
+                sun['far'][i] = far
+                cascade['region'].set_active(True)
+            sun['dirty'] = False
+
+    def add_cone_light(self, color, pos=(0, 0, 0), hpr=(0, 0, 0),exponent=40,
+                        radius=1.0, fov=45.0, shadow_size=0.0, bias=0.0005):
+        """
+        Creates a spotlight,
+        use the ConeLight class, not this function!
+        """
+        if fov > 179.0:
+            fov = 179.0
+        xy_scale = math.tan(deg2Rad(fov * 0.5))
         model = loader.load_model("models/cone")
         # temp=model.copyTo(self.plain_root)
         # self.lights.append(model)
@@ -772,17 +2402,19 @@ class DeferredRenderer(DirectObject):
         p3d_light.set_hpr(render, hpr)
         p3d_light.node().set_exponent(exponent)
         p3d_light.node().set_color(Vec4(color, 1.0))
+        p3d_light.node().get_lens().set_fov(fov)
+        p3d_light.node().get_lens().set_far(radius)
+        p3d_light.node().get_lens().set_near(1.0)
         if shadow_size > 0.0:
-            p3d_light.node().set_shadow_caster(True, shadow_size, shadow_size)
-            model.set_shader_input("bias", bias)
-            model.set_shader(loader.load_shader_GLSL(self.v.format(
-            'spot_light_shadow'), self.f.format('spot_light_shadow'), self.shading_setup))
+            tiles = self.add_shadow_caster(p3d_light, shadow_size)
+            if tiles:
+                model.set_shader_input("bias", bias)
+                model.set_shader_input("shadow_tile", tiles[0])
+                model.set_shader(loader.load_shader_GLSL(self.v.format(
+                'spot_light_shadow'), self.f.format('spot_light_shadow'), self.shading_setup))
         # p3d_light.node().set_camera_mask(self.modelMask)
         model.set_shader_input("spot", p3d_light)
         #p3d_light.node().showFrustum()
-        p3d_light.node().get_lens().set_fov(fov)
-        p3d_light.node().get_lens().set_far(radius)
-        p3d_light.node().get_lens().set_near(1.0)
         #lens=OrthographicLens()
         #lens.set_near_far(5.0, 60.0)
         #lens.set_film_size(30, 30)
@@ -814,13 +2446,17 @@ class DeferredRenderer(DirectObject):
         p3d_light.set_pos(render, pos)
 
         if shadow_size > 0:
-            model.set_shader(loader.load_shader_GLSL(self.v.format(
-                'point_light_shadow'), self.f.format('point_light_shadow'), self.shading_setup))
-            p3d_light.node().set_shadow_caster(True, shadow_size, shadow_size)
-            p3d_light.node().set_camera_mask(BitMask32.bit(13))
             for i in range(6):
                 p3d_light.node().get_lens(i).set_near_far(0.1, radius)
                 p3d_light.node().get_lens(i).make_bounds()
+            tiles = self.add_shadow_caster(p3d_light, shadow_size, 6)
+            if tiles:
+                model.set_shader(loader.load_shader_GLSL(self.v.format(
+                    'point_light_shadow'), self.f.format('point_light_shadow'), self.shading_setup))
+                shadow_tile = PTA_LVecBase4f()
+                for tile in tiles:
+                    shadow_tile.push_back(tile)
+                model.set_shader_input('shadow_tile', shadow_tile)
 
         # shader inputs
         try:
@@ -840,6 +2476,365 @@ class DeferredRenderer(DirectObject):
 
         return model, p3d_light
 
+    def _setup_instanced_lights(self, define=None, capacity=256):
+        """
+        Creates the single instanced sphere used to draw all the
+        point lights that don't cast shadows, the per light data
+        (pos, radius, color) is stored in a buffer texture
+        """
+        # 2 texels (8 floats) per light
+        self.point_light_capacity = capacity
+        self.point_light_data = array('f', [0.0]) * (capacity * 8)
+        self.point_light_tex = Texture('point_light_data')
+        self.point_light_tex.setup_buffer_texture(capacity * 2, Texture.T_float,
+                                                  Texture.F_rgba32, GeomEnums.UH_dynamic)
+        self.point_light_handles = array('i')  # index -> handle
+        self.point_light_index = {}  # handle -> index
+        # (sorted handles, their index) for the bulk functions, see _get_point_light_rows()
+        self._point_light_lookup = None
+        self._point_light_handle_counter = itertools.count(1)
+        self._point_light_dirty = True
+
+        self.point_light_geom = loader.load_model('models/sphere')
+        self.point_light_geom.reparent_to(self.light_root)
+        self.point_light_geom.set_shader(loader.load_shader_GLSL(self.v.format(
+            'point_light_instanced'), self.f.format('point_light_instanced'), define))
+        self.point_light_geom.set_attrib(DepthTestAttrib.make(RenderAttrib.MLess))
+        self.point_light_geom.set_attrib(CullFaceAttrib.make(
+            CullFaceAttrib.MCullCounterClockwise))
+        self.point_light_geom.set_attrib(ColorBlendAttrib.make(
+            ColorBlendAttrib.MAdd, ColorBlendAttrib.OOne, ColorBlendAttrib.OOne))
+        self.point_light_geom.set_attrib(DepthWriteAttrib.make(DepthWriteAttrib.MOff))
+        self.point_light_geom.set_shader_input('light_data', self.point_light_tex)
+        # the vertex shader moves the instances around,
+        # so the bounds of the model are meaningless
+        self.point_light_geom.node().set_bounds(OmniBoundingVolume())
+        self.point_light_geom.node().set_final(True)
+        # instance count of 0 means 'not instanced', so just hide it
+        self.point_light_geom.stash()
+        self.clustered_lights = False
+        self.cluster_quad = None
+        self._setup_clustered_lights(define)
+
+    def _setup_clustered_lights(self, define=None):
+        """
+        Turns clustered shading of the instanced point lights on or off,
+        depending on the 'CLUSTERED_LIGHTS' key in the shading_setup.
+        When on, the lights are binned into a froxel grid on the cpu
+        and shaded in one fullscreen pass instead of drawing light volumes
+        """
+        if define is None:
+            define = {}
+        self._point_light_dirty = True
+        if 'CLUSTERED_LIGHTS' not in define:
+            self.clustered_lights = False
+            if self.cluster_quad is not None:
+                self.cluster_quad.remove_node()
+                self.cluster_quad = None
+            return
+        if np is None:
+            raise RuntimeError('Clustered lights need numpy')
+        self.clustered_lights = True
+        self.cluster_size = (int(define.get('CLUSTER_X', 16)),
+                             int(define.get('CLUSTER_Y', 9)),
+                             int(define.get('CLUSTER_Z', 24)))
+        num_clusters = self.cluster_size[0] * self.cluster_size[1] * self.cluster_size[2]
+        if self.cluster_quad is None:
+            self.cluster_grid_tex = Texture('cluster_grid')
+            self.cluster_index_tex = Texture('cluster_index')
+            self.cluster_index_capacity = 0
+            cm = CardMaker('clustered_lights')
+            cm.set_frame(-1, 1, -1, 1)
+            self.cluster_quad = self.light_root.attach_new_node(cm.generate())
+            self.cluster_quad.set_attrib(DepthTestAttrib.make(RenderAttrib.MNone))
+            self.cluster_quad.set_attrib(CullFaceAttrib.make(CullFaceAttrib.MCullNone))
+            self.cluster_quad.set_attrib(ColorBlendAttrib.make(
+                ColorBlendAttrib.MAdd, ColorBlendAttrib.OOne, ColorBlendAttrib.OOne))
+            self.cluster_quad.set_attrib(DepthWriteAttrib.make(DepthWriteAttrib.MOff))
+            self.cluster_quad.node().set_bounds(OmniBoundingVolume())
+            self.cluster_quad.node().set_final(True)
+            self.cluster_quad.stash()
+        self.cluster_grid_tex.setup_buffer_texture(num_clusters, Texture.T_float,
+                                                   Texture.F_rg32, GeomEnums.UH_dynamic)
+        self.cluster_quad.set_shader(loader.load_shader_GLSL(self.v.format(
+            'clustered_light'), self.f.format('clustered_light'), define))
+        try:
+            self.cluster_quad.set_shader_inputs(light_data=self.point_light_tex,
+                                                cluster_grid=self.cluster_grid_tex,
+                                                cluster_index=self.cluster_index_tex)
+        except AttributeError:
+            self.cluster_quad.set_shader_input('light_data', self.point_light_tex)
+            self.cluster_quad.set_shader_input('cluster_grid', self.cluster_grid_tex)
+            self.cluster_quad.set_shader_input('cluster_index', self.cluster_index_tex)
+        if not self.point_light_geom.is_stashed():
+            self.point_light_geom.stash()
+
+    def _update_light_clusters(self):
+        """
+        Bins the instanced point lights into the froxel grid
+        (screen tiles x exponential depth slices) and uploads the result
+        """
+        num_lights = len(self.point_light_handles)
+        if num_lights == 0:
+            return
+        size_x, size_y, size_z = self.cluster_size
+        lens = base.cam.node().get_lens()
+        near = lens.get_near()
+        far = lens.get_far()
+        fov = lens.get_fov()
+        tan_x = math.tan(deg2Rad(fov[0] * 0.5))
+        tan_y = math.tan(deg2Rad(fov[1] * 0.5))
+        self.cluster_quad.set_shader_input('cluster_near_far', Vec2(near, far))
+
+        data = np.frombuffer(self.point_light_data, dtype=np.float32,
+                             count=num_lights * 8).reshape(num_lights, 8)
+        # world space -> camera space, panda uses row vectors
+        mat = render.get_mat(base.cam)
+        mat = np.array([list(mat.get_row(i)) for i in range(4)], dtype=np.float32)
+        pos = data[:, 0:3].dot(mat[0:3, 0:3]) + mat[3, 0:3]
+        radius = data[:, 3]
+        x, depth, y = pos[:, 0], pos[:, 1], pos[:, 2]
+
+        # depth range, lights fully outside of near-far are dropped
+        z_min = np.maximum(depth - radius, near)
+        z_max = np.minimum(depth + radius, far)
+        visible = (z_min <= z_max) & (radius > 0.0)
+        log_depth = math.log(far / near)
+        slice_min = np.floor(np.log(z_min / near) / log_depth * size_z)
+        slice_max = np.floor(np.log(np.maximum(z_max, near) / near) / log_depth * size_z)
+
+        # conservative screen rect of the sphere over the depth range
+        def screen_range(center, tan_half, tiles):
+            low = center - radius
+            high = center + radius
+            low = np.where(low < 0.0, low / z_min, low / z_max) / tan_half
+            high = np.where(high > 0.0, high / z_min, high / z_max) / tan_half
+            tile_min = np.floor((low * 0.5 + 0.5) * tiles)
+            tile_max = np.floor((high * 0.5 + 0.5) * tiles)
+            return tile_min, tile_max
+        x_min, x_max = screen_range(x, tan_x, size_x)
+        y_min, y_max = screen_range(y, tan_y, size_y)
+        visible &= (x_max >= 0) & (x_min < size_x) & (y_max >= 0) & (y_min < size_y)
+
+        light_ids = np.nonzero(visible)[0]
+        x_min = np.clip(x_min[light_ids], 0, size_x - 1).astype(np.int64)
+        x_max = np.clip(x_max[light_ids], 0, size_x - 1).astype(np.int64)
+        y_min = np.clip(y_min[light_ids], 0, size_y - 1).astype(np.int64)
+        y_max = np.clip(y_max[light_ids], 0, size_y - 1).astype(np.int64)
+        slice_min = np.clip(slice_min[light_ids], 0, size_z - 1).astype(np.int64)
+        slice_max = np.clip(slice_max[light_ids], 0, size_z - 1).astype(np.int64)
+
+        # expand each light to all the clusters it touches
+        num_x = x_max - x_min + 1
+        num_y = y_max - y_min + 1
+        counts = num_x * num_y * (slice_max - slice_min + 1)
+        total = int(counts.sum())
+        owner = np.repeat(np.arange(len(light_ids)), counts)
+        local = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        cluster_x = x_min[owner] + local % num_x[owner]
+        local = local // num_x[owner]
+        cluster_y = y_min[owner] + local % num_y[owner]
+        cluster_z = slice_min[owner] + local // num_y[owner]
+        cluster = (cluster_z * size_y + cluster_y) * size_x + cluster_x
+
+        order = np.argsort(cluster, kind='stable')
+        index = light_ids[owner[order]].astype(np.float32)
+        cluster_count = np.bincount(cluster, minlength=size_x * size_y * size_z)
+        grid = np.empty((len(cluster_count), 2), dtype=np.float32)
+        grid[:, 0] = np.cumsum(cluster_count) - cluster_count
+        grid[:, 1] = cluster_count
+
+        if total > self.cluster_index_capacity or self.cluster_index_capacity == 0:
+            self.cluster_index_capacity = max(1024, self.cluster_index_capacity)
+            while self.cluster_index_capacity < total:
+                self.cluster_index_capacity *= 2
+            self.cluster_index_tex.setup_buffer_texture(self.cluster_index_capacity, Texture.T_float,
+                                                        Texture.F_r32, GeomEnums.UH_dynamic)
+        index_data = np.zeros(self.cluster_index_capacity, dtype=np.float32)
+        index_data[:total] = index
+        self.cluster_grid_tex.set_ram_image(grid.tobytes())
+        self.cluster_index_tex.set_ram_image(index_data.tobytes())
+
+    def _resize_point_light_buffer(self, capacity):
+        """
+        Grows the buffer texture for instanced point lights
+        """
+        used = len(self.point_light_handles) * 8
+        data = array('f', [0.0]) * (capacity * 8)
+        data[:used] = self.point_light_data[:used]
+        self.point_light_data = data
+        self.point_light_capacity = capacity
+        self.point_light_tex.setup_buffer_texture(capacity * 2, Texture.T_float,
+                                                  Texture.F_rgba32, GeomEnums.UH_dynamic)
+        self._point_light_dirty = True
+
+    def _write_point_light(self, index, color=None, pos=None, radius=None):
+        """
+        Writes the values for one light into the buffer
+        """
+        offset = index * 8
+        if pos is not None:
+            self.point_light_data[offset:offset + 3] = array('f', pos)
+        if radius is not None:
+            self.point_light_data[offset + 3] = radius
+        if color is not None:
+            self.point_light_data[offset + 4:offset + 7] = array('f', color)
+        self._point_light_dirty = True
+
+    def add_instanced_point_light(self, color, pos=(0, 0, 0), radius=1.0):
+        """
+        Adds a omni (point) light without shadows to the instanced light buffer,
+        returns a handle used to change or remove the light.
+        Use the SphereLight class to create lights!!!
+        """
+        index = len(self.point_light_handles)
+        if index >= self.point_light_capacity:
+            self._resize_point_light_buffer(self.point_light_capacity * 2)
+        handle = next(self._point_light_handle_counter)
+        self.point_light_handles.append(handle)
+        self.point_light_index[handle] = index
+        self._point_light_lookup = None
+        self._write_point_light(index, color=color, pos=pos, radius=radius)
+        return handle
+
+    def set_instanced_point_light(self, handle, color=None, pos=None, radius=None):
+        """
+        Changes the color, pos and/or radius of a instanced point light
+        """
+        self._write_point_light(self.point_light_index[handle], color, pos, radius)
+
+    def remove_instanced_point_light(self, handle):
+        """
+        Removes a instanced point light,
+        the last light in the buffer is moved in the place of the removed one
+        """
+        index = self.point_light_index.pop(handle)
+        last_index = len(self.point_light_handles) - 1
+        last_handle = self.point_light_handles.pop()
+        if index != last_index:
+            self.point_light_handles[index] = last_handle
+            self.point_light_index[last_handle] = index
+            self.point_light_data[index * 8:index * 8 + 8] = self.point_light_data[last_index * 8:last_index * 8 + 8]
+        self._point_light_lookup = None
+        self._point_light_dirty = True
+
+    def _get_point_light_array(self):
+        """
+        Returns a numpy view (capacity x 8) of the instanced light buffer
+        """
+        return np.frombuffer(self.point_light_data, dtype=np.float32).reshape(-1, 8)
+
+    def _get_point_light_rows(self, handles):
+        """
+        Returns the rows in the instanced light buffer of the given handles (numpy array),
+        the handles are looked up with a binary search in a sorted copy of
+        point_light_handles, the copy is made again after lights are added or removed
+        """
+        if self._point_light_lookup is None:
+            current = np.array(self.point_light_handles, dtype=np.int64)
+            order = np.argsort(current, kind='mergesort')
+            self._point_light_lookup = (current[order], order)
+        sorted_handles, order = self._point_light_lookup
+        handles = np.asarray(handles, dtype=np.int64).reshape(-1)
+        found = np.searchsorted(sorted_handles, handles)
+        if len(handles) and (found.max() >= len(sorted_handles) or np.any(sorted_handles[found] != handles)):
+            raise KeyError('Unknown instanced point light handle')
+        return order[found]
+
+    def add_instanced_point_lights(self, colors, positions, radii):
+        """
+        Adds many instanced point lights at once from (numpy) arrays,
+        colors and positions are Nx3, radii has N values,
+        returns a array of handles.
+        Use the LightBatch class to create lights!!!
+        """
+        radii = np.asarray(radii, dtype=np.float32).reshape(-1)
+        count = len(radii)
+        start = len(self.point_light_handles)
+        capacity = self.point_light_capacity
+        while start + count > capacity:
+            capacity *= 2
+        if capacity != self.point_light_capacity:
+            self._resize_point_light_buffer(capacity)
+        handles = list(itertools.islice(self._point_light_handle_counter, count))
+        self.point_light_handles.extend(handles)
+        self.point_light_index.update(zip(handles, range(start, start + count)))
+        self._point_light_lookup = None
+        data = self._get_point_light_array()
+        data[start:start + count, 0:3] = positions
+        data[start:start + count, 3] = radii
+        data[start:start + count, 4:7] = colors
+        self._point_light_dirty = True
+        return np.array(handles, dtype=np.int64)
+
+    def set_instanced_point_lights(self, handles, colors=None, positions=None, radii=None):
+        """
+        Changes the color, pos and/or radius of many instanced point lights at once
+        """
+        rows = self._get_point_light_rows(handles)
+        data = self._get_point_light_array()
+        if positions is not None:
+            data[rows, 0:3] = positions
+        if radii is not None:
+            data[rows, 3] = np.asarray(radii, dtype=np.float32).reshape(-1)
+        if colors is not None:
+            data[rows, 4:7] = colors
+        self._point_light_dirty = True
+
+    def get_instanced_point_lights(self, handles):
+        """
+        Returns the colors, positions (Nx3 arrays) and radii of many instanced point lights,
+        the values are copied from the light buffer
+        """
+        data = self._get_point_light_array()[self._get_point_light_rows(handles)]
+        return data[:, 4:7], data[:, 0:3], data[:, 3]
+
+    def remove_instanced_point_lights(self, handles):
+        """
+        Removes many instanced point lights,
+        the lights that are left are moved down in the buffer (in the same order)
+        """
+        rows = self._get_point_light_rows(handles)
+        count = len(self.point_light_handles)
+        keep = np.ones(count, dtype=bool)
+        keep[rows] = False
+        left = int(keep.sum())
+        data = self._get_point_light_array()
+        data[:left] = data[:count][keep]
+        kept_handles = np.array(self.point_light_handles, dtype=np.int32)[keep]
+        self.point_light_handles = array('i')
+        try:
+            self.point_light_handles.frombytes(kept_handles.tobytes())
+        except AttributeError:  # py2
+            self.point_light_handles.fromstring(kept_handles.tostring())
+        self.point_light_index = dict(zip(self.point_light_handles, range(left)))
+        self._point_light_lookup = None
+        self._point_light_dirty = True
+
+    def _upload_point_lights(self):
+        """
+        Sends the instanced light data to the gpu (if it changed)
+        """
+        if not self._point_light_dirty:
+            return
+        self._point_light_dirty = False
+        try:
+            self.point_light_tex.set_ram_image(self.point_light_data.tobytes())
+        except AttributeError:  # py2
+            self.point_light_tex.set_ram_image(self.point_light_data.tostring())
+        num_lights = len(self.point_light_handles)
+        if self.clustered_lights:
+            node = self.cluster_quad
+        else:
+            node = self.point_light_geom
+            if num_lights > 0:
+                node.set_instance_count(num_lights)
+        if num_lights == 0:
+            if not node.is_stashed():
+                node.stash()
+        elif node.is_stashed():
+            node.unstash()
+
     def _make_FBO(self, name, auxrgba=0, multisample=0, srgb=False, depth_bits=32):
         """
         This routine creates an offscreen buffer.  All the complicated
@@ -866,17 +2861,453 @@ class DeferredRenderer(DirectObject):
             GraphicsPipe.BFRttCumulative | GraphicsPipe.BFRefuseWindow,
             base.win.get_gsg(), base.win)
 
+    def attach_light(self, light, node, offset=(0, 0, 0)):
+        """
+        Makes the light follow the node, returns a handle for detach_light(),
+        use SphereLight.attach_to() !
+        """
+        handle = next(self._attach_handle_counter)
+        self.attached_lights[handle] = (node, light, Point3(*offset))
+        if node not in self._light_attachments:
+            self._light_attachments[node] = {'transform': None, 'handles': [], 'offsets': None}
+        record = self._light_attachments[node]
+        record['handles'].append(handle)
+        record['transform'] = None  # force a update
+        record['offsets'] = None
+        return handle
+
+    def detach_light(self, handle):
+        """
+        Stops a light from following a node,
+        use SphereLight.detach() !
+        """
+        if handle not in self.attached_lights:
+            return
+        node = self.attached_lights.pop(handle)[0]
+        record = self._light_attachments[node]
+        record['handles'].remove(handle)
+        record['offsets'] = None
+        if not record['handles']:
+            del self._light_attachments[node]
+
+    def _update_attached_lights(self):
+        """
+        Moves the attached lights, but only for nodes that moved since the last frame,
+        all the lights on one node are moved in one go
+        """
+        for node, record in self._light_attachments.items():
+            if node.is_empty():
+                continue
+            transform = node.get_transform(render)
+            if transform == record['transform']:
+                continue
+            record['transform'] = transform
+            lights = [self.attached_lights[handle][1] for handle in record['handles']]
+            if np is None:
+                mat = transform.get_mat()
+                points = [mat.xform_point(self.attached_lights[handle][2]) for handle in record['handles']]
+                for light, point in zip(lights, points):
+                    light.set_pos(point)
+                continue
+            if record['offsets'] is None:
+                offsets = [tuple(self.attached_lights[handle][2]) + (1.0,) for handle in record['handles']]
+                record['offsets'] = np.array(offsets, dtype=np.float32)
+            # panda uses row vectors, so it's offset * mat
+            points = record['offsets'].dot(np.array(transform.get_mat(), dtype=np.float32))[:, :3]
+            instanced = []
+            rows = []
+            for row, (light, point) in enumerate(zip(lights, points)):
+                instance_id = light._move_to(point)
+                if instance_id is not None:
+                    instanced.append(instance_id)
+                    rows.append(row)
+            if instanced:
+                self.set_instanced_point_lights(instanced, positions=points[rows])
+
     def _update(self, task):
         """
         Update task
         """
         self.plain_cam.set_pos_hpr(base.cam.get_pos(render), base.cam.get_hpr(render))
 
-        for node, light, offset in self.attached_lights.values():
-            if not node.is_empty():
-                light.set_pos(render.get_relative_point(node, offset))
+        self._update_attached_lights()
+        self.light_manager.update(globalClock.get_dt())
+        self._update_shadows()
+        self._update_sun_lights()
+        self._upload_point_lights()
+        if self.clustered_lights:
+            self._update_light_clusters()
+        if self.frame_timing_text is not None:
+            self._update_frame_timing_text()
+        if self.dynamic_resolution is not None:
+            self._update_dynamic_resolution(globalClock.get_dt())
         return task.again
 
+    def _update_temporal(self, task):
+        """
+        Keeps the view-projection matrix of the last frame and
+        moves the sample pattern of the temporal stages
+        """
+        self.prev_view_proj[0] = self.view_proj
+        self.view_proj = render.get_mat(base.cam) * base.cam.node().get_lens().get_projection_mat()
+        # Halton (2, 3) sequence
+        self.temporal_frame = self.temporal_frame % 16 + 1
+        jitter = []
+        for base_number in (2, 3):
+            i = self.temporal_frame
+            f = 1.0
+            value = 0.0
+            while i > 0:
+                f /= base_number
+                value += f * (i % base_number)
+                i //= base_number
+            jitter.append(value)
+        self.temporal_jitter[0] = LVecBase2f(*jitter)
+        return task.again
+
+class ShadowAtlas(object):
+    """
+    A single depth texture shared by all the shadow casting lights.
+    Each light lens gets a square tile, the size of the tiles is rounded
+    up to a power of two and the tiles are handed out by a buddy allocator,
+    so the memory used for shadows is fixed by the size of the atlas.
+    Every tile is rendered by its own display region of one buffer.
+    """
+
+    def __init__(self, size=4096, min_tile_size=32, sort=-20):
+        self.size = size
+        self.sort = sort
+        self.min_tile_size = min_tile_size
+        # free tiles by size, a tile is a (x, y, size) tuple in pixels
+        self.free_tiles = {size: [(0, 0)]}
+        self.used_tiles = set()
+
+        depth_bits = ConfigVariableInt('shadow-depth-bits', 24).get_value()
+        self.tex = Texture('shadow_atlas')
+        self.tex.set_wrap_u(Texture.WM_clamp)
+        self.tex.set_wrap_v(Texture.WM_clamp)
+        if depth_bits == 32:
+            self.tex.set_format(Texture.F_depth_component32)
+        elif depth_bits == 16:
+            self.tex.set_format(Texture.F_depth_component16)
+        else:
+            self.tex.set_format(Texture.F_depth_component24)
+        winprops = WindowProperties()
+        winprops.set_size(size, size)
+        props = FrameBufferProperties()
+        props.set_depth_bits(depth_bits)
+        self.buffer = base.graphicsEngine.make_output(
+            base.pipe, 'shadow_atlas', sort,
+            props, winprops,
+            GraphicsPipe.BF_refuse_window,
+            base.win.get_gsg(), base.win)
+        self.buffer.add_render_texture(tex=self.tex,
+                                       mode=GraphicsOutput.RTMBindOrCopy,
+                                       bitplane=GraphicsOutput.RTPDepth)
+        self.buffer.set_sort(sort)
+        # each display region clears only its own tile
+        self.buffer.disable_clears()
+        self.buffer.get_overlay_display_region().set_active(False)
+
+    def _tile_size(self, size):
+        tile_size = self.min_tile_size
+        while tile_size < size and tile_size < self.size:
+            tile_size *= 2
+        return tile_size
+
+    def allocate(self, size):
+        """
+        Returns a free (x, y, size) tile at least 'size' pixels big,
+        or None if there is no space left
+        """
+        tile_size = self._tile_size(size)
+        free_size = tile_size
+        while free_size <= self.size and not self.free_tiles.get(free_size):
+            free_size *= 2
+        if free_size > self.size:
+            return None
+        x, y = self.free_tiles[free_size].pop()
+        # split the tile until it's the right size
+        while free_size > tile_size:
+            free_size //= 2
+            self.free_tiles.setdefault(free_size, []).extend(
+                [(x + free_size, y), (x, y + free_size), (x + free_size, y + free_size)])
+        tile = (x, y, tile_size)
+        self.used_tiles.add(tile)
+        return tile
+
+    def release(self, tile):
+        """
+        Returns a tile to the allocator, merging it with its free buddies
+        """
+        self.used_tiles.discard(tile)
+        x, y, tile_size = tile
+        while tile_size < self.size:
+            parent_size = tile_size * 2
+            parent_x = x - x % parent_size
+            parent_y = y - y % parent_size
+            buddies = [(parent_x + dx, parent_y + dy)
+                       for dx in (0, tile_size) for dy in (0, tile_size)
+                       if (parent_x + dx, parent_y + dy) != (x, y)]
+            free = self.free_tiles.get(tile_size, [])
+            if not all(buddy in free for buddy in buddies):
+                break
+            for buddy in buddies:
+                free.remove(buddy)
+            x, y, tile_size = parent_x, parent_y, parent_size
+        self.free_tiles.setdefault(tile_size, []).append((x, y))
+
+    def get_tile_uv(self, tile):
+        """
+        Returns the tile as a Vec4 (uv offset, uv size), as used by the shaders
+        """
+        x, y, tile_size = tile
+        size = float(self.size)
+        return Vec4(x / size, y / size, tile_size / size, tile_size / size)
+
+    def get_used_texels(self):
+        """
+        Returns the number of texels (pixels) in use
+        """
+        return sum(tile[2] * tile[2] for tile in self.used_tiles)
+
+    def make_region(self, tile, camera, lens_index=0):
+        """
+        Makes a display region that renders the given camera into a tile
+        """
+        l, b, w, h = self.get_tile_uv(tile)
+        region = self.buffer.make_display_region(l, l + w, b, b + h)
+        region.set_camera(camera)
+        region.set_lens_index(lens_index)
+        region.set_clear_depth_active(True)
+        region.set_clear_depth(1.0)
+        return region
+
+    def remove_region(self, region):
+        self.buffer.remove_display_region(region)
+
+    def destroy(self):
+        """
+        Removes the buffer of the atlas
+        """
+        self.buffer.clear_render_textures()
+        base.graphicsEngine.remove_window(self.buffer)
+
+
+class LightBatch(object):
+    """
+    A group of omni (point) lights without shadows, created, changed and removed
+    from numpy arrays in one call, with no Python object per light.
+    The batch only keeps the handles of its lights, the positions, colors
+    and radii are read from the renderer's light buffer.
+    The lights are addressed by integer handles returned by add(), eg.
+    batch=LightBatch()
+    handles=batch.add(positions=np.random.rand(1000, 3)*100.0,
+                      colors=np.ones((1000, 3)),
+                      radii=np.full(1000, 5.0))
+    batch.update(handles[:10], colors=np.zeros((10, 3)))
+    batch.remove(handles[10:20])
+    batch.save('level_lights.npz')
+    The lights are removed when the batch goes out of scope (or remove_all() is called)
+    """
+
+    def __init__(self, positions=None, colors=None, radii=None):
+        if not hasattr(builtins, 'deferred_renderer'):
+            raise RuntimeError('You need a DeferredRenderer')
+        if np is None:
+            raise RuntimeError('LightBatch needs numpy')
+        self.handles = np.zeros(0, dtype=np.int64)
+        if positions is not None:
+            self.add(positions, colors, radii)
+
+    def __len__(self):
+        return len(self.handles)
+
+    @property
+    def colors(self):
+        return deferred_renderer.get_instanced_point_lights(self.handles)[0]
+
+    @property
+    def positions(self):
+        return deferred_renderer.get_instanced_point_lights(self.handles)[1]
+
+    @property
+    def radii(self):
+        return deferred_renderer.get_instanced_point_lights(self.handles)[2]
+
+    def _get_rows(self, handles):
+        """
+        Returns the rows of the arrays for the given handles,
+        handles are always increasing, so the arrays stay sorted by handle
+        """
+        handles = np.asarray(handles, dtype=np.int64).reshape(-1)
+        rows = np.searchsorted(self.handles, handles)
+        if len(handles) and (rows.max() >= len(self.handles) or np.any(self.handles[rows] != handles)):
+            raise KeyError('Handle not in this LightBatch')
+        return handles, rows
+
+    def add(self, positions, colors, radii):
+        """
+        Adds lights, positions and colors are Nx3 arrays, radii is a array of N values
+        (or one value for all the lights), returns a array of handles
+        """
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+        count = len(positions)
+        colors = np.broadcast_to(np.asarray(colors, dtype=np.float32), (count, 3))
+        radii = np.broadcast_to(np.asarray(radii, dtype=np.float32), (count,))
+        handles = deferred_renderer.add_instanced_point_lights(colors, positions, radii)
+        self.handles = np.concatenate((self.handles, handles))
+        return handles
+
+    def update(self, handles, positions=None, colors=None, radii=None):
+        """
+        Changes the positions, colors and/or radii of the lights with the given handles
+        """
+        handles, rows = self._get_rows(handles)
+        count = len(handles)
+        if positions is not None:
+            positions = np.broadcast_to(np.asarray(positions, dtype=np.float32), (count, 3))
+        if colors is not None:
+            colors = np.broadcast_to(np.asarray(colors, dtype=np.float32), (count, 3))
+        if radii is not None:
+            radii = np.broadcast_to(np.asarray(radii, dtype=np.float32), (count,))
+        deferred_renderer.set_instanced_point_lights(handles, colors, positions, radii)
+
+    def remove(self, handles):
+        """
+        Removes the lights with the given handles
+        """
+        handles, rows = self._get_rows(handles)
+        deferred_renderer.remove_instanced_point_lights(handles)
+        self.handles = np.delete(self.handles, rows)
+
+    def remove_all(self):
+        """
+        Removes all the lights in this batch
+        """
+        self.remove(self.handles)
+
+    def save(self, filename):
+        """
+        Saves the lights to a binary (numpy .npz) file,
+        handles are not saved, load() gives the lights new handles
+        """
+        colors, positions, radii = deferred_renderer.get_instanced_point_lights(self.handles)
+        with open(filename, 'wb') as f:
+            np.savez(f, positions=positions, colors=colors, radii=radii)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Creates a new LightBatch with the lights saved in a file
+        """
+        with open(filename, 'rb') as f:
+            data = np.load(f)
+            return cls(data['positions'], data['colors'], data['radii'])
+
+    def __del__(self):
+        try:
+            self.remove_all()
+        except:
+            pass
+
+
+class LightManager(object):
+    """
+    Keeps the number of shaded lights in check.
+    Every frame all SphereLights and ConeLights get a score based on how much
+    of the screen they can cover (from their radius and distance to the camera)
+    and how bright they are. Only the best max_lights are drawn and only the best
+    max_shadowed_lights cast shadows, lights fade in and out over fade_time
+    seconds when they cross these limits, so there's no popping.
+    A limit of 0 means no limit.
+    """
+
+    def __init__(self, max_lights=0, max_shadowed_lights=0, fade_time=0.5):
+        self.lights = weakref.WeakSet()
+        # light -> [fade, shadow fade]
+        self.fades = weakref.WeakKeyDictionary()
+        self.set_budget(max_lights, max_shadowed_lights, fade_time)
+
+    def set_budget(self, max_lights=0, max_shadowed_lights=0, fade_time=0.5):
+        """
+        Sets the max number of lights and shadow casting lights
+        """
+        self.max_lights = max_lights
+        self.max_shadowed_lights = max_shadowed_lights
+        self.fade_time = fade_time
+        if not self.max_lights and not self.max_shadowed_lights:
+            for light in list(self.lights):
+                self.fades[light] = [1.0, 1.0]
+                light._set_lod_fade(1.0, 1.0)
+
+    def add_light(self, light):
+        self.lights.add(light)
+        self.fades[light] = [1.0, 1.0]
+
+    def remove_light(self, light):
+        self.lights.discard(light)
+        self.fades.pop(light, None)
+
+    def _casts_shadow(self, light):
+        """
+        True if the light has its own geometry and a shadow map in the atlas
+        (instanced lights and ConeLights without shadows don't)
+        """
+        return (light.geom is not None and light.p3d_light is not None
+                and light.p3d_light in deferred_renderer.shadow_casters)
+
+    def get_score(self, pos, radius, intensity, cam_mat, tan_fov):
+        """
+        Returns the importance of a light,
+        cam_mat should be the render to camera matrix
+        """
+        if radius <= 0.0 or intensity <= 0.0:
+            return 0.0
+        cam_pos = cam_mat.xform_point(pos)
+        if cam_pos.y < -radius:  # behind the camera
+            return 0.0
+        distance = cam_pos.length()
+        if distance <= radius:  # camera inside the light
+            coverage = 1.0
+        else:
+            coverage = min(1.0, (radius / (distance * tan_fov)) ** 2)
+        return coverage * intensity
+
+    def update(self, dt):
+        """
+        Scores all the lights and updates the fades, called every frame by the DeferredRenderer
+        """
+        if not self.max_lights and not self.max_shadowed_lights:
+            return
+        cam_mat = render.get_mat(base.cam)
+        lens = base.cam.node().get_lens()
+        tan_fov = math.tan(deg2Rad(lens.get_fov()[0] * 0.5))
+        scored = []
+        for light in list(self.lights):
+            pos, radius, intensity = light._get_lod_values()
+            scored.append((self.get_score(pos, radius, intensity, cam_mat, tan_fov), light))
+        scored.sort(key=lambda item: item[0], reverse=True)
+
+        if self.fade_time > 0.0:
+            step = dt / self.fade_time
+        else:
+            step = 1.0
+        # only lights that can cast shadows take up the shadowed slots
+        shadow_rank = 0
+        for rank, (score, light) in enumerate(scored):
+            visible = score > 0.0 and (not self.max_lights or rank < self.max_lights)
+            shadowed = False
+            if visible and self._casts_shadow(light):
+                shadowed = not self.max_shadowed_lights or shadow_rank < self.max_shadowed_lights
+                shadow_rank += 1
+            fade = self.fades[light]
+            new_fade = [min(1.0, fade[0] + step) if visible else max(0.0, fade[0] - step),
+                        min(1.0, fade[1] + step) if shadowed else max(0.0, fade[1] - step)]
+            if new_fade != fade:
+                self.fades[light] = new_fade
+                light._set_lod_fade(*new_fade)
+
 # this will replace the default Loader
 
 
@@ -886,7 +3317,26 @@ class WrappedLoader(object):
         self.original_loader = original_loader
         self.texture_shader_inputs = []
         self.use_srgb = ConfigVariableBool('framebuffer-srgb').getValue()
-        self.shader_cache = {}
+        # canonical key -> shader, least recently used first
+        self.shader_cache = OrderedDict()
+        self.shader_cache_size = ConfigVariableInt('deferred-shader-cache-size', 256).getValue()
+        self.pinned_shaders = set()
+        self.shader_cache_stats = {'hits': 0, 'misses': 0, 'reloads': 0, 'evictions': 0,
+                                   'disk_hits': 0, 'load_time': 0.0}
+        # made shaders are also kept in Panda's model cache (model-cache-dir),
+        # see readCachedShader()
+        self.use_shader_disk_cache = ConfigVariableBool('deferred-shader-disk-cache', True).getValue()
+        # keys of evicted variants, loading one again counts as a reload, not a miss
+        self.evicted_shaders = set()
+        # generated shaders, path -> source
+        self.shader_sources = {}
+        # guards shader_sources, shader_fragments and shader_words,
+        # preprocessShaderGLSL() can run on a thread (see prewarm_shaders())
+        self.shader_source_lock = threading.RLock()
+        # path -> source split on #include lines, see _getShaderFragments()
+        self.shader_fragments = {}
+        # (vertex, fragment) -> words used in the sources (with includes)
+        self.shader_words = {}
 
     def _from_snake_case(self, attr):
         camel_case=''
@@ -935,57 +3385,96 @@ class WrappedLoader(object):
                 model.set_texture(tex_stage, tex, 1)
 
     def setTextureInputs(self, node):
-        for child in node.get_children():
-            #print(child)
-            self._setTextureInputs(child)
-            self.setTextureInputs(child)
-
-
-    def _setTextureInputs(self, model):
-        #print ('Fixing model', model)
-        slots_filled = set()
-        # find all the textures, easy mode - slot is fitting the stage mode
+        """
+        Sets the texture_shader_inputs (tex_diffuse, tex_normal, tex_material)
+        using the textures each geom is rendered with. The default textures
+        are set once on node, below it only the GeomNodes (or geoms) that need
+        other textures than the ones they inherit get inputs.
+        The tree is walked once, and the inputs for each set of textures
+        are only worked out once
+        """
+        defaults = dict((d['input_name'], d['default_texture']) for d in self.texture_shader_inputs)
+        try:
+            node.set_shader_inputs(**defaults)
+        except AttributeError:
+            for name, tex in defaults.items():
+                node.set_shader_input(name, tex)
+        # TextureAttrib -> [(name, texture)]
+        found = {}
+        stack = [(node, node.get_net_state(), defaults)]
+        while stack:
+            model, state, inherited = stack.pop()
+            if model.node().is_geom_node():
+                inherited = self._setTextureInputs(model, state, inherited, found)
+            for child in model.get_children():
+                stack.append((child, state.compose(child.get_state()), inherited))
+
+    def _setTextureInputs(self, model, state, inherited, found):
+        """
+        Sets the inputs on a GeomNode that differ from the inherited ones,
+        if its geoms use different textures the inputs go on the state of
+        each geom. Returns the inputs the children of the node inherit
+        """
+        geom_node = model.node()
+        tex_attribs = []
+        for i in range(geom_node.get_num_geoms()):
+            tex_attrib = state.compose(geom_node.get_geom_state(i)).get_attrib(TextureAttrib)
+            if tex_attrib not in found:
+                found[tex_attrib] = self._getTextureInputs(tex_attrib)
+            tex_attribs.append(tex_attrib)
+        if not tex_attribs:
+            return inherited
+        if all(tex_attrib == tex_attribs[0] for tex_attrib in tex_attribs):
+            inputs = dict((name, tex) for name, tex in found[tex_attribs[0]] if inherited[name] != tex)
+            if not inputs:
+                return inherited
+            try:
+                model.set_shader_inputs(**inputs)
+            except AttributeError:
+                for name, tex in inputs.items():
+                    model.set_shader_input(name, tex)
+            inherited = dict(inherited)
+            inherited.update(inputs)
+            return inherited
+        for i, tex_attrib in enumerate(tex_attribs):
+            inputs = [(name, tex) for name, tex in found[tex_attrib] if inherited[name] != tex]
+            if not inputs:
+                continue
+            geom_state = geom_node.get_geom_state(i)
+            shader_attrib = geom_state.get_attrib(ShaderAttrib)
+            if shader_attrib is None:
+                shader_attrib = ShaderAttrib.make()
+            for name, tex in inputs:
+                shader_attrib = shader_attrib.set_shader_input(ShaderInput(name, tex))
+            geom_node.set_geom_state(i, geom_state.set_attrib(shader_attrib))
+        return inherited
+
+    def _getTextureInputs(self, tex_attrib):
+        """
+        Returns a list of (input name, texture) for the texture_shader_inputs,
+        slots without a fitting texture get the default texture
+        """
+        stages = []
+        if tex_attrib is not None:
+            for i in range(tex_attrib.get_num_on_stages()):
+                tex_stage = tex_attrib.get_on_stage(i)
+                stages.append((tex_stage.get_mode(), tex_attrib.get_on_texture(tex_stage)))
+        stages = stages[:len(self.texture_shader_inputs)]
+        textures = {}
+        # easy mode - slot is fitting the stage mode
         # (eg. slot0 is diffuse/color)
-        for slot, tex_stage in enumerate(model.find_all_texture_stages()):
-            if slot >= len(self.texture_shader_inputs):
-                break
-            tex = model.find_texture(tex_stage)
-            if tex:
-                #print('Found tex:', tex.getFilename())
-                mode = tex_stage.get_mode()
-                if mode in self.texture_shader_inputs[slot]['stage_modes']:
-                    model.set_shader_input(self.texture_shader_inputs[
-                                         slot]['input_name'], tex)
-                    slots_filled.add(slot)
-        # did we get all of them?
-        if len(slots_filled) == len(self.texture_shader_inputs):
-            return
-        # what slots need filling?
-        missing_slots = set(
-            range(len(self.texture_shader_inputs))) - slots_filled
-        for slot, tex_stage in enumerate(model.findAllTextureStages()):
-            if slot >= len(self.texture_shader_inputs):
-                break
+        for slot, (mode, tex) in enumerate(stages):
+            if mode in self.texture_shader_inputs[slot]['stage_modes']:
+                textures[slot] = tex
+        # any slot with a fitting mode
+        missing_slots = set(range(len(self.texture_shader_inputs))) - set(textures)
+        for slot, (mode, tex) in enumerate(stages):
             if slot in missing_slots:
-                tex = model.find_texture(tex_stage)
-                if tex:
-                    mode = tex_stage.get_mode()
-                    for d in self.texture_shader_inputs:
-                        if mode in d['stage_modes']:
-                            i = self.texture_shader_inputs.index(d)
-                            model.set_shader_input(self.texture_shader_inputs[
-                                                 i]['input_name'], tex)
-                            slots_filled.add(i)
-        # did we get all of them this time?
-        if len(slots_filled) == len(self.texture_shader_inputs):
-            return
-        missing_slots = set(
-            range(len(self.texture_shader_inputs))) - slots_filled
-        #print ('Fail for model:', model)
-        # set defaults
-        for slot in missing_slots:
-            model.set_shader_input(self.texture_shader_inputs[slot][
-                                 'input_name'], self.texture_shader_inputs[slot]['default_texture'])
+                for i, d in enumerate(self.texture_shader_inputs):
+                    if mode in d['stage_modes']:
+                        textures[i] = tex
+        return [(d['input_name'], textures.get(i, d['default_texture']))
+                for i, d in enumerate(self.texture_shader_inputs)]
 
     def destroy(self):
         self.original_loader.destroy()
@@ -1086,28 +3575,38 @@ class WrappedLoader(object):
     def unloadSfx(self, sfx):
         self.original_loader.unloadSfx(sfx)
 
-    def loadShaderGLSL(self, v_shader, f_shader, define=None, version='#version 140'):
+    def loadShaderGLSL(self, v_shader, f_shader, define=None, version='#version 140', sources=None):
+        # sources is the (vertex, fragment) text from preprocessShaderGLSL()
+        # or the shader from readCachedShader(), if it was already made
         # check if we already have a shader like that
-        # note: this may fail depending on the dict implementation
-        if (v_shader, f_shader, str(define)) in self.shader_cache:
-            return self.shader_cache[(v_shader, f_shader, str(define))]
-        # load the shader text
-        with open(getModelPath().findFile(v_shader).toOsSpecific()) as f:
-            v_shader_txt = f.read()
-        with open(getModelPath().findFile(f_shader).toOsSpecific()) as f:
-            f_shader_txt = f.read()
-        # make the header
-        if define:
-            header = version + '\n'
-            for name, value in define.items():
-                header += '#define {0} {1}\n'.format(name, value)
-            # put the header on top
-            v_shader_txt = v_shader_txt.replace(version, header)
-            f_shader_txt = f_shader_txt.replace(version, header)
-        # make the shader
-        shader = Shader.make(Shader.SL_GLSL, v_shader_txt, f_shader_txt)
+        key = self.getShaderKey(v_shader, f_shader, define, version)
+        if key in self.shader_cache:
+            self.shader_cache_stats['hits'] += 1
+            shader = self.shader_cache.pop(key)
+            self.shader_cache[key] = shader
+            return shader
+        if key in self.evicted_shaders:
+            self.evicted_shaders.discard(key)
+            self.shader_cache_stats['reloads'] += 1
+        else:
+            self.shader_cache_stats['misses'] += 1
+        start = ClockObject.get_global_clock().get_real_time()
+        if sources is None:
+            sources = self._readCachedShader(key)
+        if isinstance(sources, Shader):
+            shader = sources
+            self.shader_cache_stats['disk_hits'] += 1
+        else:
+            if sources is None:
+                sources = self.preprocessShaderGLSL(v_shader, f_shader, define, version)
+            v_shader_txt, f_shader_txt = sources
+            # make the shader
+            shader = Shader.make(Shader.SL_GLSL, v_shader_txt, f_shader_txt)
+            self._writeCachedShader(key, shader)
+        self.shader_cache_stats['load_time'] += ClockObject.get_global_clock().get_real_time() - start
         # store it
-        self.shader_cache[(v_shader, f_shader, str(define))] = shader
+        self.shader_cache[key] = shader
+        self._evictShaders()
         try:
             shader.set_filename(Shader.ST_vertex, v_shader)
             shader.set_filename(Shader.ST_fragment, f_shader)
@@ -1115,6 +3614,328 @@ class WrappedLoader(object):
             print('Shader filenames will not be available, consider using a dev version of Panda3D')
         return shader
 
+    def preprocessShaderGLSL(self, v_shader, f_shader, define=None, version='#version 140'):
+        """
+        Reads the source of a shader variant and puts the defines in,
+        returns the (vertex, fragment) text for loadShaderGLSL().
+        Only reads files, so it can run on a thread
+        """
+        key = self.getShaderKey(v_shader, f_shader, define, version)
+        # load the shader text, with the #include files put in
+        paths = [v_shader, f_shader]
+        v_shader_txt = self._resolveShaderIncludes(v_shader, paths)
+        f_shader_txt = self._resolveShaderIncludes(f_shader, paths)
+        # the defines only get in if the #version matches
+        defined = dict(key[3])
+        axes = set(self.getShaderAxes(v_shader, f_shader))
+        v_shader_txt = self._stripShaderSource(v_shader_txt, defined if version in v_shader_txt else {}, axes)
+        f_shader_txt = self._stripShaderSource(f_shader_txt, defined if version in f_shader_txt else {}, axes)
+        # make the header
+        if key[3]:
+            header = version + '\n'
+            for name, value in key[3]:
+                header += '#define {0} {1}\n'.format(name, value)
+            # put the header on top
+            v_shader_txt = v_shader_txt.replace(version, header)
+            f_shader_txt = f_shader_txt.replace(version, header)
+        return v_shader_txt, f_shader_txt
+
+    def readCachedShader(self, v_shader, f_shader, define=None, version='#version 140'):
+        """
+        Returns the shader variant from Panda's model cache (BamCache, see
+        'model-cache-dir'), or None if it's not there or a file it was made
+        from changed. A cached shader doesn't need its sources read, #included
+        and stripped again (the driver still compiles it).
+        Only reads files, so it can run on a thread
+        """
+        return self._readCachedShader(self.getShaderKey(v_shader, f_shader, define, version))
+
+    def _getShaderCacheRecord(self, key):
+        """
+        Returns the BamCacheRecord of a shader variant, or None if
+        the model cache is off. The record is named by a hash of the key
+        (and the text of generated sources), BamCache drops it when one of the
+        files the shader was made from changes (see _writeCachedShader())
+        """
+        cache = BamCache.get_global_ptr()
+        if not self.use_shader_disk_cache or not cache.get_active():
+            return None
+        digest = hashlib.md5(repr(key).encode('utf-8'))
+        with self.shader_source_lock:
+            for path in key[:2]:
+                if path in self.shader_sources:
+                    digest.update(self.shader_sources[path].encode('utf-8'))
+        return cache.lookup(Filename('deferred_shaders', digest.hexdigest() + '.glsl'), 'sho')
+
+    def _readCachedShader(self, key):
+        record = self._getShaderCacheRecord(key)
+        if record is None or not record.has_data():
+            return None
+        shader = record.get_data()
+        if not isinstance(shader, Shader):
+            return None
+        return shader
+
+    def _writeCachedShader(self, key, shader):
+        """
+        Stores a made shader in the model cache, with all its source files
+        (and #includes) as dependent files
+        """
+        record = self._getShaderCacheRecord(key)
+        if record is None:
+            return
+        for path in self._getShaderFiles(key[0], key[1]):
+            with self.shader_source_lock:
+                if path in self.shader_sources:
+                    continue
+            found = getModelPath().find_file(path)
+            if found:
+                record.add_dependent_file(found)
+        record.set_data(shader)
+        BamCache.get_global_ptr().store(record)
+
+    def _getShaderFiles(self, v_shader, f_shader):
+        """
+        Returns the paths of the shader sources and all the files they #include
+        """
+        files = [v_shader, f_shader]
+        for path in files:
+            for kind, value in self._getShaderFragments(path):
+                if kind == 'include' and value not in files:
+                    files.append(value)
+        return files
+
+    def getShaderKey(self, v_shader, f_shader, define=None, version='#version 140'):
+        """
+        Returns the key of a shader variant in the shader_cache,
+        the defines are sorted and the values turned to strings,
+        so {'A':1, 'B':2} and {'B':2, 'A':1} are the same variant.
+        Defines the shader never uses are left out, so eg. a shading_setup
+        key only read by python doesn't make a new variant of every shader
+        """
+        defines = []
+        if define:
+            words = self._getShaderWords(v_shader, f_shader)
+            for name, value in define.items():
+                if str(name) not in words:
+                    continue
+                if isinstance(value, bool):
+                    value = int(value)
+                defines.append((str(name), str(value).strip()))
+        return (v_shader, f_shader, version, tuple(sorted(defines)))
+
+    def getShaderAxes(self, v_shader, f_shader):
+        """
+        Returns the names of the defines a shader tests with #ifdef, #ifndef,
+        #if or #elif (in its source and #include files), these are the
+        features that make variants of the shader (eg. SHADOW_CACHE, DISABLE_POM).
+        Names the driver defines (GL_ES, GL_ARB_*, __VERSION__, ...) are not axes
+        """
+        paths = [v_shader, f_shader]
+        txt = self._resolveShaderIncludes(v_shader, paths) + self._resolveShaderIncludes(f_shader, paths)
+        axes = set()
+        for line in re.findall(r'^\s*#\s*(?:if|ifdef|ifndef|elif)\b(.*)$', txt, flags=re.M):
+            axes.update(re.findall(r'[A-Za-z_]\w*', line))
+        axes.discard('defined')
+        return sorted(name for name in axes if not name.startswith(('GL_', '__')))
+
+    def _getShaderWords(self, v_shader, f_shader):
+        """
+        Returns a set of all the names used in the source of a shader
+        (and the files it includes)
+        """
+        with self.shader_source_lock:
+            if (v_shader, f_shader) not in self.shader_words:
+                paths = [v_shader, f_shader]
+                txt = self._resolveShaderIncludes(v_shader, paths) + self._resolveShaderIncludes(f_shader, paths)
+                self.shader_words[(v_shader, f_shader)] = frozenset(re.findall(r'[A-Za-z_]\w*', txt))
+            return self.shader_words[(v_shader, f_shader)]
+
+    def _getShaderFragments(self, path):
+        """
+        Returns the source of a shader as a list of ('text', source)
+        and ('include', path) parts, the list is made once for each file.
+        '#include "name"' (or '#pragma include "name"') is found
+        relative to the directory of the shader
+        """
+        with self.shader_source_lock:
+            if path not in self.shader_fragments:
+                fragments = []
+                txt = self.readShaderSource(path)
+                start = 0
+                for match in re.finditer(r'^[ \t]*#[ \t]*(?:pragma[ \t]+)?include[ \t]+["<]([^">]+)[">][^\n]*\n?', txt, flags=re.M):
+                    fragments.append(('text', txt[start:match.start()]))
+                    include = Filename(Filename(path).get_dirname(), match.group(1))
+                    include.standardize()
+                    fragments.append(('include', include.get_fullpath()))
+                    start = match.end()
+                fragments.append(('text', txt[start:]))
+                self.shader_fragments[path] = fragments
+            return self.shader_fragments[path]
+
+    def _resolveShaderIncludes(self, path, included):
+        """
+        Returns the source of a shader with the #include lines
+        replaced by the included files, a file is only put in once,
+        included is the list of files already in the shader (the new ones are added)
+        """
+        txt = ''
+        for kind, value in self._getShaderFragments(path):
+            if kind == 'text':
+                txt += value
+            elif value not in included:
+                included.append(value)
+                # the included files have no #version
+                txt += re.sub(r'^\s*(//GLSL|#version.*)$', '', self._resolveShaderIncludes(value, included), flags=re.M)
+        return txt
+
+    def _stripShaderSource(self, txt, defined, axes):
+        """
+        Removes the #ifdef/#ifndef/#if defined() blocks that are not used
+        with the given defines, the driver would skip them anyway, but this
+        way the source only has the code of the variant.
+        Only names in axes (see getShaderAxes()) are decided here, names the
+        source #defines or #undefs itself, driver macros and any other #if
+        are left for the driver
+        """
+        own = set(re.findall(r'^\s*#\s*(?:define|undef)\s+(\w+)', txt, flags=re.M))
+
+        def evaluate(directive, expression):
+            if directive in ('ifdef', 'ifndef'):
+                name, negate = expression, directive == 'ifndef'
+            else:
+                match = re.match(r'^(!?)\s*defined\s*(?:\(\s*(\w+)\s*\)|\s(\w+))$', expression)
+                if match is None:
+                    return None
+                name, negate = match.group(2) or match.group(3), match.group(1) == '!'
+            if name in own or name not in axes:
+                return None
+            return (name in defined) != negate
+
+        lines = []
+        # for each open #if: [mode, active, taken], mode is 'keep' (left for
+        # the driver), 'eval' (known, removed) or 'dead' (inside a removed block)
+        stack = []
+        for line in txt.split('\n'):
+            emit = all(frame[0] == 'keep' or frame[1] for frame in stack)
+            match = re.match(r'^\s*#\s*(if|ifdef|ifndef|elif|else|endif)\b(.*?)\s*(//.*)?$', line)
+            if match is None:
+                if emit:
+                    lines.append(line)
+                continue
+            directive, expression = match.group(1), match.group(2).strip()
+            if directive in ('if', 'ifdef', 'ifndef'):
+                if not emit:
+                    stack.append(['dead', False, True])
+                    continue
+                result = evaluate(directive, expression)
+                if result is None:
+                    stack.append(['keep', True, False])
+                    lines.append(line)
+                else:
+                    stack.append(['eval', result, result])
+                continue
+            if not stack:
+                lines.append(line)
+                continue
+            frame = stack[-1]
+            if directive == 'endif':
+                stack.pop()
+                if frame[0] == 'keep':
+                    lines.append(line)
+            elif frame[0] == 'keep':
+                lines.append(line)
+            elif frame[0] == 'eval':
+                if directive == 'else':
+                    frame[1] = not frame[2]
+                    frame[2] = True
+                elif frame[2]:
+                    frame[1] = False
+                else:
+                    result = evaluate('if', expression)
+                    if result is None:
+                        # the rest is up to the driver
+                        stack[-1] = ['keep', True, False]
+                        lines.append(line.replace('elif', 'if', 1))
+                    else:
+                        frame[1] = result
+                        frame[2] = result
+        return '\n'.join(lines)
+
+    def pinShader(self, v_shader, f_shader, define=None, pin=True, version='#version 140'):
+        """
+        Pinned shader variants are never removed from the shader_cache
+        """
+        key = self.getShaderKey(v_shader, f_shader, define, version)
+        if pin:
+            self.pinned_shaders.add(key)
+        else:
+            self.pinned_shaders.discard(key)
+
+    def _evictShaders(self):
+        """
+        Removes the least recently used shaders if there are more than
+        shader_cache_size in the shader_cache, pinned shaders stay
+        (see pinShader()). This only bounds the loader's own bookkeeping,
+        Panda keeps every Shader made with Shader.make() in its own table
+        and nodes using an evicted shader keep it (and its compiled program),
+        so no memory is freed. Loading an evicted variant again reads and
+        strips its source again (counted as a 'reload')
+        """
+        if len(self.shader_cache) <= self.shader_cache_size:
+            return
+        for key in list(self.shader_cache):
+            if len(self.shader_cache) <= self.shader_cache_size:
+                break
+            if key in self.pinned_shaders:
+                continue
+            del self.shader_cache[key]
+            self.evicted_shaders.add(key)
+            self.shader_cache_stats['evictions'] += 1
+
+    def getShaderCacheStats(self):
+        """
+        Returns a dict with the hits, misses, reloads (misses on variants
+        that were evicted, see _evictShaders()), evictions, disk_hits (misses
+        found in the model cache, see readCachedShader()), load_time
+        (seconds spent reading the sources and making Shader objects on a miss,
+        the driver compiles them later when they are first drawn or prepared),
+        and the number of resident and pinned variants
+        """
+        stats = dict(self.shader_cache_stats)
+        stats['resident'] = len(self.shader_cache)
+        stats['pinned'] = len(self.pinned_shaders)
+        return stats
+
+    def resetShaderCacheStats(self):
+        """
+        Sets the hit, miss, reload, eviction, disk hit and time counters back to zero
+        """
+        self.shader_cache_stats = {'hits': 0, 'misses': 0, 'reloads': 0, 'evictions': 0,
+                                   'disk_hits': 0, 'load_time': 0.0}
+
+    def readShaderSource(self, path):
+        """
+        Returns the text of a shader file (or of a shader added with addShaderSource)
+        """
+        with self.shader_source_lock:
+            if path in self.shader_sources:
+                return self.shader_sources[path]
+        with open(getModelPath().findFile(path).toOsSpecific()) as f:
+            return f.read()
+
+    def addShaderSource(self, path, source):
+        """
+        Adds a generated shader, loadShaderGLSL() will use the source
+        as if it was loaded from the given path
+        """
+        with self.shader_source_lock:
+            self.shader_sources[path] = source
+            self.shader_fragments.pop(path, None)
+            for key in list(self.shader_words):
+                if path in key:
+                    del self.shader_words[key]
+
     def loadShader(self, shaderPath, okMissing=False):
         return self.original_loader.loadShader(shaderPath, okMissing)
 
@@ -1129,6 +3950,94 @@ class WrappedLoader(object):
 # light classes:
 
 
+class SunLight(object):
+    """
+    Sun light (directional light with cascaded shadow maps) for the deferred renderer.
+    Remember to keep a reference to the light instance
+    the light will be removed by the garbage collector when it goes out of scope.
+
+    direction - vector pointing at the sun
+    cascades - number of shadow maps, split along the view of base.cam
+    split_lambda - 0.0 even splits, 1.0 logarithmic splits (more detail up close)
+    shadow_distance - how far from the camera shadows are drawn (None=camera far)
+    far_update_interval - cascades other than the first two are only rendered every N frames
+
+    It is recomended to use properties to configure the light after creation eg.
+    l=SunLight(...)
+    l.color=(r,g,b)
+    l.direction=Vec3(...)
+    """
+
+    def __init__(self, color, direction, shadow_size=1024, cascades=4, split_lambda=0.75,
+                 shadow_distance=None, offset=100.0, far_update_interval=4, bias=0.0005):
+        if not hasattr(builtins, 'deferred_renderer'):
+            raise RuntimeError('You need a DeferredRenderer')
+        self.__color = color
+        self.__direction = Vec3(*direction)
+        self.sun = deferred_renderer.add_sun_light(color=color,
+                                                   direction=direction,
+                                                   shadow_size=shadow_size,
+                                                   cascades=cascades,
+                                                   split_lambda=split_lambda,
+                                                   shadow_distance=shadow_distance,
+                                                   offset=offset,
+                                                   far_update_interval=far_update_interval,
+                                                   bias=bias)
+
+    def set_color(self, color):
+        """
+        Sets light color
+        """
+        self.sun['model'].set_shader_input('sun_color', Vec3(*color))
+        self.__color = color
+
+    def set_direction(self, direction):
+        """
+        Sets light direction (vector pointing at the sun)
+        """
+        deferred_renderer.set_sun_direction(self.sun, direction)
+        self.__direction = Vec3(*direction)
+
+    def set_shadow_distance(self, distance):
+        """
+        Sets how far from the camera shadows are drawn (None=camera far)
+        """
+        self.sun['shadow_distance'] = distance
+        self.sun['dirty'] = True
+
+    def set_split_lambda(self, split_lambda):
+        """
+        Sets how the cascades are split, 0.0 even splits, 1.0 logarithmic splits
+        """
+        self.sun['split_lambda'] = split_lambda
+        self.sun['dirty'] = True
+
+    def remove(self):
+        deferred_renderer.remove_sun_light(self.sun)
+
+    def __del__(self):
+        try:
+            self.remove()
+        except:
+            pass
+
+    @property
+    def color(self):
+        return self.__color
+
+    @color.setter
+    def color(self, c):
+        self.set_color(c)
+
+    @property
+    def direction(self):
+        return self.__direction
+
+    @direction.setter
+    def direction(self, d):
+        self.set_direction(d)
+
+
 class SceneLight(object):
     """
     Directional light(s) for the deferred renderer
@@ -1136,6 +4045,8 @@ class SceneLight(object):
     it's not very logical to have multiple SceneLights, but you can have multiple
     directional lights as part of one SceneLight instance.
     You can add and remove additional lights using add_light() and remove_light()
+    The lights are written in place into arrays shared with the dir_light shader,
+    so changing them is cheap and never recompiles shaders.
     This class curently has no properies access :(
     """
 
@@ -1145,38 +4056,34 @@ class SceneLight(object):
         self.__color = {}
         self.__direction = {}
         self.__shadow_size = {}
+        # names of the lights in the order they are in the shader arrays
+        self.__names = []
         self.main_light_name = main_light_name
         if color and direction:
             self.add_light(color=color, direction=direction,
                            name=main_light_name, shadow_size=shadow_size)
 
+    def _write_light(self, name):
+        index = self.__names.index(name)
+        deferred_renderer.set_directional_light(self.__color[name],
+                                                self.__direction[name],
+                                                self.__shadow_size[name],
+                                                index)
+
     def add_light(self, color, direction, name, shadow_size=0):
         """
         Adds a directional light to this SceneLight
         """
-        if len(self.__color) == 0:
-            deferred_renderer.set_directional_light(
-                color, direction, shadow_size)
-            self.__color[name] = Vec3(color)
-            self.__direction[name] = Vec3(*direction)
-            self.__shadow_size[name] = shadow_size
-        else:
-            self.__color[name] = Vec3(color)
-            self.__direction[name] = Vec3(direction)
-            self.__shadow_size[name] = shadow_size
-            num_lights = len(self.__color)
-            colors = PTALVecBase3f()
-            for v in self.__color.values():
-                colors.push_back(v)
-            directions = PTALVecBase3f()
-            for v in self.__direction.values():
-                directions.push_back(v)
-            deferred_renderer.set_filter_define(
-                'final_light', 'NUM_LIGHTS', num_lights)
-            deferred_renderer.set_filter_input(
-                'final_light', 'light_color', colors)
-            deferred_renderer.set_filter_input(
-                'final_light', 'direction', directions)
+        if name not in self.__names:
+            if len(self.__names) >= deferred_renderer.max_dir_lights:
+                raise RuntimeError('Only {0} directional lights supported'.format(
+                    deferred_renderer.max_dir_lights))
+            self.__names.append(name)
+        self.__color[name] = Vec3(*color)
+        self.__direction[name] = Vec3(*direction)
+        self.__shadow_size[name] = shadow_size
+        self._write_light(name)
+        deferred_renderer.set_directional_light_count(len(self.__names))
 
     def remove_light(self, name=None):
         """
@@ -1189,29 +4096,13 @@ class SceneLight(object):
             del self.__color[name]
             del self.__direction[name]
             del self.__shadow_size[name]
-            if len(self.__color) == 0:
-                deferred_renderer.set_directional_light(
-                    (0, 0, 0), (0, 0, 0), 0)
-            elif len(self.__color) == 1:
-                deferred_renderer.set_filter_define(
-                    'final_light', 'NUM_LIGHTS', None)
-                last_name = self.__color.keys()[0]
-                deferred_renderer.set_directional_light(self.__color[last_name], self.__direction[
-                    last_name], self.__shadow_size[last_name])
-            else:
-                num_lights = len(self.__color)
-                colors = PTALVecBase3f()
-                for v in self.__color.values():
-                    colors.push_back(v)
-                directions = PTALVecBase3f()
-                for v in self.__direction.values():
-                    directions.push_back(v)
-                deferred_renderer.set_filter_define(
-                    'final_light', 'NUM_LIGHTS', num_lights)
-                deferred_renderer.set_filter_input(
-                    'final_light', 'light_color', colors)
-                deferred_renderer.set_filter_input(
-                    'final_light', 'direction', directions)
+            # move the last light into the free slot
+            index = self.__names.index(name)
+            last_name = self.__names.pop()
+            if last_name != name:
+                self.__names[index] = last_name
+                self._write_light(last_name)
+            deferred_renderer.set_directional_light_count(len(self.__names))
             return True
         return False
 
@@ -1221,16 +4112,8 @@ class SceneLight(object):
         """
         if name is None:
             name = self.main_light_name
-        self.__color[name] = color
-        if len(self.__color) == 1:
-            deferred_renderer.set_directional_light(
-                color, self.__direction[name], self.__shadow_size[name])
-        else:
-            colors = PTALVecBase3f()
-            for v in self.__color.values():
-                colors.push_back(v)
-            deferred_renderer.set_filter_input(
-                    'final_light', 'light_color', colors)
+        self.__color[name] = Vec3(*color)
+        self._write_light(name)
 
     def set_direction(self, direction, name=None):
         """
@@ -1238,20 +4121,15 @@ class SceneLight(object):
         """
         if name is None:
             name = self.main_light_name
-        self.__direction[name] = direction
-        if len(self.__color) == 1:
-            deferred_renderer.set_directional_light(
-                self.__color[name], direction, self.__shadow_size[name])
-        else:
-            directions = PTALVecBase3f()
-            for v in self.__direction.values():
-                directions.push_back(v)
-            deferred_renderer.set_filter_input(
-                    'final_light', 'direction', directions)
+        self.__direction[name] = Vec3(*direction)
+        self._write_light(name)
 
     def remove(self):
-        deferred_renderer.set_filter_define('final_light', 'NUM_LIGHTS', None)
-        deferred_renderer.set_directional_light((0, 0, 0), (0, 0, 0), 0)
+        self.__color = {}
+        self.__direction = {}
+        self.__shadow_size = {}
+        self.__names = []
+        deferred_renderer.set_directional_light_count(0)
 
     def __del__(self):
         try:
@@ -1267,6 +4145,9 @@ class SphereLight(object):
     remember to keep a reference to the light instance
     the light will be removed by the garbage collector when it goes out of scope
 
+    Lights without shadows are all drawn in one instanced draw call,
+    lights with shadows get their own geometry (self.geom) and light (self.p3d_light)
+
     It is recomended to use properties to configure the light after creation eg.
     l=SphereLight(...)
     l.pos=Point3(...)
@@ -1279,54 +4160,106 @@ class SphereLight(object):
             raise RuntimeError('You need a DeferredRenderer')
         self.__radius = radius
         self.__color = color
+        self.__pos = Point3(*pos)
         self.light_id=None
+        self.instance_id=None
+        self.geom=None
+        self.p3d_light=None
+        self.shadow_bias=shadow_bias
+        self.__fade = 1.0
+        self.__shadow_fade = 1.0
         if shadow_size is None:
             shadow_size=deferred_renderer.shadow_size
-        self.geom, self.p3d_light = deferred_renderer.add_point_light(color=color,
-                                                                      model="models/sphere",
-                                                                      pos=pos,
-                                                                      radius=radius,
-                                                                      shadow_size=shadow_size)
-        self.set_shadow_bias(shadow_bias)
+        self._make_light(shadow_size)
+        deferred_renderer.light_manager.add_light(self)
+
+    def _make_light(self, shadow_size):
+        if shadow_size > 0:
+            self.geom, self.p3d_light = deferred_renderer.add_point_light(color=self.__color,
+                                                                          model="models/sphere",
+                                                                          pos=self.__pos,
+                                                                          radius=self.__radius,
+                                                                          shadow_size=shadow_size)
+            self.set_shadow_bias(self.shadow_bias)
+        else:
+            self.instance_id=deferred_renderer.add_instanced_point_light(color=self.__color,
+                                                                         pos=self.__pos,
+                                                                         radius=self.__radius)
+        self._apply_fade()
+
+    def _apply_fade(self):
+        """
+        Applies the fade set by the LightManager to the color of the light
+        """
+        color = Vec3(*self.__color) * self.__fade
+        if self.instance_id is not None:
+            # a radius of 0 hides the light
+            radius = self.__radius if self.__fade > 0.0 else 0.0
+            deferred_renderer.set_instanced_point_light(self.instance_id, color=color, radius=radius)
+        elif self.geom is not None:
+            self.geom.set_shader_input('light', Vec4(color, self.__radius * self.__radius))
+            self.geom.set_shader_input('shadow_fade', self.__shadow_fade)
+            if self.__fade > 0.0:
+                self.geom.show()
+            else:
+                self.geom.hide()
+            deferred_renderer.suspend_shadow(self.p3d_light, self.__fade == 0.0 or self.__shadow_fade == 0.0)
+
+    def _set_lod_fade(self, fade, shadow_fade):
+        self.__fade = fade
+        self.__shadow_fade = shadow_fade
+        self._apply_fade()
+
+    def _get_lod_values(self):
+        return self.__pos, self.__radius, max(self.__color)
+
+    def _remove_light(self):
+        if self.instance_id is not None:
+            deferred_renderer.remove_instanced_point_light(self.instance_id)
+            self.instance_id=None
+        if self.geom is not None:
+            self.geom.remove_node()
+            deferred_renderer.remove_shadow_caster(self.p3d_light)
+            self.p3d_light.remove_node()
+            self.geom=None
+            self.p3d_light=None
 
     def attach_to(self, node, offset=(0,0,0)):
-        self.light_id=len(deferred_renderer.attached_lights)
-        deferred_renderer.attached_lights[self.light_id]=(node, self, Point3(*offset))
+        """
+        Makes the light follow the node, offset is relative to the node
+        """
+        self.detach()
+        self.light_id=deferred_renderer.attach_light(self, node, offset)
 
     def detach(self):
-        if self.light_id:
-            del deferred_renderer.attached_lights[self.light_id]
+        if self.light_id is not None:
+            deferred_renderer.detach_light(self.light_id)
+            self.light_id=None
+
+    def _move_to(self, pos):
+        """
+        Used to move attached lights, instanced lights only have the pos stored
+        and the instance_id is returned so the renderer can write all of them at once
+        """
+        if self.instance_id is not None:
+            self.__pos = Point3(*pos)
+            return self.instance_id
+        self.set_pos(Point3(*pos))
+        return None
 
     def set_shadow_size(self, size):
-        if size >0:
-            self.p3d_light.node().set_shadow_caster(True, size, size)
-            self.p3d_light.node().set_camera_mask(BitMask32.bit(13))
-            for i in range(6):
-                self.p3d_light.node().get_lens(i).set_near_far(0.1, self.__radius)
-                self.p3d_light.node().get_lens(i).make_bounds()
-
-            shader=loader.load_shader_GLSL(deferred_renderer.v.format('point_light_shadow'),
-                                           deferred_renderer.f.format('point_light_shadow'),
-                                           deferred_renderer.shading_setup)
-            self.geom.set_shader(shader)
-            self.geom.set_shader_input('shadowcaster', self.p3d_light)
-            self.set_shadow_bias(self.shadow_bias)
-        else:
-            self.p3d_light.node().set_shadow_caster(False)
-            shader=loader.load_shader_GLSL(deferred_renderer.v.format('point_light'),
-                                           deferred_renderer.f.format('point_light'),
-                                           deferred_renderer.shading_setup)
-            self.geom.set_shader(shader)
-            try:
-                buff = self.p3d_light.node().get_shadow_buffer(base.win.get_gsg())
-                buff.clear_render_textures()
-                base.win.get_gsg().get_engine().remove_window(buff)
-            except:
-                pass
+        """
+        Sets the size of the shadow map,
+        a size of 0 turns the shadows off and moves the light to the instanced buffer
+        """
+        if size > 0 or self.instance_id is None:
+            # the shadow map tiles are allocated when the light is made
+            self._remove_light()
+            self._make_light(size)
 
     def set_shadow_bias(self, bias):
         self.shadow_bias=bias
-        if bias is not None:
+        if bias is not None and self.geom is not None:
             self.geom.set_shader_input("bias", bias)
 
 
@@ -1334,29 +4267,33 @@ class SphereLight(object):
         """
         Sets light color
         """
-        self.geom.set_shader_input("light", Vec4(
-            color, self.__radius * self.__radius))
         self.__color = color
+        self._apply_fade()
 
     def set_radius(self, radius):
         """
         Sets light radius
         """
-        self.geom.set_shader_input("light", Vec4(self.__color, radius * radius))
-        self.geom.set_scale(radius)
         self.__radius = radius
+        self._apply_fade()
+        if self.instance_id is not None:
+            return
+        self.geom.set_scale(radius)
         try:
             for i in range(6):
                 self.p3d_light.node().get_lens(i).set_near_far(0.1, radius)
         except:
             pass
+        deferred_renderer.mark_shadow_dirty(self.p3d_light)
 
     def set_pos(self, *args):
         """
         Sets light position,
         you can pass in a NodePath as the first argument to make the pos relative to that node
         """
-        if self.geom.is_empty():
+        if self.geom is None and self.instance_id is None:
+            return
+        if self.geom is not None and self.geom.is_empty():
             return
         if len(args) < 1:
             return
@@ -1371,33 +4308,31 @@ class SphereLight(object):
                 args[0], Vec3(args[0], args[1], args[2]))
         else:  # something ???
             pos = Vec3(args[0], args[1], args[2])
+        moved = self.__pos != pos
+        self.__pos = Point3(pos)
+        if self.instance_id is not None:
+            deferred_renderer.set_instanced_point_light(self.instance_id, pos=pos)
+            return
         #self.geom.setShaderInput("light_pos", Vec4(pos, 1.0))
         self.geom.set_pos(render, pos)
         self.p3d_light.set_pos(render, pos)
+        if moved:
+            deferred_renderer.mark_shadow_dirty(self.p3d_light)
 
     def remove(self):
-        self.geom.remove_node()
-        try:
-            buff = self.p3d_light.node().get_shadow_buffer(base.win.get_gsg())
-            buff.clear_render_textures()
-            base.win.get_gsg().get_engine().remove_window(buff)
-            self.p3d_light.node().set_shadow_caster(False)
-        except:
-            pass
-        if self.light_id and self.light_id in deferred_renderer.attached_lights:
-            del deferred_renderer.attached_lights[self.light_id]
-        self.p3d_light.remove_node()
+        self._remove_light()
+        deferred_renderer.light_manager.remove_light(self)
+        self.detach()
 
     def __del__(self):
         try:
-            if not self.geom.is_empty():
-                self.remove()
+            self.remove()
         except:
             pass
 
     @property
     def pos(self):
-        return self.geom.get_pos(render)
+        return Point3(self.__pos)
 
     @pos.setter
     def pos(self, p):
@@ -1465,6 +4400,38 @@ class ConeLight(object):
                                                                      fov=fov,
                                                                      shadow_size=shadow_size,
                                                                      bias=bias)
+        self.__fade = 1.0
+        self.__shadow_fade = 1.0
+        self.geom.set_shader_input('shadow_fade', 1.0)
+        deferred_renderer.light_manager.add_light(self)
+
+    def _apply_fade(self):
+        """
+        Applies the fade set by the LightManager to the color of the light
+        """
+        self.p3d_light.node().set_color(Vec4(Vec3(*self.__color) * self.__fade, 1.0))
+        self.geom.set_shader_input('shadow_fade', self.__shadow_fade)
+        if self.__fade > 0.0:
+            self.geom.show()
+        else:
+            self.geom.hide()
+        deferred_renderer.suspend_shadow(self.p3d_light, self.__fade == 0.0 or self.__shadow_fade == 0.0)
+
+    def _set_lod_fade(self, fade, shadow_fade):
+        self.__fade = fade
+        self.__shadow_fade = shadow_fade
+        self._apply_fade()
+
+    def _get_lod_values(self):
+        return Point3(*self.__pos), self.__radius, max(self.__color)
+
+    def set_color(self, color):
+        """
+        Sets light color
+        """
+        self.__color = color
+        self._apply_fade()
+
     def set_exponent(self, exponent):
         self.p3d_light.node().set_exponent(exponent)
 
@@ -1477,6 +4444,7 @@ class ConeLight(object):
         if fov > 179.0:
             fov = 179.0
         self.p3d_light.node().get_lens().set_fov(fov)
+        deferred_renderer.mark_shadow_dirty(self.p3d_light)
         # we might as well start from square 1...
         self.geom.remove_node()
         xy_scale = math.tan(deg2Rad(fov * 0.5))
@@ -1489,12 +4457,19 @@ class ConeLight(object):
         self.geom.set_hpr(self.__hpr)
         self.geom.set_attrib(DepthTestAttrib.make(RenderAttrib.MLess))
         self.geom.set_attrib(CullFaceAttrib.make(
-            set_attrib.MCullCounterClockwise))
+            CullFaceAttrib.MCullCounterClockwise))
         self.geom.setAttrib(ColorBlendAttrib.make(
-            set_attrib.MAdd, ColorBlendAttrib.OOne, ColorBlendAttrib.OOne))
+            ColorBlendAttrib.MAdd, ColorBlendAttrib.OOne, ColorBlendAttrib.OOne))
         self.geom.set_attrib(DepthWriteAttrib.make(DepthWriteAttrib.MOff))
-        self.geom.set_shader(loader.loadShaderGLSL(deferred_renderer.v.format(
-            'spot_light'), deferred_renderer.f.format('spot_light'), deferred_renderer.shading_setup))
+        record = deferred_renderer.shadow_casters.get(self.p3d_light)
+        if record:
+            self.geom.set_shader(loader.loadShaderGLSL(deferred_renderer.v.format(
+                'spot_light_shadow'), deferred_renderer.f.format('spot_light_shadow'), deferred_renderer.shading_setup))
+            self.geom.set_shader_input('shadow_tile', deferred_renderer.shadow_atlas.get_tile_uv(record['tiles'][0]))
+            self.set_shadow_bias(self.__shadow_bias)
+        else:
+            self.geom.set_shader(loader.loadShaderGLSL(deferred_renderer.v.format(
+                'spot_light'), deferred_renderer.f.format('spot_light'), deferred_renderer.shading_setup))
         try:
             self.geom.set_shader_inputs(light_radius= float(self.__radius),
                                     light_pos= Vec4(self.__pos, 1.0),
@@ -1506,6 +4481,7 @@ class ConeLight(object):
             self.geom.set_shader_input('light_fov', deg2Rad(fov))
             self.geom.set_shader_input('spot', self.p3d_light)
         self.__fov = fov
+        self._apply_fade()
 
     def set_radius(self, radius):
         """
@@ -1518,6 +4494,7 @@ class ConeLight(object):
             self.p3d_light.node().get_lens().set_near_far(0.1, radius)
         except:
             pass
+        deferred_renderer.mark_shadow_dirty(self.p3d_light)
 
     def setHpr(self, hpr):
         """
@@ -1525,7 +4502,8 @@ class ConeLight(object):
         """
         self.geom.set_hpr(hpr)
         self.p3d_light.set_hpr(hpr)
-        self.__hpr = hrp
+        self.__hpr = hpr
+        deferred_renderer.mark_shadow_dirty(self.p3d_light)
 
     def set_pos(self, *args):
         """
@@ -1547,6 +4525,8 @@ class ConeLight(object):
             pos = Vec3(args[0], args[1], args[2])
         self.geom.set_pos(pos)
         self.p3d_light.set_pos(pos)
+        if Vec3(*self.__pos) != pos:
+            deferred_renderer.mark_shadow_dirty(self.p3d_light)
         self.__pos = pos
 
     def lookAt(self, node_or_pos):
@@ -1562,6 +4542,7 @@ class ConeLight(object):
         self.geom.look_at(node_or_pos)
         self.p3d_light.look_at(node_or_pos)
         self.__hpr = self.p3d_light.get_hpr(render)
+        deferred_renderer.mark_shadow_dirty(self.p3d_light)
 
     def set_shadow_bias(self, bias):
         self.__shadow_bias=bias
@@ -1570,13 +4551,8 @@ class ConeLight(object):
 
     def remove(self):
         self.geom.removeNode()
-        try:
-            buff = self.p3d_light.node().get_shadow_buffer(base.win.get_gsg())
-            buff.clear_render_textures()
-            base.win.get_gsg().get_engine().remove_window(buff)
-            self.p3d_light.node().set_shadow_caster(False)
-        except:
-            pass
+        deferred_renderer.remove_shadow_caster(self.p3d_light)
+        deferred_renderer.light_manager.remove_light(self)
         self.p3d_light.remove_node()
 
     def __del__(self):
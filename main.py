@@ -27,9 +27,7 @@ config_full={'shadows': 1024,
                             'size': 0.5,
                             'name': 'ao',
                             'shader': 'blur'},
-                            {'inputs': {'direction': LVector3f(0, 0, 0),
-                            'ambient': LVector3f(0.02, 0.01, 0.01),
-                            'light_color': LVector3f(0, 0, 0)},
+                            {'inputs': {'ambient': LVector3f(0.02, 0.01, 0.01)},
                             'name': 'final_light',
                             'shader': 'dir_light'},
                             {'inputs': {'desat': 0.2, 'scale': 10.0, 'power': 2.0},
@@ -8,10 +8,11 @@ from panda3d.core import *
 
 class Options():
     def __init__(self, config_file):
-        self.preset, self.setup, self.shadows_size=self._read_graphics_config(config_file)
+        self.preset, self.setup, self.shadows_size, self.atlas_size=self._read_graphics_config(config_file)
 
     def get(self):
-        return {'filter_setup':self.preset, 'shading_setup':self.setup, 'shadows':self.shadows_size}
+        return {'filter_setup':self.preset, 'shading_setup':self.setup, 'shadows':self.shadows_size,
+                'shadow_atlas_size':self.atlas_size}
 
     def _encode_ini_value(self, var):
         var_type=type(var)
@@ -42,10 +43,12 @@ class Options():
             except ValueError:
                 return var
 
-    def write_graphics_config(self, preset, shadows, setup, config_file):
+    def write_graphics_config(self, preset, shadows, setup, config_file, atlas_size=None):
         cfg=configparser.ConfigParser()
         cfg.add_section('SHADOWS')
         cfg.set('SHADOWS', 'size', str(shadows))
+        if atlas_size is not None:
+            cfg.set('SHADOWS', 'atlas_size', str(atlas_size))
         cfg.add_section('SETUP')
         for name, value in setup.items():
             cfg.set('SETUP', str(name), str(value))
@@ -63,10 +66,11 @@ class Options():
         except Exception as err:
             print('error reading config file', config_file)
             print(err)
-            return None, None
+            return None, None, None, None
         preset=[x for x in gfx_config.sections() if x  not in ('SETUP','SHADOWS')]
         setup={}
         shadows_size=256
+        atlas_size=4096
         for section in gfx_config.sections():
             section_dict={}
             for option in gfx_config.options(section):
@@ -84,13 +88,17 @@ class Options():
 
                             inputs[key]=self._decode_ini_value(value)
                     section_dict[option]=inputs
+                elif option == 'format':
+                    section_dict[option]=gfx_config.get(section, option).strip().lower()
                 else:
                     section_dict[option]=self._decode_ini_value(gfx_config.get(section, option))
             if section == 'SETUP':
                 setup={key.upper():value for key, value in section_dict.items()}
             elif section == 'SHADOWS':
                 shadows_size=section_dict['size']
+                if 'atlas_size' in section_dict:
+                    atlas_size=section_dict['atlas_size']
             else:
                 preset[int(section)]=section_dict
-        return preset, setup, shadows_size
+        return preset, setup, shadows_size, atlas_size
 
@@ -0,0 +1,61 @@
+//GLSL
+#version 140
+uniform sampler2D low_tex;
+uniform sampler2D depth_tex;
+uniform sampler2D normal_tex;
+uniform mat4 trans_apiclip_of_camera_to_apiview_of_camera;
+
+in vec2 uv;
+
+#ifndef DEPTH_WEIGHT
+#define DEPTH_WEIGHT 32.0
+#endif
+#ifndef NORMAL_POWER
+#define NORMAL_POWER 8.0
+#endif
+
+#include "include/octahedron.glsl"
+
+// Distance from the camera (view space depth)
+float get_view_depth(vec2 tex_uv)
+    {
+    float depth = texture(depth_tex, tex_uv).r;
+    vec4 view_pos = trans_apiclip_of_camera_to_apiview_of_camera * vec4(tex_uv*2.0-1.0, depth*2.0-1.0, 1.0);
+    return abs(view_pos.z/view_pos.w);
+    }
+
+void main()
+    {
+    // the 4 low res pixels around this pixel
+    vec2 low_size = vec2(textureSize(low_tex, 0).xy);
+    vec2 pos = uv*low_size-0.5;
+    vec2 base = floor(pos);
+    vec2 f = pos-base;
+
+    float depth = get_view_depth(uv);
+    vec3 normal = unpack_normal_octahedron(texture(normal_tex, uv).xy);
+
+    vec4 color = vec4(0.0);
+    float total = 0.0;
+    for (int i = 0; i < 4; ++i)
+        {
+        vec2 offset = vec2(i%2, i/2);
+        vec2 sample_uv = (base+offset+0.5)/low_size;
+        // bilinear weight, lower if the depth or normal is not the same
+        vec2 bilinear = mix(1.0-f, f, offset);
+        float weight = bilinear.x*bilinear.y;
+        weight /= 1.0+abs(depth-get_view_depth(sample_uv))/depth*DEPTH_WEIGHT;
+        vec3 sample_normal = unpack_normal_octahedron(texture(normal_tex, sample_uv).xy);
+        weight *= pow(max(dot(normal, sample_normal), 0.0), NORMAL_POWER);
+        color += texture(low_tex, sample_uv)*weight;
+        total += weight;
+        }
+    if (total < 0.0001)
+        {
+        gl_FragData[0] = texture(low_tex, uv);
+        }
+    else
+        {
+        gl_FragData[0] = color/total;
+        }
+    }
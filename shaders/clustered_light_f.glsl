@@ -0,0 +1,95 @@
+//GLSL
+#version 140
+#ifndef CLUSTER_X
+#define CLUSTER_X 16
+#endif
+#ifndef CLUSTER_Y
+#define CLUSTER_Y 9
+#endif
+#ifndef CLUSTER_Z
+#define CLUSTER_Z 24
+#endif
+uniform mat4 p3d_ProjectionMatrixInverse;
+uniform mat4 p3d_ViewMatrix;
+uniform sampler2D albedo_tex;
+uniform sampler2D normal_tex;
+uniform sampler2D depth_tex;
+// the part of the model buffer in use (see set_dynamic_resolution())
+uniform vec2 model_viewport;
+// two texels per light, same layout as for point_light_instanced
+uniform samplerBuffer light_data;
+// offset and count into cluster_index for each cluster
+uniform samplerBuffer cluster_grid;
+// light numbers, sorted by cluster
+uniform samplerBuffer cluster_index;
+// near and far of the camera used to slice the clusters
+uniform vec2 cluster_near_far;
+
+#include "include/octahedron.glsl"
+
+#include "include/position.glsl"
+
+#include "include/specular.glsl"
+
+void main()
+    {
+    vec2 win_size=textureSize(depth_tex, 0).xy;
+    vec2 uv=gl_FragCoord.xy/win_size;
+    // the textures are read with uv, the position needs uv in 0-1 range
+    vec2 screen_uv=uv/model_viewport;
+
+    float depth=texture(depth_tex,uv).r * 2.0 - 1.0;
+    vec3 view_pos =getPosition(screen_uv, depth);
+
+    //find the cluster
+    float view_depth=-view_pos.z;
+    if (view_depth < cluster_near_far.x || view_depth > cluster_near_far.y)
+        discard;
+    int slice=int(log(view_depth/cluster_near_far.x)/log(cluster_near_far.y/cluster_near_far.x)*float(CLUSTER_Z));
+    ivec2 tile=ivec2(screen_uv*vec2(CLUSTER_X, CLUSTER_Y));
+    slice=clamp(slice, 0, CLUSTER_Z-1);
+    tile=clamp(tile, ivec2(0), ivec2(CLUSTER_X-1, CLUSTER_Y-1));
+    vec2 offset_count=texelFetch(cluster_grid, (slice*CLUSTER_Y+tile.y)*CLUSTER_X+tile.x).xy;
+    int offset=int(offset_count.x);
+    int count=int(offset_count.y);
+    if (count == 0)
+        discard;
+
+    vec4 color_tex=texture(albedo_tex, uv);
+    vec3 albedo=color_tex.rgb;
+    vec4 normal_roughness_metallic=texture(normal_tex,uv);
+    vec3 N=unpack_normal_octahedron(normal_roughness_metallic.xy);
+    float roughness =pow(normal_roughness_metallic.b, 0.5);
+    float base_roughness =normal_roughness_metallic.b;
+    float metallic=normal_roughness_metallic.a;
+    float gloss=350.0*(1.0-roughness);
+    albedo =mix(albedo, vec3(0.0), metallic);
+
+    vec3 color=vec3(0.0);
+    vec3 spec=vec3(0.0);
+    vec3 V=normalize(-view_pos.xyz);
+
+    for (int i=0; i<count; ++i)
+        {
+        int light_id=int(texelFetch(cluster_index, offset+i).r);
+        vec4 pos_radius=texelFetch(light_data, light_id*2);
+        vec3 light_color=texelFetch(light_data, light_id*2+1).rgb;
+        vec3 light_pos=vec4(p3d_ViewMatrix * vec4(pos_radius.xyz, 1.0)).xyz;
+
+        vec3 L=normalize(light_pos-view_pos.xyz);
+        vec3 H = normalize(V+L);
+        float NdotH= max(0.0,dot( N, H));
+        float NdotL=max(0.0,dot( N, L));
+        float attenuation=1.0-(pow(distance(view_pos.xyz, light_pos), 2.0)/(pos_radius.w*pos_radius.w));
+        attenuation=pow(max(0.0, attenuation), 3.0);
+        //diffuse
+        color+=light_color*NdotL*attenuation;
+        //specular
+        spec+=do_specular(roughness, color_tex.rgb, metallic, NdotH, gloss, base_roughness)*light_color*attenuation;
+        }
+
+    float bloom = dot(spec, vec3(1.0))*0.33*0.5;
+    vec4 final=vec4((color*albedo)+spec, bloom);
+
+    gl_FragData[0]=final;
+    }
@@ -0,0 +1,9 @@
+//GLSL
+#version 140
+in vec4 p3d_Vertex;
+
+void main()
+    {
+    //fullscreen quad made with CardMaker, in the xz plane
+    gl_Position = vec4(p3d_Vertex.xz, 0.0, 1.0);
+    }
@@ -6,55 +6,20 @@ uniform sampler2D albedo_tex;
 uniform sampler2D lit_tex;
 uniform mat4 p3d_ProjectionMatrixInverse;
 uniform vec3 ambient;
-#ifndef NUM_LIGHTS
-uniform vec3 light_color;
-uniform vec3 direction;
-in vec4 light_direction;
-#endif
-#ifdef NUM_LIGHTS
-uniform vec3 light_color [NUM_LIGHTS];
-uniform vec3 direction [NUM_LIGHTS];
-in vec4 light_direction[NUM_LIGHTS];
-#endif
+// MAX_DIR_LIGHTS is set by the renderer (see _setup_directional_lights())
+uniform vec3 dir_light_color [MAX_DIR_LIGHTS];
+uniform int num_dir_lights;
+in vec4 light_direction[MAX_DIR_LIGHTS];
 
 
 //in vec2 uv;
 
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
+#include "include/octahedron.glsl"
 
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    if (packed_nrm==vec2(0.0))
-        {
-            return vec3(0.0);
-        }
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+#include "include/position.glsl"
 
-vec3 getPosition(vec2 uv, float depth)
-    {
-    vec4 view_pos = p3d_ProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
-    view_pos.xyz /= view_pos.w;
-    return view_pos.xyz;
-    }
-
-vec3 do_specular(float roughness, vec3 tint,
-                 float metallic, float NdotH,
-                 float gloss, float base_roughness)
-    {
-    return mix(vec3(1.0-roughness), tint, metallic) * pow(NdotH, gloss)*(1.0-base_roughness+metallic);
-    }
+#include "include/specular.glsl"
 
 void main()
     {
@@ -65,7 +30,7 @@ void main()
     vec4 color_tex=texture(albedo_tex, uv);
     vec3 albedo=color_tex.rgb;
     vec4 normal_roughness_metallic=texture(normal_tex,uv);
-    vec3 N=unpack_normal_octahedron(normal_roughness_metallic.xy);
+    vec3 N=unpack_normal_or_zero(normal_roughness_metallic.xy);
     float roughness =pow(normal_roughness_metallic.b, 0.5);
     float base_roughness =normal_roughness_metallic.b;
     float metallic=normal_roughness_metallic.a;
@@ -86,8 +51,10 @@ void main()
     float NdotL;
 
 
-    #ifndef NUM_LIGHTS
-        L = normalize(light_direction.xyz);
+    int num_lights=min(num_dir_lights, MAX_DIR_LIGHTS);
+    for (int i=0; i<num_lights; ++i)
+        {
+        L = normalize(light_direction[i].xyz);
         H = normalize(V+L);
         NdotH= max(0.0,dot( N, H));
         #ifdef HALFLAMBERT
@@ -96,25 +63,9 @@ void main()
         #ifndef HALFLAMBERT
             NdotL= max(0.0,dot( N, L));
         #endif
-        color+=light_color * NdotL;
-        spec=do_specular(roughness, color_tex.rgb, metallic, NdotH, gloss, base_roughness)*light_color;
-    #endif
-    #ifdef NUM_LIGHTS
-        for (int i=0; i<NUM_LIGHTS; ++i)
-            {
-            L = normalize(light_direction[i].xyz);
-            H = normalize(V+L);
-            NdotH= max(0.0,dot( N, H));
-            #ifdef HALFLAMBERT
-                NdotL= pow(max(0.0,dot( N, L))*0.5+0.5, HALFLAMBERT);
-            #endif
-            #ifndef HALFLAMBERT
-                NdotL= max(0.0,dot( N, L));
-            #endif
-            color+=light_color[i] * NdotL;
-            spec+=do_specular(roughness, color_tex.rgb, metallic, NdotH, gloss, base_roughness)*light_color[i];
-            }
-    #endif
+        color+=dir_light_color[i] * NdotL;
+        spec+=do_specular(roughness, color_tex.rgb, metallic, NdotH, gloss, base_roughness)*dir_light_color[i];
+        }
 
     float bloom = (glow*0.5) + (dot(spec, vec3(1.0))*0.33*0.5);
     vec4 final=pre_light_tex+vec4((color*albedo)+spec, bloom);
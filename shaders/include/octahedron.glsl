@@ -0,0 +1,39 @@
+//GLSL
+// Octahedron normal packing, used by the g-buffer and everything that reads normal_tex
+
+// For each component of v, returns -1 if the component is < 0, else 1
+vec2 sign_not_zero(vec2 v)
+    {
+    // Version with branches (for GLSL < 4.00)
+    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
+    }
+
+// Packs a 3-component normal to 2 channels using octahedron normals
+vec2 pack_normal_octahedron(vec3 v)
+    {
+    // Faster version using newer GLSL capatibilities
+    v.xy /= dot(abs(v), vec3(1.0));
+    // Branch-Less version
+    return mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0.0));
+    }
+
+// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
+vec3 unpack_normal_octahedron(vec2 packed_nrm)
+    {
+    // Version using newer GLSL capatibilities
+    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
+    // Branch-Less version
+    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
+    return normalize(v);
+    }
+
+// Same as unpack_normal_octahedron, but where nothing was rendered
+// (the normal is 0,0) the normal is 0,0,0
+vec3 unpack_normal_or_zero(vec2 packed_nrm)
+    {
+    if (packed_nrm==vec2(0.0))
+        {
+            return vec3(0.0);
+        }
+    return unpack_normal_octahedron(packed_nrm);
+    }
@@ -0,0 +1,10 @@
+//GLSL
+// needs: uniform mat4 p3d_ProjectionMatrixInverse;
+
+// View space position from the screen uv and the depth (in -1 to 1 range)
+vec3 getPosition(vec2 uv, float depth)
+    {
+    vec4 view_pos = p3d_ProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
+    view_pos.xyz /= view_pos.w;
+    return view_pos.xyz;
+    }
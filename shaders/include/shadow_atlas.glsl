@@ -0,0 +1,26 @@
+//GLSL
+// needs: uniform sampler2D shadow_atlas;
+
+vec2 atlas_uv(vec2 uv, vec4 tile)
+    {
+    //keep the samples inside the tile (xy - offset, zw - size, in atlas uv)
+    vec2 half_texel=0.5/textureSize(shadow_atlas, 0).xy;
+    return clamp(tile.xy+uv*tile.zw, tile.xy+half_texel, tile.xy+tile.zw-half_texel);
+    }
+
+float soft_shadow(vec2 uv, vec4 tile, float z, float bias, float blur)
+    {
+    float result = float(texture(shadow_atlas, atlas_uv(uv + vec2( -0.326212, -0.405805)*blur, tile)).r >= z+bias);
+    result += float(texture(shadow_atlas, atlas_uv(uv + vec2(-0.840144, -0.073580)*blur, tile)).r >= z+bias);
+    result += float(texture(shadow_atlas, atlas_uv(uv + vec2(-0.695914, 0.457137)*blur, tile)).r >= z+bias);
+    result += float(texture(shadow_atlas, atlas_uv(uv + vec2(-0.203345, 0.620716)*blur, tile)).r >= z+bias);
+    result += float(texture(shadow_atlas, atlas_uv(uv + vec2(0.962340, -0.194983)*blur, tile)).r >= z+bias);
+    result += float(texture(shadow_atlas, atlas_uv(uv + vec2(0.473434, -0.480026)*blur, tile)).r >= z+bias);
+    result += float(texture(shadow_atlas, atlas_uv(uv + vec2(0.519456, 0.767022)*blur, tile)).r >= z+bias);
+    result += float(texture(shadow_atlas, atlas_uv(uv + vec2(0.185461, -0.893124)*blur, tile)).r >= z+bias);
+    result += float(texture(shadow_atlas, atlas_uv(uv + vec2(0.507431, 0.064425)*blur, tile)).r >= z+bias);
+    result += float(texture(shadow_atlas, atlas_uv(uv + vec2(0.896420, 0.412458)*blur, tile)).r >= z+bias);
+    result += float(texture(shadow_atlas, atlas_uv(uv + vec2(-0.321940, -0.932615)*blur, tile)).r >= z+bias);
+    result += float(texture(shadow_atlas, atlas_uv(uv + vec2(-0.791559, -0.597705)*blur, tile)).r >= z+bias);
+    return result/12.0;
+    }
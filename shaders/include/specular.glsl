@@ -0,0 +1,8 @@
+//GLSL
+
+vec3 do_specular(float roughness, vec3 tint,
+                 float metallic, float NdotH,
+                 float gloss, float base_roughness)
+    {
+    return mix(vec3(1.0-roughness), tint, metallic) * pow(NdotH, gloss)*(1.0-base_roughness+metallic);
+    }
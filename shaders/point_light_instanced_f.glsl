@@ -0,0 +1,62 @@
+//GLSL
+#version 140
+uniform mat4 p3d_ProjectionMatrixInverse;
+uniform sampler2D albedo_tex;
+uniform sampler2D normal_tex;
+uniform sampler2D depth_tex;
+// the part of the model buffer in use (see set_dynamic_resolution())
+uniform vec2 model_viewport;
+
+flat in vec4 light_pos;
+flat in vec3 light_color;
+
+#include "include/octahedron.glsl"
+
+#include "include/position.glsl"
+
+#include "include/specular.glsl"
+
+void main()
+    {
+    vec2 win_size=textureSize(depth_tex, 0).xy;
+    vec2 uv=gl_FragCoord.xy/win_size;
+    // the textures are read with uv, the position needs uv in 0-1 range
+    vec2 screen_uv=uv/model_viewport;
+
+    vec4 color_tex=texture(albedo_tex, uv);
+    vec3 albedo=color_tex.rgb;
+    vec4 normal_roughness_metallic=texture(normal_tex,uv);
+    vec3 N=unpack_normal_octahedron(normal_roughness_metallic.xy);
+    float roughness =pow(normal_roughness_metallic.b, 0.5);
+    float base_roughness =normal_roughness_metallic.b;
+    float metallic=normal_roughness_metallic.a;
+    //vec3 specular = mix(vec3(0.04), albedo, metallic);
+    float gloss=350.0*(1.0-roughness);
+    vec3 glow=albedo*color_tex.a;
+    albedo =mix(albedo, vec3(0.0), metallic);
+    float depth=texture(depth_tex,uv).r * 2.0 - 1.0;
+
+    vec3 view_pos =getPosition(screen_uv, depth);
+
+    vec3 color=vec3(0.0);
+    vec3 spec=vec3(0.0);
+    vec3 L=normalize(light_pos.xyz-view_pos.xyz);;
+    vec3 V=normalize(-view_pos.xyz);
+    vec3 H = normalize(V+L);
+    float NdotH= max(0.0,dot( N, H));
+    float NdotL=max(0.0,dot( N, L));
+
+    float light_radius=light_pos.w;
+    float attenuation=1.0-(pow(distance(view_pos.xyz, light_pos.xyz), 2.0)/light_radius);
+    attenuation=pow(max(0.0, attenuation), 3.0);
+    //diffuse
+    color+=light_color*NdotL*attenuation;
+    //specular
+    spec=do_specular(roughness, color_tex.rgb, metallic, NdotH, gloss, base_roughness)*light_color*attenuation;
+
+    float bloom = dot(spec, vec3(1.0))*0.33*0.5;
+    vec4 final=vec4((color*albedo)+spec, bloom);
+
+    gl_FragData[0]=final;
+
+    }
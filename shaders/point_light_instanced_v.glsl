@@ -0,0 +1,24 @@
+//GLSL
+#version 140
+in vec4 p3d_Vertex;
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelViewMatrix;
+// two texels per light:
+// [0] world position xyz, radius
+// [1] color rgb, unused
+uniform samplerBuffer light_data;
+
+flat out vec4 light_pos;
+flat out vec3 light_color;
+
+void main()
+    {
+    vec4 pos_radius=texelFetch(light_data, gl_InstanceID*2);
+    vec4 color=texelFetch(light_data, gl_InstanceID*2+1);
+    //the sphere model has a radius of 1.0, same scale as add_point_light()
+    vec4 vertex=vec4(pos_radius.xyz+p3d_Vertex.xyz*pos_radius.w*1.1, 1.0);
+    gl_Position = p3d_ModelViewProjectionMatrix * vertex;
+    light_pos=vec4(vec4(p3d_ModelViewMatrix * vec4(pos_radius.xyz, 1.0)).xyz, pos_radius.w*pos_radius.w);
+    light_color=color.rgb;
+    }
@@ -3,7 +3,6 @@
 struct p3d_LightSourceParameters
     {
     vec4 position;
-    samplerCube shadowMap;
     };
 uniform p3d_LightSourceParameters shadowcaster;
 uniform mat4 p3d_ProjectionMatrixInverse;
@@ -13,65 +12,76 @@ uniform mat4 p3d_ModelViewMatrix;
 uniform sampler2D albedo_tex;
 uniform sampler2D normal_tex;
 uniform sampler2D depth_tex;
+// the part of the model buffer in use (see set_dynamic_resolution())
+uniform vec2 model_viewport;
 
 uniform mat4 trans_render_to_shadowcaster;
+uniform sampler2D shadow_atlas;
+// one tile per cube face, xy - offset, zw - size, in atlas uv
+uniform vec4 shadow_tile[6];
+// orientation of the cube face lenses, in light space
+uniform vec3 shadow_face_forward[6];
+uniform vec3 shadow_face_right[6];
+uniform vec3 shadow_face_up[6];
 
 uniform vec4 light;
 
 uniform float near;
 uniform float bias;
+// 0.0 - no shadow, 1.0 - full shadow, used to fade shadows in and out
+uniform float shadow_fade;
 
 in vec3 N;
 in vec3 V;
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
+#include "include/octahedron.glsl"
 
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+#include "include/position.glsl"
 
-vec3 getPosition(vec2 uv, float depth)
-    {
-    vec4 view_pos = p3d_ProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
-    view_pos.xyz /= view_pos.w;
-    return view_pos.xyz;
-    }
+#include "include/shadow_atlas.glsl"
 
-float soft_shadow_cube(samplerCube tex, vec3 uvw, float z, float bias, float blur)
+float shadow_cube(vec3 light_vec, float near, float far, float bias, float blur)
     {
-    float pixel=blur/textureSize(tex, 0).x;
-    //float result=float(texture(tex, uvw).r >= (z * 0.5 + 0.5)+bias);
-    float result =float(texture(tex,uvw+vec3(1,0,0)*pixel).r >= (z * 0.5 + 0.5)+bias);
-    result +=float(texture(tex,uvw+vec3(-1,0,0)*pixel).r >= (z * 0.5 + 0.5)+bias);
-    result +=float(texture(tex,uvw+vec3(0,1,0)*pixel).r >= (z * 0.5 + 0.5)+bias);
-    result +=float(texture(tex,uvw+vec3(0,-1,0)*pixel).r >= (z * 0.5 + 0.5)+bias);
-    result +=float(texture(tex,uvw+vec3(0,0,1)*pixel).r >= (z * 0.5 + 0.5)+bias);
-    result +=float(texture(tex,uvw+vec3(0,0,-1)*pixel).r >= (z * 0.5 + 0.5)+bias);
-    return result/6.0;
+    //pick the face the vector is pointing at
+    int face=0;
+    float face_dist=dot(light_vec, shadow_face_forward[0]);
+    for (int i=1; i<6; ++i)
+        {
+        float d=dot(light_vec, shadow_face_forward[i]);
+        if (d > face_dist)
+            {
+            face_dist=d;
+            face=i;
+            }
+        }
+    //90 deg fov, so no need to scale by tan(fov/2)
+    vec2 uv=vec2(dot(light_vec, shadow_face_right[face]), dot(light_vec, shadow_face_up[face]))/face_dist;
+    uv=uv*0.5+0.5;
+    float z=((far+near)/(far-near))+((-2.0*far*near)/(face_dist*(far-near)));
+    z=z*0.5+0.5+bias;
+    vec4 tile=shadow_tile[face];
+    #ifdef DISABLE_SOFTSHADOW
+    return float(texture(shadow_atlas, atlas_uv(uv, tile)).r >= z);
+    #endif
+    #ifndef DISABLE_SOFTSHADOW
+    float pixel=blur/(textureSize(shadow_atlas, 0).x*tile.z);
+    float result =float(texture(shadow_atlas, atlas_uv(uv, tile)).r >= z);
+    result +=float(texture(shadow_atlas, atlas_uv(uv+vec2(1,0)*pixel, tile)).r >= z);
+    result +=float(texture(shadow_atlas, atlas_uv(uv+vec2(-1,0)*pixel, tile)).r >= z);
+    result +=float(texture(shadow_atlas, atlas_uv(uv+vec2(0,1)*pixel, tile)).r >= z);
+    result +=float(texture(shadow_atlas, atlas_uv(uv+vec2(0,-1)*pixel, tile)).r >= z);
+    return result/5.0;
+    #endif
     }
 
-vec3 do_specular(float roughness, vec3 tint,
-                 float metallic, float NdotH,
-                 float gloss, float base_roughness)
-    {
-    return mix(vec3(1.0-roughness), tint, metallic) * pow(NdotH, gloss)*(1.0-base_roughness+metallic);
-    }
+#include "include/specular.glsl"
 
 void main()
     {
     vec2 win_size=textureSize(depth_tex, 0).xy;
     vec2 uv=gl_FragCoord.xy/win_size;
+    // the textures are read with uv, the position needs uv in 0-1 range
+    vec2 screen_uv=uv/model_viewport;
 
     vec4 color_tex=texture(albedo_tex, uv);
     vec3 albedo=color_tex.rgb;
@@ -86,7 +96,7 @@ void main()
     albedo =mix(albedo, vec3(0.0), metallic);
     float depth=texture(depth_tex,uv).r * 2.0 - 1.0;
 
-    vec3 view_pos =getPosition(uv, depth);
+    vec3 view_pos =getPosition(screen_uv, depth);
 
     vec3 color=vec3(0.0);
     vec3 spec=vec3(0.0);
@@ -109,18 +119,10 @@ void main()
     vec4 final=vec4((color*albedo)+spec, bloom);
 
     //shadows
-    vec4 world_pos = p3d_ViewProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
-    vec4 shadow_uv=trans_render_to_shadowcaster*world_pos;
-    shadow_uv.xyz=shadow_uv.xyz/shadow_uv.w;
-    float ldist = max(abs(shadow_uv.x), max(abs(shadow_uv.y), abs(shadow_uv.z)));
-    ldist = ((light_radius+near)/(light_radius-near))+((-2.0*light_radius*near)/(ldist * (light_radius-near)));
-    #ifdef DISABLE_SOFTSHADOW
-        float shadow= float(texture(shadowcaster.shadowMap, shadow_uv.xyz).r >= (ldist * 0.5 + 0.5)+bias);
-    #endif
-    #ifndef DISABLE_SOFTSHADOW
-        float shadow=soft_shadow_cube( shadowcaster.shadowMap,  shadow_uv.xyz,  ldist,  bias,  70.0*(1.0-attenuation));
-    #endif
-    final*=shadow;
+    vec4 world_pos = p3d_ViewProjectionMatrixInverse * vec4( screen_uv.xy * 2.0 - vec2(1.0), depth, 1.0);
+    vec4 light_vec=trans_render_to_shadowcaster*world_pos;
+    float shadow=shadow_cube(light_vec.xyz/light_vec.w, near, sqrt(light_radius), bias, 1.5*(1.0-attenuation));
+    final*=mix(1.0, shadow, shadow_fade);
 
     gl_FragData[0]=final;
 
@@ -0,0 +1,10 @@
+//GLSL
+#version 140
+//cached static depth, same layout as the shadow atlas
+uniform sampler2D shadow_cache;
+
+void main()
+    {
+    //the tiles are in the same place in both atlases
+    gl_FragDepth=texelFetch(shadow_cache, ivec2(gl_FragCoord.xy), 0).r;
+    }
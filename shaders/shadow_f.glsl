@@ -0,0 +1,7 @@
+//GLSL
+#version 140
+
+void main()
+    {
+    //depth only
+    }
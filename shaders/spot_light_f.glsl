@@ -15,6 +15,8 @@ uniform mat4 p3d_ProjectionMatrixInverse;
 uniform sampler2D albedo_tex;
 uniform sampler2D normal_tex;
 uniform sampler2D depth_tex;
+// the part of the model buffer in use (see set_dynamic_resolution())
+uniform vec2 model_viewport;
 
 //uniform mat4 trans_render_to_clip_of_spot;
 //uniform mat4 p3d_ViewProjectionMatrixInverse;
@@ -30,22 +32,7 @@ in vec3 N;
 in vec3 V;
 //in vec4 shadow_uv;
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
-
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+#include "include/octahedron.glsl"
 
 vec4 blur_tex(sampler2D tex, vec2 uv, float blur)
     {
@@ -66,24 +53,16 @@ vec4 blur_tex(sampler2D tex, vec2 uv, float blur)
     return out_tex;
     }
 
-vec3 getPosition(vec2 uv, float depth)
-    {
-    vec4 view_pos = p3d_ProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
-    view_pos.xyz /= view_pos.w;
-    return view_pos.xyz;
-    }
+#include "include/position.glsl"
 
-vec3 do_specular(float roughness, vec3 tint,
-                 float metallic, float NdotH,
-                 float gloss, float base_roughness)
-    {
-    return mix(vec3(1.0-roughness), tint, metallic) * pow(NdotH, gloss)*(1.0-base_roughness+metallic);
-    }
+#include "include/specular.glsl"
 
 void main()
     {
     vec2 win_size=textureSize(depth_tex, 0).xy;
     vec2 uv=gl_FragCoord.xy/win_size;
+    // the textures are read with uv, the position needs uv in 0-1 range
+    vec2 screen_uv=uv/model_viewport;
 
     vec4 color_tex=texture(albedo_tex, uv);
     vec3 albedo=color_tex.rgb;
@@ -97,7 +76,7 @@ void main()
     albedo =mix(albedo, vec3(0.0), metallic);
     float depth=texture(depth_tex,uv).r * 2.0 - 1.0;
 
-    vec3 view_pos =getPosition(uv, depth);
+    vec3 view_pos =getPosition(screen_uv, depth);
 
     vec3 color=vec3(0.0);
     vec3 spec=vec3(0.0);
@@ -8,13 +8,14 @@ struct p3d_LightSourceParameters
     float spotExponent;
     float spotCutoff;
     float spotCosCutoff;
-    sampler2D shadowMap;
     };
 uniform p3d_LightSourceParameters spot;
 uniform mat4 p3d_ProjectionMatrixInverse;
 uniform sampler2D albedo_tex;
 uniform sampler2D normal_tex;
 uniform sampler2D depth_tex;
+// the part of the model buffer in use (see set_dynamic_resolution())
+uniform vec2 model_viewport;
 
 uniform mat4 trans_render_to_clip_of_spot;
 uniform mat4 p3d_ViewProjectionMatrixInverse;
@@ -23,63 +24,30 @@ uniform float light_radius;
 uniform float light_fov;
 uniform vec4 light_pos;
 uniform float bias;
+// 0.0 - no shadow, 1.0 - full shadow, used to fade shadows in and out
+uniform float shadow_fade;
+uniform sampler2D shadow_atlas;
+// xy - offset, zw - size of the tile used by this light, in atlas uv
+uniform vec4 shadow_tile;
 
 in vec3 N;
 in vec3 V;
 
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
+#include "include/octahedron.glsl"
 
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+#include "include/shadow_atlas.glsl"
 
-float soft_shadow(sampler2D tex, vec2 uv, float z, float bias, float blur)
-    {
-    float result = float(texture(tex, uv + vec2( -0.326212, -0.405805)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(-0.840144, -0.073580)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(-0.695914, 0.457137)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(-0.203345, 0.620716)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(0.962340, -0.194983)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(0.473434, -0.480026)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(0.519456, 0.767022)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(0.185461, -0.893124)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(0.507431, 0.064425)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(0.896420, 0.412458)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(-0.321940, -0.932615)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(-0.791559, -0.597705)*blur).r >= z+bias);
-    return result/12.0;
-    }
+#include "include/position.glsl"
 
-vec3 getPosition(vec2 uv, float depth)
-    {
-    vec4 view_pos = p3d_ProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
-    view_pos.xyz /= view_pos.w;
-    return view_pos.xyz;
-    }
-
-vec3 do_specular(float roughness, vec3 tint,
-                 float metallic, float NdotH,
-                 float gloss, float base_roughness)
-    {
-    return mix(vec3(1.0-roughness), tint, metallic) * pow(NdotH, gloss)*(1.0-base_roughness+metallic);
-    }
+#include "include/specular.glsl"
 
 void main()
     {
     vec2 win_size=textureSize(depth_tex, 0).xy;
     vec2 uv=gl_FragCoord.xy/win_size;
+    // the textures are read with uv, the position needs uv in 0-1 range
+    vec2 screen_uv=uv/model_viewport;
 
     vec4 color_tex=texture(albedo_tex, uv);
     vec3 albedo=color_tex.rgb;
@@ -93,7 +61,7 @@ void main()
     albedo =mix(albedo, vec3(0.0), metallic);
     float depth=texture(depth_tex,uv).r * 2.0 - 1.0;
 
-    vec3 view_pos =getPosition(uv, depth);
+    vec3 view_pos =getPosition(screen_uv, depth);
 
     vec3 color=vec3(0.0);
     vec3 spec=vec3(0.0);
@@ -120,16 +88,16 @@ void main()
     vec4 final=vec4((color*albedo)+spec, bloom);
 
     //shadows
-    vec4 pos = p3d_ViewProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
+    vec4 pos = p3d_ViewProjectionMatrixInverse * vec4( screen_uv.xy * 2.0 - vec2(1.0), depth, 1.0);
     vec4 shadow_uv=trans_render_to_clip_of_spot*pos;
     shadow_uv.xyz=shadow_uv.xyz/shadow_uv.w*0.5+0.5;
     #ifdef DISABLE_SOFTSHADOW
-        float shadow= float(texture(spot.shadowMap, shadow_uv.xy).r >= shadow_uv.z+bias);
+        float shadow= float(texture(shadow_atlas, atlas_uv(shadow_uv.xy, shadow_tile)).r >= shadow_uv.z+bias);
     #endif
     #ifndef DISABLE_SOFTSHADOW
-        float shadow= soft_shadow(spot.shadowMap, shadow_uv.xy+vec2(0.0, 0.005), shadow_uv.z, bias, 0.008*attenuation);
+        float shadow= soft_shadow(shadow_uv.xy+vec2(0.0, 0.005), shadow_tile, shadow_uv.z, bias, 0.008*attenuation);
     #endif
-    final*=shadow;
+    final*=mix(1.0, shadow, shadow_fade);
 
 
     gl_FragData[0]=final;
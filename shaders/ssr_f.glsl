@@ -20,29 +20,18 @@ uniform samplerCube cube_tex;
 uniform mat4 trans_apiclip_of_camera_to_apiview_of_camera;
 uniform mat4 trans_apiview_of_camera_to_apiclip_of_camera;
 uniform mat4 trans_apiview_of_camera_to_world;
+#ifdef TEMPORAL
+uniform vec2 temporal_jitter;
+#endif
+// offset of the ray steps (0-1), changes each frame with TEMPORAL
+float ray_offset = 0.0;
 
 
 //uniform float maxDelta;
 //uniform float rayLength;
 
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
-
-
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+#include "include/octahedron.glsl"
 
 float linearizeDepth(float depth)
     {
@@ -77,8 +66,8 @@ vec4 raytrace(vec3 startPos,
     vec4 color = vec4(0.0, 0.0, 0.0, 1.0);
     for (int i = 1; i < stepsCount; i++)
         {
-        samplePos = (startPosSS.xy + vectorSS.xy*i);
-        currentDepthSS = startPosSS.z + vectorSS.z*i;
+        samplePos = (startPosSS.xy + vectorSS.xy*(float(i)-ray_offset));
+        currentDepthSS = startPosSS.z + vectorSS.z*(float(i)-ray_offset);
         currentDepth = linearizeDepth(currentDepthSS);
         sampleDepth = linearizeDepth( texture(depth, samplePos).r);
         deltaD = currentDepth - sampleDepth;
@@ -116,6 +105,10 @@ void main()
         if (normal_roughness_metallic.a > 0.0)
             {
             //float gloss=normal_map.a;
+#ifdef TEMPORAL
+            //interleaved gradient noise, moved each frame
+            ray_offset = fract(52.9829189*fract(dot(gl_FragCoord.xy, vec2(0.06711056, 0.00583715)))+temporal_jitter.x);
+#endif
             vec3 N = unpack_normal_octahedron(normal_roughness_metallic.xy);
             //hardware depth
             float D = texture(depth_tex, uv).r;
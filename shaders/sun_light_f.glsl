@@ -1,107 +1,105 @@
 //GLSL
 #version 140
-struct p3d_LightSourceParameters
-    {
-    vec4 color;
-    vec4 position;
-    vec3 spotDirection;
-    float spotExponent;
-    float spotCutoff;
-    float spotCosCutoff;
-    sampler2D shadowMap;
-    };
-uniform p3d_LightSourceParameters spot;
 uniform mat4 p3d_ProjectionMatrixInverse;
+uniform mat4 p3d_ViewProjectionMatrixInverse;
 uniform sampler2D albedo_tex;
 uniform sampler2D normal_tex;
 uniform sampler2D depth_tex;
+// the part of the model buffer in use (see set_dynamic_resolution())
+uniform vec2 model_viewport;
 
-uniform mat4 trans_render_to_clip_of_spot;
-uniform mat4 p3d_ViewProjectionMatrixInverse;
-
+uniform vec3 sun_color;
+#ifdef NUM_CASCADES
 uniform float bias;
+// 0.0 - no shadow, 1.0 - full shadow, used to fade shadows in and out
+uniform float shadow_fade;
+uniform sampler2D shadow_atlas;
+// render space to clip space of each cascade camera
+uniform mat4 sun_shadow_mat[NUM_CASCADES];
+// xy - offset, zw - size of the tile used by each cascade, in atlas uv
+uniform vec4 sun_shadow_tile[NUM_CASCADES];
+// distance from the camera where each cascade ends
+uniform float sun_cascade_far[NUM_CASCADES];
+#endif
 
-in vec3 N;
-in vec3 V;
 in vec4 light_direction;
-//in vec4 shadow_uv;
 
-// For each component of v, returns -1 if the component is < 0, else 1
-vec2 sign_not_zero(vec2 v)
-    {
-    // Version with branches (for GLSL < 4.00)
-    return vec2(v.x >= 0 ? 1.0 : -1.0, v.y >= 0 ? 1.0 : -1.0);
-    }
+#include "include/octahedron.glsl"
 
-// Packs a 3-component normal to 2 channels using octahedron normals
-vec2 pack_normal_octahedron(vec3 v)
-    {
-    // Faster version using newer GLSL capatibilities
-    v.xy /= dot(abs(v), vec3(1.0));
-    // Branch-Less version
-    return mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0.0));
-    }
+#include "include/position.glsl"
 
+#include "include/specular.glsl"
 
-// Unpacking from octahedron normals, input is the output from pack_normal_octahedron
-vec3 unpack_normal_octahedron(vec2 packed_nrm)
-    {
-    // Version using newer GLSL capatibilities
-    vec3 v = vec3(packed_nrm.xy, 1.0 - abs(packed_nrm.x) - abs(packed_nrm.y));
-    // Branch-Less version
-    v.xy = mix(v.xy, (1.0 - abs(v.yx)) * sign_not_zero(v.xy), step(v.z, 0));
-    return normalize(v);
-    }
+#ifdef NUM_CASCADES
+#include "include/shadow_atlas.glsl"
 
-float soft_shadow(sampler2D tex, vec2 uv, float z, float bias, float blur)
+float sun_shadow(vec4 world_pos, float view_depth)
     {
-    float result = float(texture(tex, uv + vec2( -0.326212, -0.405805)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(-0.840144, -0.073580)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(-0.695914, 0.457137)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(-0.203345, 0.620716)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(0.962340, -0.194983)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(0.473434, -0.480026)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(0.519456, 0.767022)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(0.185461, -0.893124)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(0.507431, 0.064425)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(0.896420, 0.412458)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(-0.321940, -0.932615)*blur).r >= z+bias);
-    result += float(texture(tex, uv + vec2(-0.791559, -0.597705)*blur).r >= z+bias);
-    return result/12.0;
+    for (int i=0; i<NUM_CASCADES; ++i)
+        {
+        vec4 shadow_uv=sun_shadow_mat[i]*world_pos;
+        shadow_uv.xyz=shadow_uv.xyz/shadow_uv.w*0.5+0.5;
+        //far cascades are not updated every frame, so the point might
+        //be outside the cascade even if it's in the cascade depth range
+        if (view_depth > sun_cascade_far[i] ||
+            any(lessThan(shadow_uv.xyz, vec3(0.0))) ||
+            any(greaterThan(shadow_uv.xyz, vec3(1.0))))
+            continue;
+        #ifdef DISABLE_SOFTSHADOW
+            return float(texture(shadow_atlas, atlas_uv(shadow_uv.xy, sun_shadow_tile[i])).r >= shadow_uv.z+bias);
+        #endif
+        #ifndef DISABLE_SOFTSHADOW
+            //the same blur in world units for all cascades
+            return soft_shadow(shadow_uv.xy, sun_shadow_tile[i], shadow_uv.z, bias, 0.001*sun_cascade_far[0]/sun_cascade_far[i]);
+        #endif
+        }
+    return 1.0;
     }
+#endif
 
 void main()
     {
-    vec3 color=vec3(0.0, 0.0, 0.0);
     vec2 win_size=textureSize(depth_tex, 0).xy;
     vec2 uv=gl_FragCoord.xy/win_size;
+    // the textures are read with uv, the position needs uv in 0-1 range
+    vec2 screen_uv=uv/model_viewport;
 
     vec4 color_tex=texture(albedo_tex, uv);
     vec3 albedo=color_tex.rgb;
-    vec4 normal_glow_gloss=texture(normal_tex,uv);
-    vec3 normal=unpack_normal_octahedron(normal_glow_gloss.xy);
-    float gloss=normal_glow_gloss.a;
-    float glow=normal_glow_gloss.b;
+    vec4 normal_roughness_metallic=texture(normal_tex,uv);
+    vec3 N=unpack_normal_or_zero(normal_roughness_metallic.xy);
+    float roughness =pow(normal_roughness_metallic.b, 0.5);
+    float base_roughness =normal_roughness_metallic.b;
+    float metallic=normal_roughness_metallic.a;
+    float gloss=350.0*(1.0-roughness);
+    albedo =mix(albedo, vec3(0.0), metallic);
     float depth=texture(depth_tex,uv).r * 2.0 - 1.0;
 
-    //vec4 light_view_pos=spot.position;
-
-    vec4 view_pos = p3d_ProjectionMatrixInverse * vec4( uv.xy * 2.0 - vec2(1.0), depth, 1.0);
-    view_pos.xyz /= view_pos.w;
-
-    //vec3 light_vec = -normalize(spot.spotDirection);
-    vec3 light_vec = normalize(light_direction.xyz);
-    //light_vec = normalize(spot.position.xyz-view_pos.xyz);
-
-    //diffuse
-    color+=spot.color.rgb*max(dot(normal.xyz,light_vec), 0.0);
-    //spec
-    vec3 view_vec = normalize(-view_pos.xyz);
-    vec3 reflect_vec=normalize(reflect(light_vec,normal.xyz));
-    float spec=clamp(pow(max(dot(reflect_vec, -view_vec), 0.0), 50.0+1500.0*gloss)*gloss*2.0, 0.0, 0.45);
-
-
-    vec4 final=vec4((color*albedo)+spot.color.rgb*spec, spec+gloss);
+    vec3 view_pos =getPosition(screen_uv, depth);
+
+    vec3 L = normalize(light_direction.xyz);
+    vec3 V=normalize(-view_pos.xyz);
+    vec3 H = normalize(V+L);
+    float NdotH= max(0.0,dot( N, H));
+    #ifdef HALFLAMBERT
+        float NdotL= pow(max(0.0,dot( N, L))*0.5+0.5, HALFLAMBERT);
+    #endif
+    #ifndef HALFLAMBERT
+        float NdotL= max(0.0,dot( N, L));
+    #endif
+
+    vec3 color=sun_color*NdotL;
+    vec3 spec=do_specular(roughness, color_tex.rgb, metallic, NdotH, gloss, base_roughness)*sun_color;
+
+    float bloom = dot(spec, vec3(1.0))*0.33*0.5;
+    vec4 final=vec4((color*albedo)+spec, bloom);
+
+    #ifdef NUM_CASCADES
+        vec4 world_pos = p3d_ViewProjectionMatrixInverse * vec4( screen_uv.xy * 2.0 - vec2(1.0), depth, 1.0);
+        world_pos/=world_pos.w;
+        float shadow=sun_shadow(world_pos, -view_pos.z);
+        final*=mix(1.0, shadow, shadow_fade);
+    #endif
 
     gl_FragData[0]=final;
     }
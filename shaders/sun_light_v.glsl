@@ -1,22 +1,15 @@
 //GLSL
 #version 140
 in vec4 p3d_Vertex;
-in vec3 p3d_Normal;
 
-uniform mat4 p3d_ModelViewProjectionMatrix;
-uniform mat3 p3d_NormalMatrix;
-uniform mat4 p3d_ModelViewMatrix;
-uniform mat4 trans_world_to_apiview_of_camera;
-uniform vec3 direction;
+uniform mat4 p3d_ViewMatrix;
+uniform vec3 sun_direction;
 
-out vec3 N;
-out vec3 V;
 out vec4 light_direction;
 
 void main()
     {
-    light_direction=trans_world_to_apiview_of_camera*vec4(normalize(direction), 0.0);
-    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
-    N=p3d_NormalMatrix * p3d_Normal;
-    V=vec4(p3d_ModelViewMatrix * p3d_Vertex).xyz;
+    light_direction=p3d_ViewMatrix*vec4(normalize(sun_direction), 0.0);
+    //fullscreen quad made with CardMaker, in the xz plane
+    gl_Position = vec4(p3d_Vertex.xz, 0.0, 1.0);
     }
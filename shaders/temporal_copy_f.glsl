@@ -0,0 +1,10 @@
+//GLSL
+#version 140
+uniform sampler2D input_tex;
+
+in vec2 uv;
+
+void main()
+    {
+    gl_FragData[0] = texture(input_tex, uv);
+    }
@@ -0,0 +1,31 @@
+//GLSL
+#version 140
+uniform sampler2D depth_tex;
+uniform mat4 trans_apiclip_of_camera_to_apiview_of_camera;
+
+in vec2 uv;
+
+#ifndef DEPTH_RANGE
+#define DEPTH_RANGE 1000.0
+#endif
+
+// Distance from the camera (view space depth)
+float get_view_depth(vec2 tex_uv)
+    {
+    float depth = texture(depth_tex, tex_uv).r;
+    vec4 view_pos = trans_apiclip_of_camera_to_apiview_of_camera * vec4(tex_uv*2.0-1.0, depth*2.0-1.0, 1.0);
+    return abs(view_pos.z/view_pos.w);
+    }
+
+// 24 bit depth in a 8 bit per channel rgb texture
+vec3 pack_depth(float depth)
+    {
+    vec3 packed_depth = fract(depth*vec3(1.0, 255.0, 65025.0));
+    packed_depth -= packed_depth.yzz*vec3(1.0/255.0, 1.0/255.0, 0.0);
+    return packed_depth;
+    }
+
+void main()
+    {
+    gl_FragData[0] = vec4(pack_depth(clamp(get_view_depth(uv)/DEPTH_RANGE, 0.0, 0.9999)), 1.0);
+    }
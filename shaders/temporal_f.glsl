@@ -0,0 +1,46 @@
+//GLSL
+#version 140
+uniform sampler2D current_tex;
+uniform sampler2D history_tex;
+uniform sampler2D history_depth;
+uniform sampler2D depth_tex;
+uniform mat4 trans_apiclip_of_camera_to_world;
+uniform mat4 prev_view_proj;
+uniform float temporal_blend;
+
+in vec2 uv;
+
+#ifndef DEPTH_RANGE
+#define DEPTH_RANGE 1000.0
+#endif
+#ifndef DISOCCLUSION
+#define DISOCCLUSION 0.05
+#endif
+
+// see temporal_depth_f.glsl
+float unpack_depth(vec3 packed_depth)
+    {
+    return dot(packed_depth, vec3(1.0, 1.0/255.0, 1.0/65025.0));
+    }
+
+void main()
+    {
+    vec4 current = texture(current_tex, uv);
+    //where was this pixel last frame?
+    float depth = texture(depth_tex, uv).r;
+    vec4 world_pos = trans_apiclip_of_camera_to_world * vec4(uv*2.0-1.0, depth*2.0-1.0, 1.0);
+    world_pos /= world_pos.w;
+    vec4 prev_pos = prev_view_proj * world_pos;
+    vec2 prev_uv = prev_pos.xy/prev_pos.w*0.5+0.5;
+
+    float blend = temporal_blend;
+    //off screen last frame
+    if (any(lessThan(prev_uv, vec2(0.0))) || any(greaterThan(prev_uv, vec2(1.0))))
+        blend = 0.0;
+    //something else was there last frame (disocclusion)
+    float prev_depth = unpack_depth(texture(history_depth, prev_uv).rgb)*DEPTH_RANGE;
+    if (abs(prev_depth-prev_pos.w) > DISOCCLUSION*prev_pos.w)
+        blend = 0.0;
+
+    gl_FragData[0] = mix(current, texture(history_tex, prev_uv), blend);
+    }